@@ -7,42 +7,79 @@ import tempfile
 import subprocess
 import logging
 import shutil
-from typing import Dict, List, Optional, Tuple
+import queue
+import hashlib
+import zlib
+import signal
+import socket
+import gzip
+import struct
+import sqlite3
+import importlib.util
+from array import array
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, BinaryIO, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 import json
 import time
-from threading import Lock
+from threading import Event, Lock, Timer
+
+# Тяжёлые зависимости (openpyxl, docxtpl, reportlab, PyPDF2, Pillow, uno)
+# импортируются при первом использовании: до bind порта грузится только FastAPI.
 
 # --- optional Excel support
-try:
-    from openpyxl import load_workbook
-    HAS_XLSX = True
-except Exception:
-    HAS_XLSX = False
+HAS_XLSX = importlib.util.find_spec("openpyxl") is not None
 
-from fastapi import FastAPI, UploadFile, File, Form
+# --- optional UNO bridge (python3-uno) для управления LibreOffice по сокету
+HAS_UNO = importlib.util.find_spec("uno") is not None
+
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.responses import (
     FileResponse,
-    HTMLResponse,
+    JSONResponse,
     Response,
     StreamingResponse,
     PlainTextResponse,
 )
 from fastapi.middleware.cors import CORSMiddleware
 
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-
-from docxtpl import DocxTemplate
+if TYPE_CHECKING:
+    from docxtpl import DocxTemplate
+    from PyPDF2.generic import DictionaryObject, IndirectObject, StreamObject
 
 
 # =============================================================================
 # App / logging
 # =============================================================================
-app = FastAPI(title="Certificates Generator")
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Запуск и остановка сервиса в одном месте; сами шаги — у своих подсистем.
+    Остановка идёт от новых единиц работы к ресурсам: уборщик и прогресс,
+    планировщик и пулы этапов, затем LibreOffice и каталоги конвертации.
+    """
+    _sweep_workspaces()
+    _start_executors()
+    janitor = asyncio.create_task(_results_janitor())
+    await _prepare_overlay_on_startup()
+    _start_warmup()
+    try:
+        yield
+    finally:
+        janitor.cancel()
+        PROGRESS_PUBLISHER.shutdown()
+        SCHEDULER.shutdown()
+        EXECUTORS.shutdown()
+        LO_POOL.shutdown()
+        WORKSPACES.close()
+
+
+app = FastAPI(title="Certificates Generator", lifespan=lifespan)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("certefikati")
 
@@ -51,8 +88,16 @@ ONLINE_NAME_PAD_NBSP   = 0   # ОТКЛЮЧЕНО: позиция задана 
 ONLINE_COURSE_PAD_NBSP = 0   # ОТКЛЮЧЕНО: позиция задана в шаблоне
 NBSP = "\u00A0"
 
-# lock для сериализации LibreOffice (soffice) конвертаций
-LO_CONVERT_LOCK = Lock()
+# пул LibreOffice: число долгоживущих soffice, каждый со своим профилем
+LO_POOL_SIZE = max(1, int(os.getenv("LO_POOL_SIZE", str(min(4, os.cpu_count() or 1)))))
+LO_PROFILES_DIR = os.getenv("LO_PROFILES_DIR", os.path.join(tempfile.gettempdir(), "lo_pool"))
+LO_ACQUIRE_TIMEOUT = int(os.getenv("LO_ACQUIRE_TIMEOUT", "600"))  # секунды ожидания свободного слота
+LO_RECYCLE_AFTER = int(os.getenv("LO_RECYCLE_AFTER", "500"))  # перезапуск инстанса после N конвертаций
+LO_CONVERT_TIMEOUT = int(os.getenv("LO_CONVERT_TIMEOUT", "180"))  # секунды на одну конвертацию
+
+# пакетный режим: сколько строк одного шаблона склеивать в один DOCX; полная группа
+# уходит в конвертацию сразу (0 — без ограничения: группы ждут конца входа)
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "25"))
 
 
 @app.head("/")
@@ -66,208 +111,48 @@ def root():
     return RedirectResponse(url="/ui")
 
 
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+UI_CACHE_MAX_AGE = int(os.getenv("UI_CACHE_MAX_AGE", "300"))  # секунды
+
+
+@dataclass
+class StaticAsset:
+    """Файл из STATIC_DIR, заранее сжатый gzip; ETag — по содержимому."""
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+
+_STATIC_ASSETS: Dict[str, StaticAsset] = {}
+
+
+def static_asset(name: str) -> StaticAsset:
+    asset = _STATIC_ASSETS.get(name)
+    if asset is None:
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            body = f.read()
+        asset = _STATIC_ASSETS[name] = StaticAsset(
+            body=body,
+            gzipped=gzip.compress(body, 9, mtime=0),
+            etag='"%s"' % hashlib.sha256(body).hexdigest()[:16],
+        )
+    return asset
+
+
 @app.get("/ui")
-def ui():
-    html_content = """
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Генератор сертификатов</title>
-    <style>
-        body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; background-color: #f5f5f5; }
-        .container { background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-        h1 { color: #333; text-align: center; margin-bottom: 30px; }
-        .form-group { margin-bottom: 20px; }
-        label { display: block; margin-bottom: 5px; font-weight: bold; color: #555; }
-        input[type="file"] { width: 100%; padding: 10px; border: 2px dashed #ddd; border-radius: 5px; background: #fafafa; }
-        .radio-group { display: flex; gap: 20px; margin-top: 10px; }
-        .radio-item { display: flex; align-items: center; gap: 5px; }
-        input[type="radio"] { margin: 0; }
-        button { background: #007bff; color: white; border: none; padding: 12px 30px; border-radius: 5px; cursor: pointer; font-size: 16px; width: 100%; margin-top: 20px; }
-        button:hover { background: #0056b3; }
-        button:disabled { background: #ccc; cursor: not-allowed; }
-        .status { margin-top: 20px; padding: 10px; border-radius: 5px; display: none; }
-        .status.success { background: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-        .status.error { background: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-        .progress { width: 100%; height: 20px; background: #f0f0f0; border-radius: 10px; overflow: hidden; margin-top: 10px; display: none; }
-        .progress-bar { height: 100%; background: #007bff; width: 0%; transition: width 0.3s; }
-        .progress-info { margin-top: 6px; color: #555; font-size: 14px; display: none; }
-        #fileStatus { margin-top: 6px; font-size: 14px; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Генератор сертификатов</h1>
-
-        <form id="certificateForm">
-            <div class="form-group">
-                <label for="csvFile">Выберите файл (CSV или Excel):</label>
-                <input type="file" id="csvFile" name="csv_file" accept=".csv,.xlsx,.xls" required>
-                <div id="fileStatus">Файл не выбран</div>
-            </div>
-
-            <div class="form-group">
-                <label>Тип сертификата:</label>
-                <div class="radio-group">
-                    <div class="radio-item">
-                        <input type="radio" id="print" name="mode" value="print">
-                        <label for="print">Печать</label>
-                    </div>
-                    <div class="radio-item">
-                        <input type="radio" id="online" name="mode" value="online" checked>
-                        <label for="online">Онлайн</label>
-                    </div>
-                </div>
-            </div>
-
-            <button type="submit" id="generateBtn">Сгенерировать</button>
-        </form>
-
-        <div class="progress" id="progress"><div class="progress-bar" id="progressBar"></div></div>
-        <div class="progress-info" id="progressInfo"></div>
-        <div class="status" id="status"></div>
-    </div>
-
-    <script>
-        const form = document.getElementById('certificateForm');
-        const fileInput = document.getElementById('csvFile');
-        const fileStatus = document.getElementById('fileStatus');
-        const generateBtn = document.getElementById('generateBtn');
-        const progress = document.getElementById('progress');
-        const progressBar = document.getElementById('progressBar');
-        const progressInfo = document.getElementById('progressInfo');
-        const status = document.getElementById('status');
-
-        fileInput.addEventListener('change', function() {
-            if (this.files.length > 0) {
-                fileStatus.textContent = `Выбран файл: ${this.files[0].name}`;
-                fileStatus.style.color = '#28a745';
-            } else {
-                fileStatus.textContent = 'Файл не выбран';
-                fileStatus.style.color = '#dc3545';
-            }
-        });
-
-        form.addEventListener('submit', async function(e) {
-            e.preventDefault();
-
-            const formData = new FormData();
-            const file = fileInput.files[0];
-            const mode = document.querySelector('input[name="mode"]:checked').value;
-
-            if (!file) {
-                showStatus('Пожалуйста, выберите файл', 'error');
-                return;
-            }
-
-            formData.append('csv_file', file);
-            formData.append('mode', mode);
-
-            const jobId = (window.crypto && crypto.randomUUID)
-                ? crypto.randomUUID() : ('job-' + Date.now() + '-' + Math.random().toString(16).slice(2));
-            formData.append('job_id', jobId);
-
-            generateBtn.disabled = true;
-            generateBtn.textContent = 'Генерация...';
-            progress.style.display = 'block';
-            progressInfo.style.display = 'block';
-            status.style.display = 'none';
-
-            // progress via SSE
-            const es = new EventSource(`/progress/${jobId}`);
-            let sseStage = 'init';
-            es.onmessage = (ev) => {
-                try {
-                    const data = JSON.parse(ev.data || '{}');
-                    sseStage = data.stage || sseStage;
-                    if (sseStage === 'processing' || sseStage === 'zipping') {
-                        updateProgress(data.percent || 0);
-                        setInfo(`${data.message || ''} (${data.processed || 0}/${data.total || 0})`);
-                    } else if (sseStage === 'done') {
-                        setInfo('Подготовка к скачиванию...');
-                        downloadZip(jobId);
-                    } else if (sseStage === 'uploading') {
-                        setInfo('Загрузка файла...');
-                    } else if (sseStage === 'error') {
-                        setInfo(data.message || 'Ошибка');
-                    }
-                    if (sseStage === 'done' || sseStage === 'error') es.close();
-                } catch (e) {}
-            };
-            es.onerror = () => es.close();
-
-            try {
-                const xhr = new XMLHttpRequest();
-                xhr.open('POST', '/generate-async');
-                xhr.responseType = 'json';
-                xhr.upload.onprogress = (e) => {
-                    if (e.lengthComputable) {
-                        const pct = Math.round((e.loaded / e.total) * 100);
-                        updateProgress(Math.min(pct, 99));
-                        setInfo(`Загрузка файла: ${pct}%`);
-                    } else {
-                        setInfo('Загрузка файла...');
-                    }
-                };
-                xhr.onload = () => {
-                    if (xhr.status !== 200) {
-                        const text = typeof xhr.response === 'string' ? xhr.response : (xhr.response?.detail || 'Ошибка запуска');
-                        showStatus(`Ошибка: ${text}`, 'error');
-                        cleanup();
-                        return;
-                    }
-                    setInfo('Файл загружен, идёт обработка...');
-                };
-                xhr.onerror = () => {
-                    showStatus('Сетевая ошибка при запросе', 'error');
-                    cleanup();
-                };
-                xhr.send(formData);
-            } catch (error) {
-                showStatus(`Ошибка сети: ${error.message}`, 'error');
-                cleanup();
-            }
-        });
-
-        function showStatus(message, type) {
-            status.textContent = message;
-            status.className = `status ${type}`;
-            status.style.display = 'block';
-        }
-        function updateProgress(pct) { progressBar.style.width = (pct || 0) + '%'; }
-        function setInfo(text) { progressInfo.textContent = text || ''; }
-        function cleanup() {
-            generateBtn.disabled = false;
-            generateBtn.textContent = 'Сгенерировать';
-            setTimeout(() => {
-                progress.style.display = 'none';
-                progressInfo.style.display = 'none';
-                progressBar.style.width = '0%';
-                progressInfo.textContent = '';
-            }, 800);
-        }
-        async function downloadZip(jobId) {
-            try {
-                const res = await fetch(`/download/${jobId}`);
-                if (!res.ok) { setTimeout(() => downloadZip(jobId), 1500); return; }
-                const blob = await res.blob();
-                const url = window.URL.createObjectURL(blob);
-                const a = document.createElement('a');
-                a.href = url; a.download = 'certificates.zip';
-                document.body.appendChild(a); a.click();
-                document.body.removeChild(a); window.URL.revokeObjectURL(url);
-                updateProgress(100); setInfo('Готово');
-                showStatus('Сертификаты успешно сгенерированы!', 'success');
-                cleanup();
-            } catch (e) { showStatus('Ошибка при скачивании результата', 'error'); cleanup(); }
-        }
-    </script>
-</body>
-</html>
-    """
-    return HTMLResponse(content=html_content)
+def ui(request: Request) -> Response:
+    asset = static_asset("ui.html")
+    headers = {
+        "Cache-Control": f"public, max-age={UI_CACHE_MAX_AGE}",
+        "ETag": asset.etag,
+        "Vary": "Accept-Encoding",
+    }
+    if request.headers.get("if-none-match") == asset.etag:
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=asset.gzipped, media_type="text/html; charset=utf-8", headers=headers)
+    return Response(content=asset.body, media_type="text/html; charset=utf-8", headers=headers)
 
 
 app.add_middleware(
@@ -278,6 +163,95 @@ app.add_middleware(
 )
 
 
+# =============================================================================
+# Metrics (Prometheus text format, без внешних зависимостей)
+# =============================================================================
+def _label_value(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, _label_value(v)) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels_text(self.labels, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # ключ меток -> (счётчики по корзинам, сумма, количество)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            counts, total, n = self._series.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[key] = (counts, total + value, n + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, n) in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = _labels_text(self.labels, key, 'le="%g"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {count}")
+                le = _labels_text(self.labels, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {n}")
+                lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {total:.6f}")
+                lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {n}")
+        return lines
+
+
+def gauge_lines(name: str, help_text: str, value: float) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+
+
+# render — DOCX до конвертации, convert — LibreOffice, lock_wait — ожидание слота пула,
+# overlay — штамп текста поверх фона, zip — запись PDF в архив
+STAGE_SECONDS = Histogram("certgen_stage_duration_seconds", "Duration of pipeline stages", ("stage",))
+ROWS_TOTAL = Counter("certgen_rows_total", "Uploaded rows by outcome", ("mode", "kind", "status"))
+
+
 # =============================================================================
 # Paths / fonts
 # =============================================================================
@@ -287,40 +261,57 @@ TEMPLATES_DIR = os.path.abspath(os.path.join(BASE_DIR, "..", "Templates"))
 FONTS_DIR_CANDIDATES = [
     os.path.abspath(os.path.join(BASE_DIR, "..", "fonts")),
     os.path.abspath(os.path.join(BASE_DIR, "..", "@fonts")),
+    "/usr/local/share/fonts/ey",  # Dockerfile
 ]
 FONTS_DIR = next((p for p in FONTS_DIR_CANDIDATES if os.path.isdir(p)), FONTS_DIR_CANDIDATES[0])
 
 FONT_NAME = "EYInterstate"
-registered = False
-try:
-    regular = os.path.join(FONTS_DIR, "EYINTERSTATE-REGULAR.OTF")
-    if os.path.exists(regular):
-        pdfmetrics.registerFont(TTFont(FONT_NAME, regular))
-        registered = True
-        for (alias, path) in [
-            ("EYInterstate-Bold", os.path.join(FONTS_DIR, "EYINTERSTATE-BOLD.OTF")),
-            ("EYInterstate-Light", os.path.join(FONTS_DIR, "EYINTERSTATE-LIGHT.OTF")),
-        ]:
-            if os.path.exists(path):
-                try: pdfmetrics.registerFont(TTFont(alias, path))
-                except Exception: pass
-except Exception:
-    registered = False
-
-if not registered:
-    FONT_NAME = "DejaVuSans"
-    for p in ["/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-              "/usr/share/fonts/trruetype/dejavu/DejaVuSansCondensed.ttf",
-              "/usr/share/fonts/truetype/dejavu/DejaVuSansCondensed.ttf"]:
-        if os.path.exists(p):
-            try:
-                pdfmetrics.registerFont(TTFont(FONT_NAME, p))
+_fonts_lock = Lock()
+_fonts_ready = False
+
+
+def ensure_fonts() -> None:
+    """Регистрирует шрифты reportlab при первом обращении (а не при импорте модуля)."""
+    global FONT_NAME, _fonts_ready
+    if _fonts_ready:
+        return
+    with _fonts_lock:
+        if _fonts_ready:
+            return
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+
+        registered = False
+        try:
+            regular = os.path.join(FONTS_DIR, "EYINTERSTATE-REGULAR.OTF")
+            if os.path.exists(regular):
+                pdfmetrics.registerFont(TTFont("EYInterstate", regular))
                 registered = True
-                break
-            except Exception:
-                continue
-if not registered:
-    FONT_NAME = "Helvetica"
+                for (alias, path) in [
+                    ("EYInterstate-Bold", os.path.join(FONTS_DIR, "EYINTERSTATE-BOLD.OTF")),
+                    ("EYInterstate-Light", os.path.join(FONTS_DIR, "EYINTERSTATE-LIGHT.OTF")),
+                ]:
+                    if os.path.exists(path):
+                        try: pdfmetrics.registerFont(TTFont(alias, path))
+                        except Exception: pass
+        except Exception:
+            registered = False
+
+        if not registered:
+            FONT_NAME = "DejaVuSans"
+            for p in ["/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+                      "/usr/share/fonts/trruetype/dejavu/DejaVuSansCondensed.ttf",
+                      "/usr/share/fonts/truetype/dejavu/DejaVuSansCondensed.ttf"]:
+                if os.path.exists(p):
+                    try:
+                        pdfmetrics.registerFont(TTFont(FONT_NAME, p))
+                        registered = True
+                        break
+                    except Exception:
+                        continue
+        if not registered:
+            FONT_NAME = "Helvetica"
+        _fonts_ready = True
 
 
 # =============================================================================
@@ -338,8 +329,164 @@ DOCX_MAP: Dict[str, Dict[str, Dict[str, str]]] = {
         "1day_1month": {"normal": "template-online3_1day_1month.docx", "small": "template-online3_small_1day_1month.docx"},
     },
 }
+# имя шаблона -> вид дат (для меток метрик)
+TEMPLATE_KINDS: Dict[str, str] = {
+    name: kind for group in DOCX_MAP.values() for kind, variants in group.items() for name in variants.values()
+}
+# имя шаблона -> print/online (для преобразований при загрузке)
+TEMPLATE_GROUPS: Dict[str, str] = {
+    name: group for group, kinds in DOCX_MAP.items() for variants in kinds.values() for name in variants.values()
+}
+
+
+
+# =============================================================================
+# Кэш готовых PDF: ключ — хэш (шаблон, режим, движок, контекст), LRU на диске
+# =============================================================================
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "cert_render_cache"))
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # 0 — выключен
+
+_TEMPLATE_DIGESTS: Dict[Tuple[str, float, int], str] = {}
+
+
+def template_digest(path: str) -> str:
+    """sha256 содержимого шаблона; пересчитывается только при изменении файла."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    digest = _TEMPLATE_DIGESTS.get(key)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = _TEMPLATE_DIGESTS[key] = hashlib.sha256(f.read()).hexdigest()
+    return digest
+
+
+def template_version(path: str) -> str:
+    """Версия шаблона вместе с преобразованиями, которые к нему применяются при загрузке."""
+    transforms = template_transforms(path)
+    if not transforms:
+        return template_digest(path)
+    return hashlib.sha256((template_digest(path) + repr(transforms)).encode("utf-8")).hexdigest()
+
+
+def template_set_version() -> str:
+    """Отпечаток всего набора шаблонов (и ручной раскладки overlay, если есть)."""
+    h = hashlib.sha256()
+    names = sorted({n for group in DOCX_MAP.values() for variants in group.values() for n in variants.values()})
+    for name in names:
+        path = os.path.join(TEMPLATES_DIR, name)
+        h.update(name.encode("utf-8"))
+        h.update((template_version(path) if os.path.exists(path) else "-").encode("ascii"))
+    if os.path.exists(OVERLAY_LAYOUTS_FILE):
+        h.update(template_digest(OVERLAY_LAYOUTS_FILE).encode("ascii"))
+    return h.hexdigest()
+
+
+class RenderCache:
+    """Content-addressed кэш PDF на диске с LRU-вытеснением по суммарному размеру."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(directory):
+                if name.endswith(".pdf"):
+                    st = os.stat(os.path.join(directory, name))
+                    entries.append((st.st_mtime, name[:-4], st.st_size))
+            for _, key, size in sorted(entries):
+                self._index[key] = size
+                self._bytes += size
+            self._evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(docx_path: str, mode: str, engine: str, context: Dict[str, str]) -> str:
+        payload = json.dumps([template_version(docx_path), mode, engine, context], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pdf")
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                self._bytes -= self._index.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=key + ".", suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            # кэш — только ускорение: сбой записи не должен ронять строку
+            logger.warning(f"Render cache write failed for {key[:12]}: {e}")
+            if tmp is not None:
+                try: os.unlink(tmp)
+                except OSError: pass
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            self._bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try: os.unlink(self._path(key))
+            except OSError: pass
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._index),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
 
-DOCX_TO_PDF_CACHE: Dict[str, str] = {}
+RENDER_CACHE = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES)
 
 
 # =============================================================================
@@ -374,28 +521,81 @@ KEY_ALIASES = {
     "country":    {"страна", "country", "страна/country", "country/страна"},
 }
 
-def _build_row_with_normalized_keys(row: Dict[str, str]) -> Dict[str, str]:
-    out: Dict[str, str] = {}
-    for k, v in (row or {}).items():
-        if k is None: continue
-        val = _clean_value(v)
-        out[k] = val
-        nk = _norm_key(str(k))
-        out[nk] = val
-        if "/" in str(k):
-            parts = [p.strip() for p in str(k).split("/") if p.strip()]
-            for p in parts:
-                out[p] = val
-                out[_norm_key(p)] = val
-    return out
-
-def _get_field(row: Dict[str, str], canonical: str) -> str:
-    r = _build_row_with_normalized_keys(row)
-    aliases = KEY_ALIASES.get(canonical, set())
-    for key in list(r.keys()):
-        nk = _norm_key(str(key))
-        if nk in aliases: return _clean_value(r[key])
-    return _clean_value(r.get(canonical) or r.get(_norm_key(canonical)) or "")
+REQUIRED_FIELDS = ("course", "dates", "first_name", "last_name", "id")
+
+
+@dataclass(slots=True)
+class CertificateRow:
+    """Только канонические поля строки, уже очищенные."""
+    first_name: str = ""
+    last_name: str = ""
+    course: str = ""
+    dates: str = ""
+    id: str = ""
+    city: str = ""
+    country: str = ""
+
+
+ROW_FIELDS = tuple(CertificateRow.__dataclass_fields__)
+
+
+def _canonical_for_header(header: str) -> Optional[str]:
+    """Канонское поле для заголовка колонки (целиком или по частям «Имя/Name»)."""
+    candidates = [_norm_key(header)] + [_norm_key(p) for p in header.split("/") if p.strip()]
+    for canonical, aliases in KEY_ALIASES.items():
+        if any(c in aliases for c in candidates):
+            return canonical
+    return None
+
+
+@dataclass
+class RowSchema:
+    """
+    Соответствие «колонка -> каноническое поле», вычисленное один раз на
+    загруженную таблицу. Из нескольких подходящих колонок берётся первая.
+    """
+    headers: List[str]
+    indices: Tuple[Optional[int], ...]
+    unknown: List[str] = field(default_factory=list)
+    ambiguous: Dict[str, List[str]] = field(default_factory=dict)
+
+    @classmethod
+    def from_headers(cls, headers: List[str]) -> "RowSchema":
+        found: Dict[str, List[int]] = {}
+        unknown: List[str] = []
+        for idx, h in enumerate(headers):
+            h = _clean_value(h)
+            canonical = _canonical_for_header(h) if h else None
+            if canonical:
+                found.setdefault(canonical, []).append(idx)
+            elif h:
+                unknown.append(h)
+        return cls(
+            headers=list(headers),
+            indices=tuple(found[f][0] if f in found else None for f in ROW_FIELDS),
+            unknown=unknown,
+            ambiguous={f: [headers[i] for i in idxs] for f, idxs in found.items() if len(idxs) > 1},
+        )
+
+    @property
+    def missing(self) -> List[str]:
+        return [f for f, idx in zip(ROW_FIELDS, self.indices) if idx is None and f in REQUIRED_FIELDS]
+
+    def warnings(self) -> List[str]:
+        out: List[str] = []
+        if self.unknown:
+            out.append("Неизвестные колонки: " + ", ".join(self.unknown))
+        for f, names in self.ambiguous.items():
+            out.append(f"Несколько колонок для поля {f}: {', '.join(names)} — используется «{names[0]}»")
+        return out
+
+    def extract(self, cells: List[str]) -> CertificateRow:
+        n = len(cells)
+        return CertificateRow(*(
+            _clean_value(cells[idx]) if idx is not None and idx < n else ""
+            for idx in self.indices
+        ))
+
 
 def detect_delimiter(text: str) -> str:
     sample = text[:4096]
@@ -404,74 +604,67 @@ def detect_delimiter(text: str) -> str:
     delim = max(counts, key=counts.get)
     return delim if counts[delim] > 0 else ','
 
-def normalize_csv_and_get_delimiter(text: str) -> Tuple[str, str]:
-    text = text.replace('\r\n', '\n').replace('\r', '\n')
-    delim = detect_delimiter(text)
-    reader = csv.reader(io.StringIO(text), delimiter=delim)
-    rows = [list(map(lambda s: (s or '').strip(), r)) for r in reader]
-    rows = [r for r in rows if any(cell != '' for cell in r)]
-    if not rows: return '', delim
-
-    def is_generic_header(cells: List[str]) -> bool:
-        return bool(cells) and all(cell.lower().startswith('column') or cell.lower().startswith('unnamed') for cell in cells)
-
-    start_idx = 1
-    header = rows[0]
-    if is_generic_header(header) and len(rows) >= 2:
-        start_idx = 2
-        header = rows[1]
-    if header:
-        header[0] = header[0].lstrip('\ufeff')
-    norm_rows = [header] + rows[start_idx:]
-    normalized_text = '\n'.join(delim.join(r) for r in norm_rows)
-    return normalized_text, delim
+def _is_generic_header(cells: List[str]) -> bool:
+    return bool(cells) and all(cell.lower().startswith('column') or cell.lower().startswith('unnamed') for cell in cells)
+
+
+_DATE_NUMERIC_RE = re.compile(r"\b(\d{1,2})\.(\d{1,2})\.(\d{2,4})\b")
+_YEAR_RE = re.compile(r"\b(20\d{2})\b")
+_DAY_RANGE_RE = re.compile(r"\b(\d{1,2})\s*[-–]\s*(\d{1,2})\b")
+_LIST_SEP_RE = re.compile(r"[,;]+")
+_SPACES_RE = re.compile(r"\s+")
+# «мар» раньше «ма»: марта/мая различаются третьей буквой
+_MONTH_PREFIXES = tuple((name.lower(), num) for num, name in MONTH_GEN.items()) + (
+    ("янв", 1), ("фев", 2), ("мар", 3), ("апр", 4), ("ма", 5), ("июн", 6),
+    ("июл", 7), ("авг", 8), ("сен", 9), ("окт", 10), ("ноя", 11), ("дек", 12),
+)
+
+
+class DateParseError(ValueError):
+    """Строка «Даты» не распознана — вместо молчаливого 1 января."""
+
+
+def _detect_month(token: str) -> Optional[int]:
+    """Месяц по названию (английскому или русскому); числа здесь не месяцы."""
+    for prefix, num in _MONTH_PREFIXES:
+        if token.startswith(prefix):
+            return num
+    return None
+
 
 def parse_dates(s: str) -> Dict[str, Optional[int]]:
+    """d1/m1/d2/m2/y из строки «Даты»; DateParseError, если день или месяц не найдены."""
     s = (s or "").strip()
-    date_pattern = r"\b(\d{1,2})\.(\d{1,2})\.(\d{2,4})\b"
-    dates = list(re.finditer(date_pattern, s))
-    if len(dates) >= 2:
-        d1, m1, y1 = int(dates[0].group(1)), int(dates[0].group(2)), int(dates[0].group(3))
-        d2, m2, y2 = int(dates[1].group(1)), int(dates[1].group(2)), int(dates[1].group(3))
-        if y1 < 100: y1 += 2000
-        if y2 < 100: y2 += 2000
-        return {"d1": d1, "m1": m1, "d2": d2, "m2": m2, "y": y1}
-    elif len(dates) == 1:
-        d1, m1, y1 = int(dates[0].group(1)), int(dates[0].group(2)), int(dates[0].group(3))
-        if y1 < 100: y1 += 2000
-        return {"d1": d1, "m1": m1, "d2": None, "m2": None, "y": y1}
-
-    s_lower = s.lower()
-    m_year = re.search(r"\b(20\d{2})\b", s)
-    y = int(m_year.group(1)) if m_year else __import__("datetime").datetime.now().year
-
-    months_tokens = [
-        ("January", 1), ("February", 2), ("March", 3), ("April", 4),
-        ("May", 5), ("June", 6), ("July", 7), ("August", 8),
-        ("September", 9), ("October", 10), ("November", 11), ("December", 12),
-    ]
-    def detect_month(token: str) -> Optional[int]:
-        if token.isdigit() and 1 <= int(token) <= 12: return int(token)
-        for pref, m in months_tokens:
-            if token.startswith(pref.lower()): return m
-        return None
+    dates = [tuple(map(int, d)) for d in _DATE_NUMERIC_RE.findall(s)]
+    result: Dict[str, Optional[int]]
+    if dates:
+        d1, m1, y1 = dates[0]
+        d2, m2 = dates[1][:2] if len(dates) >= 2 else (None, None)
+        result = {"d1": d1, "m1": m1, "d2": d2, "m2": m2, "y": y1 + 2000 if y1 < 100 else y1}
+    else:
+        s_lower = s.lower()
+        m_year = _YEAR_RE.search(s)
+        y = int(m_year.group(1)) if m_year else time.localtime().tm_year
+        tokens = _SPACES_RE.sub(" ", _LIST_SEP_RE.sub(" ", s_lower)).strip().split(" ")
+        days = [int(t) for t in tokens if t.isdigit() and 1 <= int(t) <= 31]
+        # числовой месяц — только если названия нет: в «5 March» пятёрка — день
+        months = ([m for m in map(_detect_month, tokens) if m]
+                  or [int(t) for t in tokens if t.isdigit() and 1 <= int(t) <= 12])
+
+        rng = _DAY_RANGE_RE.search(s_lower)
+        if rng and months:
+            result = {"d1": int(rng.group(1)), "m1": months[0], "d2": int(rng.group(2)), "m2": months[0], "y": y}
+        elif len(days) >= 2 and months:
+            result = {"d1": days[0], "m1": months[0], "d2": days[1], "m2": months[1 if len(months) >= 2 else 0], "y": y}
+        elif days and months:
+            result = {"d1": days[0], "m1": months[0], "d2": None, "m2": None, "y": y}
+        else:
+            raise DateParseError(f"Не удалось разобрать даты: {s!r}")
+    for d, m in ((result["d1"], result["m1"]), (result["d2"], result["m2"])):
+        if d is not None and not (1 <= d <= 31 and 1 <= m <= 12):
+            raise DateParseError(f"Некорректная дата в {s!r}")
+    return result
 
-    tokens = re.sub(r"[,;]+", " ", s_lower)
-    tokens = re.sub(r"\s+", " ", tokens).strip().split(" ")
-    days = [int(t) for t in tokens if t.isdigit() and 1 <= int(t) <= 31]
-    month_idx = [(i, detect_month(t)) for i, t in enumerate(tokens) if detect_month(t)]
-
-    rng = re.search(r"\b(\d{1,2})\s*[-–]\s*(\d{1,2})\b", s_lower)
-    if rng and month_idx:
-        return {"d1": int(rng.group(1)), "m1": month_idx[0][1],
-                "d2": int(rng.group(2)), "m2": month_idx[0][1], "y": y}
-    if len(days) >= 2 and len(month_idx) >= 2:
-        return {"d1": days[0], "m1": month_idx[0][1], "d2": days[1], "m2": month_idx[1][1], "y": y}
-    if len(days) >= 2 and len(month_idx) == 1:
-        return {"d1": days[0], "m1": month_idx[0][1], "d2": days[1], "m2": month_idx[0][1], "y": y}
-    if len(days) >= 1 and len(month_idx) >= 1:
-        return {"d1": days[0], "m1": month_idx[0][1], "d2": None, "m2": None, "y": y}
-    return {"d1": days[0] if days else 1, "m1": month_idx[0][1] if month_idx else 1, "d2": None, "m2": None, "y": y}
 
 def format_dates_for_jinja(p: Dict[str, Optional[int]]) -> Dict[str, str]:
     d1, m1, d2, m2, y = p["d1"], p["m1"], p["d2"], p["m2"], p["y"]
@@ -486,324 +679,2746 @@ def format_dates_for_jinja(p: Dict[str, Optional[int]]) -> Dict[str, str]:
         result.update({"Дата1": str(d1), "Месяц1": MONTH_GEN[m1]})
     return result
 
-def pick_kind(p: Dict[str, Optional[int]]) -> str:
-    d1, m1, d2, m2 = p["d1"], p["m1"], p["d2"], p["m2"]
-    if d1 and d2:
-        return "duration_day" if m1 == m2 else "2day_2month"
-    return "1day_1month"
+def pick_kind(p: Dict[str, Optional[int]]) -> str:
+    d1, m1, d2, m2 = p["d1"], p["m1"], p["d2"], p["m2"]
+    if d1 and d2:
+        return "duration_day" if m1 == m2 else "2day_2month"
+    return "1day_1month"
+
+
+@dataclass(frozen=True)
+class ParsedDates:
+    """Разобранная строка «Даты» вместе с производными: вид шаблона и поля Jinja."""
+    d1: int
+    m1: int
+    d2: Optional[int]
+    m2: Optional[int]
+    y: int
+    kind: str
+    fields: Tuple[Tuple[str, str], ...]
+
+    @classmethod
+    def parse(cls, value: str) -> "ParsedDates":
+        p = parse_dates(value)
+        return cls(kind=pick_kind(p), fields=tuple(format_dates_for_jinja(p).items()), **p)
+
+    def context(self) -> Dict[str, str]:
+        """Новый словарь полей Jinja — его можно дополнять полями строки."""
+        return dict(self.fields)
+
+
+class DateParser:
+    """
+    Разборы на время задачи: в когорте у «Даты» обычно одно-два значения на
+    тысячи строк, поэтому каждое уникальное значение разбирается один раз.
+    Нераспознанные значения считаются по строкам для отчёта.
+    """
+
+    def __init__(self):
+        self._memo: Dict[str, Union[ParsedDates, str]] = {}
+        self.unparseable: Dict[str, int] = {}
+
+    def parse(self, value: str) -> ParsedDates:
+        hit = self._memo.get(value)
+        if hit is None:
+            try:
+                hit = ParsedDates.parse(value)
+            except DateParseError as e:
+                hit = str(e)
+            self._memo[value] = hit
+        if isinstance(hit, str):
+            self.unparseable[value] = self.unparseable.get(value, 0) + 1
+            raise DateParseError(hit)
+        return hit
+
+    @property
+    def distinct(self) -> int:
+        return len(self._memo)
+
+    def warnings(self) -> List[str]:
+        return [f"Не распознаны даты «{value}» (строк: {count})" for value, count in self.unparseable.items()]
+
+
+def sanitize_filename(s: str) -> str:
+    return re.sub(r'[\\/:*?"<>|]+', "_", s).replace(" ", "_")[:100]
+
+
+# =============================================================================
+# Text fit: ширины глифов из hmtx/cmap шрифта, подбор кегля под блок шаблона
+# =============================================================================
+TEXT_FIT = os.getenv("TEXT_FIT", "0") == "1"  # 1 — кегль под длину текста вместо выбора normal/small
+TEXT_FIT_MIN_SCALE = float(os.getenv("TEXT_FIT_MIN_SCALE", "0.6"))  # не мельче доли исходного кегля
+TEXT_FIT_STEP = 0.5  # pt; w:sz задаётся в полупунктах
+
+FONT_FILES = {
+    "regular": ("EYINTERSTATE-REGULAR.OTF", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"),
+    "bold": ("EYINTERSTATE-BOLD.OTF", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    "light": ("EYINTERSTATE-LIGHT.OTF", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"),
+}
+# поле шаблона -> (плейсхолдеры, ключ контекста с кеглем в полупунктах, строк не больше)
+FIT_FIELDS = {
+    "name": (("Имя", "Фамилия"), "РазмерИмени", 1),
+    "course": (("Тренинг",), "РазмерТренинга", 2),
+}
+
+
+class GlyphMetrics:
+    """
+    Ширины глифов шрифта (sfnt: TrueType или OpenType/CFF — hmtx есть в обоих)
+    в долях кегля, без кернинга. Латиница и кириллица — в плотном массиве.
+    """
+
+    DENSE = 0x0500
+
+    def __init__(self, advances: Dict[int, float], default: float):
+        self.default = default
+        self.dense = array("d", (advances.get(c, default) for c in range(self.DENSE)))
+        self.sparse = {c: w for c, w in advances.items() if c >= self.DENSE}
+
+    @classmethod
+    def from_file(cls, path: str) -> "GlyphMetrics":
+        with open(path, "rb") as f:
+            data = f.read()
+        (num_tables,) = struct.unpack(">H", data[4:6])
+        tables = {}
+        for i in range(num_tables):
+            tag, _, offset, length = struct.unpack(">4sIII", data[12 + 16 * i:28 + 16 * i])
+            tables[tag] = data[offset:offset + length]
+        (units_per_em,) = struct.unpack(">H", tables[b"head"][18:20])
+        (num_metrics,) = struct.unpack(">H", tables[b"hhea"][34:36])
+        hmtx = tables[b"hmtx"]
+        widths = [struct.unpack(">H", hmtx[4 * i:4 * i + 2])[0] / units_per_em for i in range(num_metrics)]
+        advances = {c: widths[min(g, num_metrics - 1)] for c, g in _sfnt_cmap(tables[b"cmap"]).items()}
+        return cls(advances, default=advances.get(ord("n"), 0.5))
+
+    def em_width(self, text: str) -> float:
+        dense, n = self.dense, self.DENSE
+        return sum(dense[o] if o < n else self.sparse.get(o, self.default) for o in map(ord, text))
+
+
+def _sfnt_cmap(cmap: bytes) -> Dict[int, int]:
+    """Кодовая точка -> glyph id из юникодной подтаблицы cmap (формат 12 или 4)."""
+    (num,) = struct.unpack(">H", cmap[2:4])
+    subtables = {}
+    for i in range(num):
+        platform, encoding, offset = struct.unpack(">HHI", cmap[4 + 8 * i:12 + 8 * i])
+        subtables[(platform, encoding)] = offset
+    for key in ((3, 10), (0, 4), (3, 1), (0, 3), (0, 1)):
+        offset = subtables.get(key)
+        if offset is None:
+            continue
+        (fmt,) = struct.unpack(">H", cmap[offset:offset + 2])
+        result: Dict[int, int] = {}
+        if fmt == 12:
+            (groups,) = struct.unpack(">I", cmap[offset + 12:offset + 16])
+            for g in range(groups):
+                start, end, glyph = struct.unpack(">III", cmap[offset + 16 + 12 * g:offset + 28 + 12 * g])
+                for c in range(start, min(end, 0x2FFFF) + 1):
+                    result[c] = glyph + c - start
+            return result
+        if fmt == 4:
+            (seg_x2,) = struct.unpack(">H", cmap[offset + 6:offset + 8])
+            segs = seg_x2 // 2
+            ends = struct.unpack(f">{segs}H", cmap[offset + 14:offset + 14 + seg_x2])
+            base = offset + 16 + seg_x2
+            starts = struct.unpack(f">{segs}H", cmap[base:base + seg_x2])
+            deltas = struct.unpack(f">{segs}h", cmap[base + seg_x2:base + 2 * seg_x2])
+            ranges_at = base + 2 * seg_x2
+            ranges = struct.unpack(f">{segs}H", cmap[ranges_at:ranges_at + seg_x2])
+            for s in range(segs):
+                for c in range(starts[s], min(ends[s], 0xFFFE) + 1):
+                    if ranges[s] == 0:
+                        glyph = (c + deltas[s]) & 0xFFFF
+                    else:
+                        at = ranges_at + 2 * s + ranges[s] + 2 * (c - starts[s])
+                        (glyph,) = struct.unpack(">H", cmap[at:at + 2])
+                        glyph = (glyph + deltas[s]) & 0xFFFF if glyph else 0
+                    if glyph:
+                        result[c] = glyph
+            return result
+    raise ValueError("No unicode cmap subtable")
+
+
+_GLYPH_METRICS: Dict[str, GlyphMetrics] = {}
+_GLYPH_LOCK = Lock()
+
+
+def glyph_metrics(style: str) -> GlyphMetrics:
+    """Метрики начертания regular/bold/light: EY Interstate, иначе DejaVu, иначе усреднённые."""
+    metrics = _GLYPH_METRICS.get(style)
+    if metrics is not None:
+        return metrics
+    with _GLYPH_LOCK:
+        if style in _GLYPH_METRICS:
+            return _GLYPH_METRICS[style]
+        ey_name, fallback = FONT_FILES.get(style, FONT_FILES["regular"])
+        for path in (os.path.join(FONTS_DIR, ey_name), fallback):
+            if not os.path.exists(path):
+                continue
+            try:
+                metrics = GlyphMetrics.from_file(path)
+                break
+            except Exception as e:
+                logger.warning(f"Font metrics unavailable for {path}: {e}")
+        if metrics is None:
+            metrics = GlyphMetrics({}, default=0.55)
+        _GLYPH_METRICS[style] = metrics
+        return metrics
+
+
+@dataclass(frozen=True)
+class FitSlot:
+    """Блок шаблона под поле: полезная ширина и исходный кегль в pt, начертание."""
+    field: str
+    width: float
+    size: float
+    style: str
+
+    @property
+    def placeholders(self) -> Tuple[str, ...]:
+        return FIT_FIELDS[self.field][0]
+
+    @property
+    def context_key(self) -> str:
+        return FIT_FIELDS[self.field][1]
+
+    @property
+    def max_lines(self) -> int:
+        return FIT_FIELDS[self.field][2]
+
+    def text(self, context: Dict[str, str]) -> str:
+        return " ".join(context.get(p, "") for p in self.placeholders).strip()
+
+
+def _lines_needed(words: List[float], space: float, width_em: float) -> float:
+    """Жадный перенос по словам: сколько строк займёт текст; слово шире строки — inf."""
+    if any(w > width_em for w in words):
+        return float("inf")
+    lines, used = 1, 0.0
+    for w in words:
+        if used and used + space + w > width_em:
+            lines, used = lines + 1, w
+        else:
+            used += (space if used else 0.0) + w
+    return lines
+
+
+@lru_cache(maxsize=65536)
+def fit_size(text: str, slot: FitSlot) -> float:
+    """Наибольший кегль (шаг 0.5 pt, не больше исходного), при котором текст влезает в блок."""
+    metrics = glyph_metrics(slot.style)
+    words = [metrics.em_width(w) for w in text.split()]
+    space = metrics.em_width(" ")
+    size, floor = slot.size, max(TEXT_FIT_STEP, slot.size * TEXT_FIT_MIN_SCALE)
+    while size - TEXT_FIT_STEP >= floor and _lines_needed(words, space, slot.width / size) > slot.max_lines:
+        size -= TEXT_FIT_STEP
+    return size
+
+
+def fit_column(texts: List[str], slot: FitSlot) -> List[float]:
+    """Кегли для целой колонки: каждое уникальное значение меряется один раз."""
+    sizes = {t: fit_size(t, slot) for t in dict.fromkeys(texts)}
+    return [sizes[t] for t in texts]
+
+
+def fit_context(docx_path: str, context: Dict[str, str]) -> Dict[str, str]:
+    """Ключи кегля (полупункты) для полей шаблона, подобранные под длину текста строки."""
+    return {slot.context_key: str(int(round(fit_size(slot.text(context), slot) * 2)))
+            for slot in TEMPLATE_REGISTRY.get(docx_path).fit_slots}
+
+
+def need_small_variant(docx_path: str, context: Dict[str, str]) -> bool:
+    """Прежний режим (TEXT_FIT=0): шаблон small, если имя не влезает исходным кеглем."""
+    return any(fit_size(slot.text(context), slot) < slot.size
+               for slot in TEMPLATE_REGISTRY.get(docx_path).fit_slots if slot.field == "name")
+
+
+_TXBX_RE = re.compile(r"<w:txbxContent>.*?</w:txbxContent>", re.DOTALL)
+_PARA_RE = re.compile(r"<w:p[ >].*?</w:p>", re.DOTALL)
+_SZ_RE = re.compile(r'(<w:sz(?:Cs)? w:val=")(\d+)(")')
+_EXT_RE = re.compile(r'<a:ext cx="(\d+)"')
+_BODYPR_RE = re.compile(r"<wps:bodyPr\b[^>]*>")
+EMU_PER_PT = 12700
+
+
+_ROOT_NS_RE = re.compile(r"<w:(?:document|body)\b([^>]*)>")
+
+
+def _fit_style(para_xml: str, marker: "re.Pattern[str]", styles: "DocxStyles", ns_attrs: str) -> str:
+    """
+    Начертание прогона с плейсхолдером так, как его видит Word: w:b с w:val,
+    стиль прогона и цепочка стиля абзаца (DocxStyles). ns_attrs — объявления
+    пространств имён корня документа, без них фрагмент абзаца не разобрать.
+    """
+    from lxml import etree
+
+    p = etree.fromstring(f"<w:body{ns_attrs}>{para_xml}</w:body>")[0]
+    w = "{%s}" % DOCX_NS["w"]
+    run = next((r for r in p.iter(w + "r")
+                if marker.search("".join(t.text or "" for t in r.iter(w + "t")))), None)
+    props = styles.run_props(p, run)
+    if props["bold"]:
+        return "bold"  # полужирный Light LibreOffice синтезирует — берём шире, с запасом
+    return "light" if "light" in props["font"].lower() else "regular"
+
+
+def apply_fit_slots(xml: str, styles: Optional["DocxStyles"] = None) -> Tuple[str, List[FitSlot]]:
+    """
+    Кегль абзацев с именем и названием курса становится переменной Jinja
+    (по умолчанию — исходный). Ширина блока берётся из текстбокса DrawingML
+    за вычетом внутренних полей; VML-копия (mc:Fallback) правится так же.
+    Начертание — по стилям документа (styles из word/styles.xml и темы).
+    """
+    styles = styles or DocxStyles()
+    root = _ROOT_NS_RE.search(xml)
+    ns_attrs = root.group(1) if root else ' xmlns:w="%s"' % DOCX_NS["w"]
+    slots: Dict[str, FitSlot] = {}
+    out: List[str] = []
+    pos = 0
+    for box in _TXBX_RE.finditer(xml):
+        content = box.group(0)
+        for field_name, (placeholders, key, _) in FIT_FIELDS.items():
+            marker = re.compile(r"\{\{\s*%s\s*\}\}" % placeholders[0])
+            if not marker.search(content):
+                continue
+            para = next((p for p in _PARA_RE.findall(content) if marker.search(p)), None)
+            if para is None:
+                continue
+            # исходный кегль — из свойств того run, где стоит плейсхолдер
+            at = marker.search(para).start()
+            run = para[max(para.rfind("<w:r>", 0, at), para.rfind("<w:r ", 0, at)):at]
+            sizes = _SZ_RE.findall(run)
+            if not sizes:
+                continue
+            base = int(sizes[0][1])
+            if field_name not in slots:
+                ext = _EXT_RE.findall(xml, 0, box.start())
+                body_pr = _BODYPR_RE.search(xml, box.end())
+                if ext:
+                    attrs = dict(re.findall(r'(\w+)="(\d+)"', body_pr.group(0))) if body_pr else {}
+                    inner = int(ext[-1]) - int(attrs.get("lIns", 91440)) - int(attrs.get("rIns", 91440))
+                    slots[field_name] = FitSlot(field_name, inner / EMU_PER_PT, base / 2,
+                                                _fit_style(para, marker, styles, ns_attrs))
+            fitted = _SZ_RE.sub(lambda m: f"{m.group(1)}{{{{ {key}|default({m.group(2)}) }}}}{m.group(3)}", para)
+            content = content.replace(para, fitted)
+        out.append(xml[pos:box.start()])
+        out.append(content)
+        pos = box.end()
+    out.append(xml[pos:])
+    return "".join(out), list(slots.values())
+
+
+# =============================================================================
+# Layout transforms: правки отступов применяются к шаблону один раз при загрузке
+# =============================================================================
+ONLINE_LAYOUT_ADJUST = os.getenv("ONLINE_LAYOUT_ADJUST", "0") == "1"  # ОТКЛЮЧЕНО: координаты заданы в шаблоне
+
+
+@dataclass(frozen=True)
+class IndentTransform:
+    """
+    w:ind абзацев шаблона, где есть все плейсхолдеры хотя бы одной группы match:
+    атрибуты set (twips) выставляются, drop — удаляются. scope: textbox —
+    абзацы текстбоксов (DrawingML и VML), body — остальные, включая таблицы.
+    """
+    name: str
+    match: Tuple[Tuple[str, ...], ...]
+    scope: str
+    set: Tuple[Tuple[str, int], ...]
+    drop: Tuple[str, ...] = ()
+
+    def matches(self, para_xml: str) -> bool:
+        return any(all(_placeholder_re(p).search(para_xml) for p in group) for group in self.match)
+
+
+# 1 pt = 20 twips; значения прежней построчной правки online-сертификатов
+LAYOUT_TRANSFORMS: Dict[str, Tuple[IndentTransform, ...]] = {
+    "online": (
+        IndentTransform("course", (("Тренинг",),), "body", (("left", 18 * 20), ("firstLine", 0)), ("hanging",)),
+        IndentTransform("course_textbox", (("Тренинг",),), "textbox", (("left", 0), ("hanging", 0)), ("firstLine",)),
+        IndentTransform("date_textbox", (("Месяц1", "Год"), ("Город",)), "textbox",
+                        (("left", 0), ("firstLine", 0)), ("hanging",)),
+    ),
+}
+
+_LEAF_PARA_RE = re.compile(r"<w:p[ >](?:(?!<w:p[ >]).)*?</w:p>", re.DOTALL)
+_PPR_RE = re.compile(r"<w:pPr>(.*?)</w:pPr>", re.DOTALL)
+_IND_RE = re.compile(r"<w:ind\b[^>]*/>")
+_ATTR_RE = re.compile(r'(w:\w+)="([^"]*)"')
+
+
+@lru_cache(maxsize=None)
+def _placeholder_re(name: str) -> "re.Pattern[str]":
+    return re.compile(r"\{\{\s*%s\s*(?:\||\}\})" % re.escape(name))
+
+
+def template_transforms(docx_path: str) -> Tuple[IndentTransform, ...]:
+    if not ONLINE_LAYOUT_ADJUST:
+        return ()
+    return LAYOUT_TRANSFORMS.get(TEMPLATE_GROUPS.get(os.path.basename(docx_path), ""), ())
+
+
+def _apply_indent(para: str, transform: IndentTransform) -> str:
+    attrs: Dict[str, str] = {}
+    ppr = _PPR_RE.search(para)
+    ind = _IND_RE.search(ppr.group(1)) if ppr else None
+    if ind:
+        attrs = dict(_ATTR_RE.findall(ind.group(0)))
+    for name in transform.drop:
+        attrs.pop(f"w:{name}", None)
+    for name, twips in transform.set:
+        attrs[f"w:{name}"] = str(twips)
+    new_ind = "<w:ind " + " ".join(f'{k}="{v}"' for k, v in attrs.items()) + "/>"
+    if ppr is None:
+        open_end = para.index(">") + 1
+        return para[:open_end] + f"<w:pPr>{new_ind}</w:pPr>" + para[open_end:]
+    inner = ppr.group(1)
+    if ind:
+        inner = inner[:ind.start()] + new_ind + inner[ind.end():]
+    else:
+        # w:ind в w:pPr идёт перед w:jc и w:rPr
+        at = min([i for i in (inner.find("<w:jc"), inner.find("<w:rPr")) if i >= 0] or [len(inner)])
+        inner = inner[:at] + new_ind + inner[at:]
+    return para[:ppr.start(1)] + inner + para[ppr.end(1):]
+
+
+def apply_layout_transforms(xml: str, transforms: Tuple[IndentTransform, ...]) -> str:
+    """Один проход по абзацам XML шаблона (до компиляции Jinja); строки рендерятся уже из результата."""
+    if not transforms:
+        return xml
+    boxes = [(m.start(), m.end()) for m in _TXBX_RE.finditer(xml)]
+    out: List[str] = []
+    pos = 0
+    for m in _LEAF_PARA_RE.finditer(xml):
+        scope = "textbox" if any(a <= m.start() < b for a, b in boxes) else "body"
+        para = original = m.group(0)
+        for transform in transforms:
+            if transform.scope == scope and transform.matches(para):
+                para = _apply_indent(para, transform)
+        if para is not original:
+            out.append(xml[pos:m.start()])
+            out.append(para)
+            pos = m.end()
+    out.append(xml[pos:])
+    return "".join(out)
+
+
+# =============================================================================
+# Workspace: файлы для LibreOffice — в каталоге задачи на tmpfs, не дольше строки
+# =============================================================================
+def _default_workspace_root() -> str:
+    shm = "/dev/shm"
+    base = shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, "certgen_work")
+
+
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR") or _default_workspace_root()
+
+
+class Workspace:
+    """
+    Каталог задачи. DOCX и PDF живут в памяти; на диск попадают только на время
+    конвертации: row() удаляет свой подкаталог на выходе, close() — весь каталог.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def row(self) -> Iterator[str]:
+        path = tempfile.mkdtemp(prefix="row_", dir=self.path)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def close(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def sweep_pid_dirs(root: str) -> int:
+    """Удаляет подкаталоги root/<pid> процессов, которых уже нет."""
+    removed = 0
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return 0
+    for name in names:
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            os.kill(int(name), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except OSError:
+            continue  # процесс есть, но чужой
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        removed += 1
+    return removed
+
+
+class WorkspaceManager:
+    """
+    Каталоги задач в root/<pid>: у каждого процесса (uvicorn --workers N) свой
+    подкаталог, а подкаталоги завершившихся процессов удаляет sweep().
+    Разовые конвертации (прогрев, фон overlay) идут через shared().
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._active: Dict[str, Workspace] = {}
+        self._shared: Optional[Workspace] = None
+        self._lock = Lock()
+        self.jobs = 0
+
+    @property
+    def base(self) -> str:
+        return os.path.join(self.root, str(os.getpid()))
+
+    def shared(self) -> Workspace:
+        if self._shared is None:
+            with self._lock:
+                if self._shared is None:
+                    self._shared = Workspace(os.path.join(self.base, "shared"))
+        return self._shared
+
+    @contextmanager
+    def job(self, key: str) -> Iterator[Workspace]:
+        ws = Workspace(os.path.join(self.base, "job_" + sanitize_filename(key)))
+        with self._lock:
+            self._active[ws.path] = ws
+            self.jobs += 1
+        try:
+            yield ws
+        finally:
+            with self._lock:
+                self._active.pop(ws.path, None)
+            ws.close()
+
+    def sweep(self) -> int:
+        """Удаляет каталоги процессов, которых уже нет (падение, рестарт контейнера)."""
+        return sweep_pid_dirs(self.root)
+
+    def close(self) -> None:
+        with self._lock:
+            for ws in list(self._active.values()):
+                ws.close()
+            self._active.clear()
+            self._shared = None
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def stats(self) -> Dict[str, object]:
+        used = 0
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    used += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+        try:
+            usage = shutil.disk_usage(self.root if os.path.isdir(self.root) else os.path.dirname(self.root))
+            total, free = usage.total, usage.free
+        except OSError:
+            total = free = 0
+        return {
+            "dir": self.root,
+            "active_jobs": len(self._active),
+            "jobs": self.jobs,
+            "bytes": used,
+            "disk_total": total,
+            "disk_free": free,
+        }
+
+
+WORKSPACES = WorkspaceManager(WORKSPACE_DIR)
+
+
+def _sweep_workspaces():
+    removed = WORKSPACES.sweep()
+    if removed:
+        logger.info(f"Removed {removed} stale workspace(s) from {WORKSPACE_DIR}")
+
+
+# =============================================================================
+# DOCX -> PDF (LibreOffice) — пул тёплых конвертеров
+# =============================================================================
+LIBREOFFICE_PATHS = [
+    "soffice",
+    "libreoffice",
+    r"C:\Program Files\LibreOffice\program\soffice.exe",
+    r"C:\Program Files (x86)\LibreOffice\program\soffice.exe",
+    r"C:\LibreOffice\program\soffice.exe",
+]
+_SOFFICE_BIN: Optional[str] = None
+
+
+def find_soffice() -> str:
+    """Находит бинарник LibreOffice один раз на процесс."""
+    global _SOFFICE_BIN
+    if _SOFFICE_BIN:
+        return _SOFFICE_BIN
+    for path in LIBREOFFICE_PATHS:
+        found = shutil.which(path) if not os.path.isabs(path) else (path if os.path.exists(path) else None)
+        if found:
+            _SOFFICE_BIN = found
+            return found
+    raise RuntimeError("LibreOffice not found. Install it or add to PATH.")
+
+
+def _free_port() -> int:
+    """Свободный порт от ОС: у каждого воркера uvicorn свои сокеты soffice."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _file_url(path: str) -> str:
+    return "file:///" + os.path.abspath(path).replace("\\", "/").lstrip("/")
+
+
+class LibreOfficeTimeout(RuntimeError):
+    """Конвертация не уложилась в LO_CONVERT_TIMEOUT; инстанс убит."""
+
+
+def _kill_tree(proc: subprocess.Popen) -> None:
+    """soffice — обёртка над soffice.bin: на POSIX убиваем всю сессию процесса."""
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+class LibreOfficeInstance:
+    """
+    Один слот пула: собственный профиль LibreOffice, подготовленный заранее.
+    С python3-uno держит запущенный soffice и конвертирует через UNO-сокет,
+    без него — запускает `--convert-to`, но уже с тёплым профилем. Профиль
+    (LO_PROFILES_DIR/<pid>/slotN) и порт у каждого процесса свои: воркеры
+    uvicorn не делят и не перезапускают чужие soffice.
+    """
+
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.port = 0  # выбирается при каждом старте
+        self.profile_dir = os.path.join(LO_PROFILES_DIR, str(os.getpid()), f"slot{slot}")
+        self.proc: Optional[subprocess.Popen] = None
+        self.desktop = None
+        self.started = False
+        self.conversions = 0
+        self.restarts = 0
+        self.failures = 0      # подряд неудачных конвертаций (liveness без UNO)
+        self.timeouts = 0
+        self._expired = False
+
+    @property
+    def profile_url(self) -> str:
+        return _file_url(self.profile_dir)
+
+    def _base_cmd(self) -> List[str]:
+        return [
+            find_soffice(), "--headless", "--invisible", "--nologo", "--norestore",
+            "--nolockcheck", "--nodefault", f"-env:UserInstallation={self.profile_url}",
+        ]
+
+    def _run(self, args: List[str]) -> Tuple[bytes, bytes]:
+        """Одноразовый soffice с тёплым профилем; по таймауту убивается вместе с дочерними."""
+        proc = subprocess.Popen(self._base_cmd() + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=True)
+        try:
+            return proc.communicate(timeout=LO_CONVERT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            _kill_tree(proc)
+            proc.communicate()
+            self.timeouts += 1
+            raise LibreOfficeTimeout(f"LibreOffice slot {self.slot}: no result in {LO_CONVERT_TIMEOUT}s")
+
+    def seed_profile(self) -> None:
+        """
+        Создаёт профиль: первый запуск soffice самый дорогой, поэтому готовый
+        профиль публикуется в LO_PROFILES_DIR/template и дальше копируется.
+        """
+        if os.path.isdir(os.path.join(self.profile_dir, "user")):
+            return
+        template = os.path.join(LO_PROFILES_DIR, "template")
+        if os.path.isdir(os.path.join(template, "user")):
+            try:
+                shutil.copytree(template, self.profile_dir, dirs_exist_ok=True)
+                return
+            except (OSError, shutil.Error) as e:
+                logger.warning(f"LibreOffice profile template copy failed: {e}")
+                shutil.rmtree(self.profile_dir, ignore_errors=True)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self._run(["--terminate_after_init"])
+        if os.path.isdir(os.path.join(self.profile_dir, "user")) and not os.path.exists(template):
+            staging = f"{template}.{os.getpid()}.{self.slot}"
+            try:
+                shutil.copytree(self.profile_dir, staging)
+                os.rename(staging, template)  # атомарно; кто не успел — просто удаляет свою копию
+            except OSError:
+                shutil.rmtree(staging, ignore_errors=True)
+
+    def start(self) -> None:
+        self.seed_profile()
+        self.conversions = 0
+        self.failures = 0
+        self.started = True
+        if not HAS_UNO:
+            return
+        self.port = _free_port()
+        accept = f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        self.proc = subprocess.Popen(self._base_cmd() + [accept], start_new_session=True,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        import uno  # type: ignore
+
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_ctx)
+        url = f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        deadline = time.time() + 60
+        while True:
+            try:
+                ctx = resolver.resolve(url)
+                self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+                break
+            except Exception:
+                if self.proc.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    self.started = False
+                    raise RuntimeError(f"LibreOffice slot {self.slot} failed to start")
+                time.sleep(0.3)
+        logger.info(f"LibreOffice slot {self.slot} listening on port {self.port}")
+
+    def stop(self) -> None:
+        if self.desktop is not None:
+            try: self.desktop.terminate()
+            except Exception: pass
+        self.desktop = None
+        if self.proc is not None:
+            try:
+                self.proc.terminate()
+                self.proc.wait(timeout=10)
+            except Exception:
+                _kill_tree(self.proc)
+        self.proc = None
+
+    def restart(self) -> None:
+        logger.warning(f"Restarting LibreOffice slot {self.slot}")
+        self.stop()
+        if not HAS_UNO:
+            # без UNO всё состояние слота — профиль: пересоздаём его с нуля
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+        self.restarts += 1
+        self.start()
+
+    def is_alive(self) -> bool:
+        if not HAS_UNO:
+            # одна неудача — скорее плохой документ; две подряд — сломанный профиль
+            return self.failures < 2 and os.path.isdir(self.profile_dir)
+        if self.proc is None or self.proc.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def convert(self, docx_path: str, out_dir: str) -> str:
+        pdf_path = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+        if HAS_UNO:
+            from com.sun.star.beans import PropertyValue  # type: ignore
+
+            def prop(name, value):
+                p = PropertyValue()
+                p.Name, p.Value = name, value
+                return p
+            # UNO-вызовы блокируют без таймаута: по истечении срока soffice убивается, вызов падает
+            self._expired = False
+            watchdog = Timer(LO_CONVERT_TIMEOUT, self._expire)
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                doc = self.desktop.loadComponentFromURL(_file_url(docx_path), "_blank", 0, (prop("Hidden", True),))
+                try:
+                    doc.storeToURL(_file_url(pdf_path), (prop("FilterName", "writer_pdf_Export"),))
+                finally:
+                    doc.close(True)
+            except Exception:
+                if self._expired:
+                    raise LibreOfficeTimeout(f"LibreOffice slot {self.slot}: no result in {LO_CONVERT_TIMEOUT}s")
+                raise
+            finally:
+                watchdog.cancel()
+        else:
+            last_stdout = last_stderr = b""
+            for attempt in range(2):
+                try:
+                    last_stdout, last_stderr = self._run(["--convert-to", "pdf", "--outdir", out_dir, docx_path])
+                except LibreOfficeTimeout:
+                    self.failures += 1
+                    raise
+                if os.path.exists(pdf_path):
+                    break
+                time.sleep(0.5)
+            if not os.path.exists(pdf_path):
+                self.failures += 1
+                stderr_txt = (last_stderr or b"").decode(errors='ignore')
+                stdout_txt = (last_stdout or b"").decode(errors='ignore')
+                raise RuntimeError(f"LibreOffice convert failed: {stderr_txt or stdout_txt or 'unknown error'}")
+        if not os.path.exists(pdf_path):
+            raise RuntimeError("LibreOffice convert failed: no PDF produced")
+        self.conversions += 1
+        self.failures = 0
+        return pdf_path
+
+    def _expire(self) -> None:
+        self._expired = True
+        self.timeouts += 1
+        logger.error(f"LibreOffice slot {self.slot} exceeded {LO_CONVERT_TIMEOUT}s, killing")
+        if self.proc is not None:
+            _kill_tree(self.proc)
+
+
+class LibreOfficePool:
+    """Пул из N инстансов LibreOffice: ленивый старт, health-check и рестарт при падении."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._instances: List[LibreOfficeInstance] = []
+        self._idle: "queue.Queue[LibreOfficeInstance]" = queue.Queue()
+        self._start_lock = Lock()
+        self._started = False
+
+    def _ensure_started(self) -> None:
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            find_soffice()
+            removed = sweep_pid_dirs(LO_PROFILES_DIR)
+            if removed:
+                logger.info(f"Removed {removed} stale LibreOffice profile set(s)")
+            for slot in range(self.size):
+                inst = LibreOfficeInstance(slot)
+                self._instances.append(inst)
+                self._idle.put(inst)
+            self._started = True
+            logger.info(f"LibreOffice pool ready: {self.size} slot(s), uno={HAS_UNO}")
+
+    @contextmanager
+    def acquire(self) -> Iterator[LibreOfficeInstance]:
+        self._ensure_started()
+        with STAGE_SECONDS.time(stage="lock_wait"):
+            try:
+                inst = self._idle.get(timeout=LO_ACQUIRE_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError(f"No free LibreOffice slot within {LO_ACQUIRE_TIMEOUT}s")
+        try:
+            if not inst.started:
+                inst.start()
+            elif not inst.is_alive() or (LO_RECYCLE_AFTER and inst.conversions >= LO_RECYCLE_AFTER):
+                inst.restart()
+            yield inst
+        finally:
+            self._idle.put(inst)
+
+    def convert(self, docx_path: str, out_dir: str) -> str:
+        with self.acquire() as inst, STAGE_SECONDS.time(stage="convert"):
+            try:
+                return inst.convert(docx_path, out_dir)
+            except LibreOfficeTimeout:
+                # зависший документ зависнет и на повторе: только поднимаем слот заново
+                inst.restart()
+                raise
+            except Exception as e:
+                if inst.is_alive():
+                    raise
+                logger.warning(f"LibreOffice slot {inst.slot} crashed ({e}), retrying")
+                inst.restart()
+                return inst.convert(docx_path, out_dir)
+
+    def shutdown(self) -> None:
+        for inst in self._instances:
+            inst.stop()
+        if self._started:
+            shutil.rmtree(os.path.join(LO_PROFILES_DIR, str(os.getpid())), ignore_errors=True)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "size": self.size,
+            "started": self._started,
+            "idle": self._idle.qsize(),
+            "uno": HAS_UNO,
+            "conversions": sum(i.conversions for i in self._instances),
+            "restarts": sum(i.restarts for i in self._instances),
+            "timeouts": sum(i.timeouts for i in self._instances),
+        }
+
+
+LO_POOL = LibreOfficePool(LO_POOL_SIZE)
+
+
+def convert_docx_bytes(docx_bytes: bytes, workspace: Optional[Workspace] = None) -> bytes:
+    """
+    DOCX из памяти -> PDF через пул. Файлы для LibreOffice — в каталоге строки
+    workspace (по умолчанию общий) и удаляются сразу после чтения PDF.
+    Кэширование — на уровне строк, см. RENDER_CACHE.
+    """
+    with (workspace or WORKSPACES.shared()).row() as row_dir:
+        docx_path = os.path.join(row_dir, "cert.docx")
+        with open(docx_path, "wb") as f:
+            f.write(docx_bytes)
+        logger.info(f"Converting DOCX to PDF: {docx_path}")
+        with open(LO_POOL.convert(docx_path, row_dir), "rb") as f:
+            return f.read()
+
+
+# =============================================================================
+# Реестр шаблонов: DOCX разбирается и компилируется один раз
+# =============================================================================
+_DOCX_BODY_RE = re.compile(r"<w:body\b[^>]*>.*</w:body>", re.DOTALL)
+_DOCPR_ID_RE = re.compile(r'(<wp:docPr\b[^>]*?\bid=")\d+(")')
+_P_OPEN_RE = re.compile(r"<w:p([ >])")
+_P_OPEN_NL_RE = re.compile(r"\n<w:p([ >])")
+
+
+@dataclass
+class CompiledTemplate:
+    """Распакованные части DOCX и скомпилированный Jinja для частей с плейсхолдерами."""
+    path: str
+    mtime: float
+    entries: List[zipfile.ZipInfo]
+    parts: Dict[str, bytes]
+    doc_prefix: str = ""
+    doc_suffix: str = ""
+    body: object = None                                          # jinja2.Template тела документа
+    extra: Dict[str, object] = field(default_factory=dict)       # колонтитулы/свойства
+    fit_slots: List[FitSlot] = field(default_factory=list)       # поля с подбором кегля
+    transforms: Tuple[IndentTransform, ...] = ()                  # применённые при загрузке
+    tpl: Optional["DocxTemplate"] = None                           # для patch_xml/resolve_listing
+
+
+class TemplateRegistry:
+    """
+    Кэш шаблонов по (путь, mtime): архив распаковывается, XML проходит
+    patch_xml docxtpl и компилируется Jinja один раз. Строка рендерится
+    только подстановкой в готовый Jinja и упаковкой частей обратно.
+    """
+
+    def __init__(self):
+        self._items: Dict[str, CompiledTemplate] = {}
+        self._lock = Lock()
+
+    def get(self, docx_path: str) -> CompiledTemplate:
+        path = os.path.abspath(docx_path)
+        mtime = os.path.getmtime(path)
+        item = self._items.get(path)
+        if item is not None and item.mtime == mtime:
+            return item
+        with self._lock:
+            item = self._items.get(path)
+            if item is None or item.mtime != mtime:
+                item = self._items[path] = self._compile(path, mtime)
+                logger.info(f"Template compiled: {os.path.basename(path)}")
+            return item
+
+    @staticmethod
+    def _jinja(src_xml: str):
+        from jinja2 import Template
+        return Template(_P_OPEN_RE.sub(r"\n<w:p\1", src_xml))
+
+    def _compile(self, path: str, mtime: float) -> CompiledTemplate:
+        with zipfile.ZipFile(path) as z:
+            entries = z.infolist()
+            parts = {e.filename: z.read(e.filename) for e in entries}
+        from docxtpl import DocxTemplate
+
+        tpl = DocxTemplate(path)
+        tpl.init_docx()
+        item = CompiledTemplate(path=path, mtime=mtime, entries=entries, parts=parts, tpl=tpl)
+
+        doc_xml = parts["word/document.xml"].decode("utf-8")
+        m = _DOCX_BODY_RE.search(doc_xml)
+        if m is None:
+            raise ValueError(f"No <w:body> in {path}")
+        item.doc_prefix, item.doc_suffix = doc_xml[:m.start()], doc_xml[m.end():]
+        item.transforms = template_transforms(path)
+        styles = DocxStyles(parts.get("word/styles.xml"), parts.get("word/theme/theme1.xml"))
+        body_xml, item.fit_slots = apply_fit_slots(tpl.patch_xml(tpl.get_xml()), styles)
+        item.body = self._jinja(apply_layout_transforms(body_xml, item.transforms))
+
+        for name, data in parts.items():
+            is_hf = name.startswith(("word/header", "word/footer")) and name.endswith(".xml")
+            if (is_hf or name == "docProps/core.xml") and b"{" in data:
+                src = data.decode("utf-8")
+                item.extra[name] = self._jinja(apply_layout_transforms(tpl.patch_xml(src), item.transforms) if is_hf else src)
+        return item
+
+    @staticmethod
+    def _finish(item: CompiledTemplate, dst_xml: str) -> str:
+        dst_xml = _P_OPEN_NL_RE.sub(r"<w:p\1", dst_xml)
+        dst_xml = (dst_xml
+                   .replace('{_{', '{{')
+                   .replace('}_}', '}}')
+                   .replace('{_%', '{%')
+                   .replace('%_}', '%}'))
+        return item.tpl.resolve_listing(dst_xml)
+
+    def render_body(self, docx_path: str, context: Dict[str, str]) -> str:
+        """Отрендеренный <w:body> шаблона."""
+        item = self.get(docx_path)
+        counter = iter(range(1001, 1 << 30))
+        body = self._finish(item, item.body.render(context))
+        # как docxtpl.fix_docpr_ids: id фигур уникальны
+        return _DOCPR_ID_RE.sub(lambda m: f"{m.group(1)}{next(counter)}{m.group(2)}", body)
+
+    def build_docx(self, docx_path: str, body_xml: str, context: Dict[str, str]) -> bytes:
+        """Собирает DOCX из готового тела и остальных частей шаблона."""
+        item = self.get(docx_path)
+        replaced = {"word/document.xml": (item.doc_prefix + body_xml + item.doc_suffix).encode("utf-8")}
+        for name, compiled in item.extra.items():
+            replaced[name] = self._finish(item, compiled.render(context)).encode("utf-8")
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+            for info in item.entries:
+                # картинки уже сжаты — повторный deflate только тратит CPU
+                compress = zipfile.ZIP_DEFLATED if info.filename.endswith((".xml", ".rels")) else zipfile.ZIP_STORED
+                zout.writestr(info.filename, replaced.get(info.filename, item.parts[info.filename]),
+                              compress_type=compress)
+        return buf.getvalue()
+
+    def render(self, docx_path: str, context: Dict[str, str]) -> bytes:
+        """DOCX-байты для одной строки; при сбое компиляции — обычный путь docxtpl."""
+        try:
+            return self.build_docx(docx_path, self.render_body(docx_path, context), context)
+        except Exception as e:
+            logger.warning(f"Template registry render failed for {os.path.basename(docx_path)} ({e}), using docxtpl")
+            from docxtpl import DocxTemplate
+
+            doc = DocxTemplate(docx_path)
+            doc.render(context)
+            buf = io.BytesIO()
+            doc.save(buf)
+            return buf.getvalue()
+
+    def stats(self) -> Dict[str, object]:
+        return {"templates": len(self._items)}
+
+
+TEMPLATE_REGISTRY = TemplateRegistry()
+
+
+# =============================================================================
+# Render DOCX: реестр шаблонов -> PDF
+# =============================================================================
+def render_docx_template(
+    docx_path: str,
+    context: Dict[str, str],
+    workspace: Optional[Workspace] = None,
+) -> bytes:
+    """
+    DOCX одной строки из реестра шаблонов -> PDF. Отступы online-шаблонов уже
+    выставлены при загрузке (см. LAYOUT_TRANSFORMS) — по строке XML не трогается.
+    DOCX собирается в памяти; на диск — только на время конвертации (см. Workspace).
+    """
+    with STAGE_SECONDS.time(stage="render"):
+        docx_bytes = TEMPLATE_REGISTRY.render(docx_path, context)
+    return convert_docx_bytes(docx_bytes, workspace)
+
+
+def _add_section_break(body, sect_pr) -> None:
+    """Ставит разрыв раздела (новая страница) после последнего абзаца перед итоговым sectPr."""
+    from copy import deepcopy
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    idx = body.index(sect_pr)
+    last = body[idx - 1] if idx > 0 else None
+    if last is None or last.tag != qn("w:p"):
+        last = OxmlElement("w:p")
+        body.insert(idx, last)
+    last.get_or_add_pPr().append(deepcopy(sect_pr))
+
+
+def render_docx_batch(
+    docx_path: str,
+    contexts: List[Dict[str, str]],
+    workspace: Optional[Workspace] = None,
+) -> List[bytes]:
+    """
+    Пакетный режим: строки одного шаблона склеиваются в один DOCX (раздел на
+    сертификат), конвертируются одним вызовом LibreOffice, а PDF режется по
+    страницам. Если число страниц не совпало с числом строк — исключение.
+    """
+    with STAGE_SECONDS.time(stage="render"):
+        docx_bytes = build_docx_batch(docx_path, contexts)
+    return convert_docx_batch(docx_bytes, len(contexts), workspace)
+
+
+def build_docx_batch(docx_path: str, contexts: List[Dict[str, str]]) -> bytes:
+    """Один DOCX на пакет строк: раздел (страница) на сертификат."""
+    from lxml import etree
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import qn
+
+    body = parse_xml(TEMPLATE_REGISTRY.render_body(docx_path, contexts[0]))
+    sect_pr = body.find(qn("w:sectPr"))
+    if sect_pr is None:
+        raise RuntimeError("Template has no section properties")
+    for context in contexts[1:]:
+        part = parse_xml(TEMPLATE_REGISTRY.render_body(docx_path, context))
+        _add_section_break(body, sect_pr)
+        for el in list(part):
+            if el.tag != qn("w:sectPr"):
+                sect_pr.addprevious(el)
+    # id фигур должны быть уникальны в пределах документа
+    for i, el in enumerate(body.iter(qn("wp:docPr")), 1):
+        el.set("id", str(i))
+    return TEMPLATE_REGISTRY.build_docx(docx_path, etree.tostring(body, encoding="unicode"), contexts[0])
+
+
+def convert_docx_batch(docx_bytes: bytes, count: int, workspace: Optional[Workspace] = None) -> List[bytes]:
+    """Пакетный DOCX -> PDF одним вызовом LibreOffice, по PDF на страницу."""
+    from PyPDF2 import PdfReader, PdfWriter
+
+    with (workspace or WORKSPACES.shared()).row() as row_dir:
+        docx_path = os.path.join(row_dir, "batch.docx")
+        with open(docx_path, "wb") as f:
+            f.write(docx_bytes)
+        with open(LO_POOL.convert(docx_path, row_dir), "rb") as f:
+            reader = PdfReader(io.BytesIO(f.read()))
+    if len(reader.pages) != count:
+        raise RuntimeError(f"Batch PDF has {len(reader.pages)} pages for {count} rows")
+    result: List[bytes] = []
+    for page in reader.pages:
+        writer = PdfWriter()
+        writer.add_page(page)
+        buf = io.BytesIO()
+        writer.write(buf)
+        result.append(buf.getvalue())
+    return result
+
+
+@dataclass
+class PdfSizeStats:
+    """Байты PDF до и после оптимизации в пределах задачи."""
+    before: int = 0
+    after: int = 0
+    lock: Lock = field(default_factory=Lock, repr=False)
+
+    def add(self, before: int, after: int) -> None:
+        with self.lock:
+            self.before += before
+            self.after += after
+
+
+@dataclass
+class PipelineRow:
+    """Строка на конвейере. Без context рендер не нужен: PDF берётся у более ранней строки или из прежнего архива."""
+    row_num: int
+    fname: str
+    ckey: str
+    context: Optional[Dict[str, str]] = None
+    copy_from: Optional[str] = None  # запись архива prior (incremental)
+    cert_id: str = ""                # для манифеста: попадает туда только записанный PDF
+
+
+@dataclass
+class RenderUnit:
+    """
+    Единица работы конвейера: строки одного шаблона (одна или пакет). Этапы
+    заполняют results; docx — DOCX для LibreOffice по индексам todo (при
+    batch — один склеенный DOCX на все todo).
+    """
+    docx_path: str
+    kind: str
+    rows: List[PipelineRow]
+    results: List[Union[bytes, Exception, None]] = field(default_factory=list)
+    todo: List[int] = field(default_factory=list)
+    docx: List[bytes] = field(default_factory=list)
+    batch: bool = False
+
+    @property
+    def renders(self) -> bool:
+        return any(r.context is not None for r in self.rows)
+
+
+def _optimize_results(unit: RenderUnit, indices: List[int], quality: str, sizes: Optional[PdfSizeStats]) -> None:
+    """В кэше лежит исходный PDF, оптимизация под quality — после него."""
+    for i in indices:
+        pdf_bytes = unit.results[i]
+        if not isinstance(pdf_bytes, bytes):
+            continue
+        try:
+            optimized = optimize_pdf(pdf_bytes, quality)
+        except Exception as e:
+            logger.warning(f"PDF optimization skipped for {os.path.basename(unit.docx_path)}: {e}")
+            optimized = pdf_bytes
+        if sizes is not None:
+            sizes.add(len(pdf_bytes), len(optimized))
+        unit.results[i] = optimized
+
+
+def render_unit(
+    unit: RenderUnit,
+    engine: str = "docx",
+    quality: str = "print",
+    sizes: Optional[PdfSizeStats] = None,
+) -> RenderUnit:
+    """
+    Этап render: готовые PDF — из RENDER_CACHE, overlay — сразу PDF; остальные
+    строки уходят в todo — для них этап docx готовит DOCX (см. template_docx).
+    """
+    contexts = [r.context for r in unit.rows]
+    unit.results = [RENDER_CACHE.get(r.ckey) for r in unit.rows]
+    missing = [i for i, r in enumerate(unit.results) if r is None]
+    ready = [i for i in range(len(unit.rows)) if i not in missing]
+    if engine == "overlay" and missing and get_overlay_layout(unit.docx_path) is not None:
+        for i in missing:
+            try:
+                with STAGE_SECONDS.time(stage="overlay"):
+                    unit.results[i] = render_overlay_pdf(unit.docx_path, contexts[i])
+                RENDER_CACHE.put(unit.rows[i].ckey, unit.results[i])
+                ready.append(i)
+            except Exception as e:
+                logger.warning(f"Overlay render failed for {os.path.basename(unit.docx_path)} ({e}), using LibreOffice")
+                unit.todo.append(i)
+    else:
+        unit.todo = missing
+    _optimize_results(unit, ready, quality, sizes)
+    return unit
+
+
+def template_docx(docx_path: str, contexts: List[Dict[str, str]]) -> Tuple[bool, List[Union[bytes, Exception]], float]:
+    """
+    Этап docx: (batch, DOCX, секунды). Несколько строк — один склеенный DOCX,
+    при сбое и для одной строки — по DOCX на строку (или исключение вместо него).
+    Только str/dict на входе и bytes на выходе — годится для процессного пула.
+    """
+    t0 = time.perf_counter()
+    if len(contexts) > 1:
+        try:
+            return True, [build_docx_batch(docx_path, contexts)], time.perf_counter() - t0
+        except Exception as e:
+            logger.warning(f"Batch render failed for {os.path.basename(docx_path)} ({e}), falling back to per-row")
+    parts: List[Union[bytes, Exception]] = []
+    for context in contexts:
+        try:
+            parts.append(TEMPLATE_REGISTRY.render(docx_path, context))
+        except Exception as e:
+            parts.append(e)
+    return False, parts, time.perf_counter() - t0
+
+
+def _template_docx_in_worker(docx_path: str, contexts: List[Dict[str, str]]) -> Tuple[bool, List[Union[bytes, Exception]], float]:
+    """template_docx для ProcessPoolExecutor: исключения сторонних библиотек не всегда переживают pickle."""
+    try:
+        batch, parts, elapsed = template_docx(docx_path, contexts)
+    except Exception as e:
+        raise RuntimeError(str(e)) from None
+    return batch, [RuntimeError(str(p)) if isinstance(p, Exception) else p for p in parts], elapsed
+
+
+def _docx_worker_init() -> None:
+    """Процесс пула docx: шаблоны компилируются один раз и остаются в его TEMPLATE_REGISTRY."""
+    _warm_templates(_warmup_contexts())
+
+
+def apply_docx_parts(unit: RenderUnit, batch: bool, parts: List[Union[bytes, Exception]]) -> RenderUnit:
+    """Результат template_docx -> unit: строки с ошибкой шаблона выпадают из todo."""
+    if batch:
+        unit.batch, unit.docx = True, parts  # type: ignore[assignment]
+        return unit
+    todo, unit.todo = unit.todo, []
+    for i, part in zip(todo, parts):
+        if isinstance(part, Exception):
+            unit.results[i] = part
+        else:
+            unit.todo.append(i)
+            unit.docx.append(part)
+    return unit
+
+
+def convert_unit(
+    unit: RenderUnit,
+    quality: str = "print",
+    sizes: Optional[PdfSizeStats] = None,
+    workspace: Optional[Workspace] = None,
+) -> RenderUnit:
+    """Этап convert: DOCX из template_docx -> PDF через LibreOffice, в кэш и под quality."""
+    if unit.batch:
+        try:
+            fresh: List[Union[bytes, Exception]] = list(convert_docx_batch(unit.docx[0], len(unit.todo), workspace))
+        except Exception as e:
+            # LibreOfficeTimeout тоже сюда: слот уже перезапущен, а зависнуть мог один
+            # сертификат пакета — построчно он получит свою ошибку, остальные пройдут
+            reason = "timed out" if isinstance(e, LibreOfficeTimeout) else f"failed ({e})"
+            logger.warning(f"Batch convert of {len(unit.todo)} rows {reason} for "
+                           f"{os.path.basename(unit.docx_path)}, falling back to per-row")
+            fresh = [_render_rows_uncached(unit.docx_path, [unit.rows[i].context], workspace=workspace)[0]
+                     for i in unit.todo]
+    else:
+        fresh = []
+        for docx_bytes in unit.docx:
+            try:
+                fresh.append(convert_docx_bytes(docx_bytes, workspace))
+            except Exception as e:
+                fresh.append(e)
+    for i, pdf_bytes in zip(unit.todo, fresh):
+        unit.results[i] = pdf_bytes
+        if not isinstance(pdf_bytes, Exception):
+            RENDER_CACHE.put(unit.rows[i].ckey, pdf_bytes)
+    _optimize_results(unit, unit.todo, quality, sizes)
+    unit.docx = []
+    return unit
+
+
+def _render_rows_uncached(
+    docx_path: str,
+    contexts: List[Dict[str, str]],
+    engine: str = "docx",
+    workspace: Optional[Workspace] = None,
+) -> List[Union[bytes, Exception]]:
+    """
+    overlay — штамп текста поверх готового фона (без LibreOffice);
+    иначе пакетом, а при сбое — построчно.
+    """
+    results: List[Union[bytes, Exception]] = []
+    if engine == "overlay" and get_overlay_layout(docx_path) is not None:
+        for context in contexts:
+            try:
+                with STAGE_SECONDS.time(stage="overlay"):
+                    results.append(render_overlay_pdf(docx_path, context))
+            except Exception as e:
+                logger.warning(f"Overlay render failed for {os.path.basename(docx_path)} ({e}), using LibreOffice")
+                results.extend(_render_rows_uncached(docx_path, [context], workspace=workspace))
+        return results
+    if len(contexts) > 1:
+        try:
+            return list(render_docx_batch(docx_path, contexts, workspace))
+        except Exception as e:
+            logger.warning(f"Batch convert failed for {os.path.basename(docx_path)} ({e}), falling back to per-row")
+    for context in contexts:
+        try:
+            results.append(render_docx_template(docx_path, context, workspace))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+# =============================================================================
+# Overlay-движок: фон шаблона один раз через LibreOffice + текст reportlab
+# =============================================================================
+RENDER_ENGINES = ("docx", "overlay")
+RENDER_ENGINE = os.getenv("RENDER_ENGINE", "docx")
+OVERLAY_LAYOUTS_FILE = os.getenv("OVERLAY_LAYOUTS_FILE", os.path.join(TEMPLATES_DIR, "layouts.json"))
+
+TWIPS_PER_PT = 20
+DOCX_NS = {
+    "w":   "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+    "wp":  "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing",
+    "wps": "http://schemas.microsoft.com/office/word/2010/wordprocessingShape",
+    "a":   "http://schemas.openxmlformats.org/drawingml/2006/main",
+}
+
+
+@dataclass
+class OverlayParagraph:
+    template: str            # текст абзаца с плейсхолдерами Jinja
+    font: str
+    size: float
+    color: str = "000000"
+    align: str = "left"      # left | center | right
+    space_before: float = 0.0
+    space_after: float = 0.0
+
+
+@dataclass
+class OverlayBox:
+    x: float                 # pt от левого верхнего угла страницы
+    y: float
+    width: float
+    height: float
+    paragraphs: List[OverlayParagraph] = field(default_factory=list)
+
+
+@dataclass
+class OverlayLayout:
+    page_width: float
+    page_height: float
+    boxes: List[OverlayBox] = field(default_factory=list)
+    background: bytes = b""
+
+
+OVERLAY_LAYOUTS: Dict[Tuple[str, float], Optional[OverlayLayout]] = {}
+OVERLAY_LOCK = Lock()
+
+# высота строки (ascent + descent по OS/2 win*) в долях кегля. LibreOffice берёт
+# метрически совместимые замены (Liberation, Carlito), поэтому числа те же, что в Word
+LINE_HEIGHT_EM = {
+    "times new roman": 1.107,
+    "arial": 1.149,
+    "calibri": 1.221,
+    "calibri light": 1.221,
+    "cambria": 1.172,
+}
+DEFAULT_LINE_HEIGHT_EM = 1.17
+
+
+@lru_cache(maxsize=None)
+def line_height_em(family: str) -> float:
+    """Высота строки семейства; EYInterstate — из OS/2 самого шрифта."""
+    key = (family or "").lower()
+    if key in LINE_HEIGHT_EM:
+        return LINE_HEIGHT_EM[key]
+    if key.startswith("eyinterstate"):
+        path = os.path.join(FONTS_DIR, FONT_FILES["light" if "light" in key else "regular"][0])
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            (num_tables,) = struct.unpack(">H", data[4:6])
+            tables = {}
+            for i in range(num_tables):
+                tag, _, offset, length = struct.unpack(">4sIII", data[12 + 16 * i:28 + 16 * i])
+                tables[tag] = data[offset:offset + length]
+            (units_per_em,) = struct.unpack(">H", tables[b"head"][18:20])
+            win_ascent, win_descent = struct.unpack(">HH", tables[b"OS/2"][74:78])
+            return (win_ascent + win_descent) / units_per_em
+        except (OSError, KeyError, struct.error):
+            pass
+    return DEFAULT_LINE_HEIGHT_EM
+
+
+class DocxStyles:
+    """
+    Свойства абзаца и прогона так, как их видит Word: docDefaults, затем цепочка
+    basedOn стиля абзаца (w:pStyle или стиль по умолчанию), стиля прогона
+    (w:rStyle) и прямое форматирование. Тема нужна для w:asciiTheme.
+    """
+
+    def __init__(self, styles_xml: Optional[bytes] = None, theme_xml: Optional[bytes] = None):
+        from lxml import etree
+
+        w = "{%s}" % DOCX_NS["w"]
+        self._w = w
+        self._styles: Dict[str, object] = {}
+        self._default_para: Optional[str] = None
+        self._doc_ppr = self._doc_rpr = None
+        if styles_xml:
+            root = etree.fromstring(styles_xml)
+            self._doc_ppr = root.find("w:docDefaults/w:pPrDefault/w:pPr", DOCX_NS)
+            self._doc_rpr = root.find("w:docDefaults/w:rPrDefault/w:rPr", DOCX_NS)
+            for st in root.iterfind("w:style", DOCX_NS):
+                self._styles[st.get(w + "styleId")] = st
+                if st.get(w + "type") == "paragraph" and st.get(w + "default") in ("1", "true"):
+                    self._default_para = st.get(w + "styleId")
+        self._theme_fonts: Dict[str, str] = {}
+        if theme_xml:
+            theme = etree.fromstring(theme_xml)
+            for kind in ("major", "minor"):
+                latin = theme.find(f".//a:{kind}Font/a:latin", DOCX_NS)
+                if latin is not None:
+                    self._theme_fonts[kind] = latin.get("typeface", "")
+
+    @classmethod
+    def from_zip(cls, z: zipfile.ZipFile) -> "DocxStyles":
+        names = set(z.namelist())
+        return cls(z.read("word/styles.xml") if "word/styles.xml" in names else None,
+                   z.read("word/theme/theme1.xml") if "word/theme/theme1.xml" in names else None)
+
+    def _chain(self, style_id: Optional[str], part: str) -> List[object]:
+        """Элементы part (w:pPr/w:rPr) цепочки стилей от базового к самому стилю."""
+        chain = []
+        seen = set()
+        while style_id and style_id in self._styles and style_id not in seen:
+            seen.add(style_id)
+            st = self._styles[style_id]
+            el = st.find(part, DOCX_NS)
+            if el is not None:
+                chain.append(el)
+            based = st.find("w:basedOn", DOCX_NS)
+            style_id = based.get(self._w + "val") if based is not None else None
+        return chain[::-1]
+
+    def _para_style(self, p) -> Optional[str]:
+        ps = p.find("w:pPr/w:pStyle", DOCX_NS)
+        return ps.get(self._w + "val") if ps is not None else self._default_para
+
+    def spacing(self, p) -> Dict[str, str]:
+        """Атрибуты w:spacing абзаца (before/after/line/lineRule) после наследования."""
+        result: Dict[str, str] = {}
+        layers = [self._doc_ppr] + self._chain(self._para_style(p), "w:pPr") + [p.find("w:pPr", DOCX_NS)]
+        for ppr in layers:
+            el = ppr.find("w:spacing", DOCX_NS) if ppr is not None else None
+            if el is not None:
+                result.update({k[len(self._w):]: v for k, v in el.attrib.items() if k.startswith(self._w)})
+        return result
+
+    def run_props(self, p, r=None) -> Dict[str, object]:
+        """size (pt), font (семейство), bold прогона r; без r — знака абзаца."""
+        w = self._w
+        layers = [self._doc_rpr] + self._chain(self._para_style(p), "w:rPr")
+        rpr = r.find("w:rPr", DOCX_NS) if r is not None else p.find("w:pPr/w:rPr", DOCX_NS)
+        if rpr is not None:
+            rs = rpr.find("w:rStyle", DOCX_NS)
+            if rs is not None:
+                layers += self._chain(rs.get(w + "val"), "w:rPr")
+        layers.append(rpr)
+        props: Dict[str, object] = {"size": 11.0, "font": "", "bold": None, "bold_cs": None}
+        for layer in layers:
+            if layer is None:
+                continue
+            sz = layer.find("w:sz", DOCX_NS)
+            if sz is not None and sz.get(w + "val", "").isdigit():
+                props["size"] = int(sz.get(w + "val")) / 2
+            fonts = layer.find("w:rFonts", DOCX_NS)
+            if fonts is not None:
+                if fonts.get(w + "ascii"):
+                    props["font"] = fonts.get(w + "ascii")
+                elif fonts.get(w + "asciiTheme"):
+                    kind = "major" if fonts.get(w + "asciiTheme").startswith("major") else "minor"
+                    props["font"] = self._theme_fonts.get(kind, "")
+            for tag, key in (("b", "bold"), ("bCs", "bold_cs")):
+                el = layer.find(f"w:{tag}", DOCX_NS)
+                if el is not None:
+                    props[key] = el.get(w + "val", "1").lower() not in ("0", "false", "off")
+        props["bold"] = bool(props["bold"] if props["bold"] is not None else props["bold_cs"])
+        del props["bold_cs"]
+        return props
+
+    def line_height(self, p) -> float:
+        """Высота одной строки абзаца, pt (по самому высокому прогону с текстом)."""
+        w = self._w
+        runs = [r for r in p.iterfind("w:r", DOCX_NS) if "".join(t.text or "" for t in r.iterfind("w:t", DOCX_NS))]
+        sizes = [self.run_props(p, r) for r in runs] or [self.run_props(p)]
+        natural = max(props["size"] * line_height_em(props["font"]) for props in sizes)
+        spacing = self.spacing(p)
+        line = int(spacing.get("line", "240")) / TWIPS_PER_PT
+        rule = spacing.get("lineRule", "auto")
+        if rule == "exact":
+            return line
+        if rule == "atLeast":
+            return max(line, natural)
+        return natural * int(spacing.get("line", "240")) / 240
+
+
+def _overlay_font(family: str, bold: bool) -> str:
+    from reportlab.pdfbase import pdfmetrics
+
+    ensure_fonts()
+    registered_fonts = set(pdfmetrics.getRegisteredFontNames())
+    if bold and "EYInterstate-Bold" in registered_fonts:
+        return "EYInterstate-Bold"
+    if "light" in (family or "").lower() and "EYInterstate-Light" in registered_fonts:
+        return "EYInterstate-Light"
+    return FONT_NAME
+
+
+def _xml_para_text(p) -> str:
+    return "".join(t.text or "" for t in p.iter("{%s}t" % DOCX_NS["w"]))
+
+
+def _own_para_text(p) -> str:
+    """Текст самого абзаца, без текстбоксов, привязанных к нему."""
+    w = "{%s}" % DOCX_NS["w"]
+    return "".join(t.text or "" for t in p.iter(w + "t") if next(t.iterancestors(w + "p"), None) is p)
+
+
+def _overlay_paragraph(p, text: str, styles: Optional[DocxStyles] = None) -> OverlayParagraph:
+    w = "{%s}" % DOCX_NS["w"]
+    styles = styles or DocxStyles()
+    r = p.find("w:r", DOCX_NS)
+    props = styles.run_props(p, r)
+    color_el = p.find("w:r/w:rPr/w:color", DOCX_NS)
+    color = color_el.get(w + "val", "000000") if color_el is not None else "000000"
+    jc = p.find("w:pPr/w:jc", DOCX_NS)
+    align = {"center": "center", "right": "right", "end": "right"}.get(
+        jc.get(w + "val") if jc is not None else "", "left")
+    spacing = styles.spacing(p)
+    return OverlayParagraph(
+        template=text,
+        font=_overlay_font(props["font"], props["bold"]),
+        size=props["size"],
+        color="000000" if color == "auto" else color,
+        align=align,
+        space_before=int(spacing.get("before", 0)) / TWIPS_PER_PT,
+        space_after=int(spacing.get("after", 0)) / TWIPS_PER_PT,
+    )
+
+
+def _body_flow(body, styles: DocxStyles, top: float) -> Optional[Dict[object, float]]:
+    """
+    Верх каждого абзаца тела (pt от верха страницы, вместе с отступом перед ним).
+    Абзацы считаются однострочными — в шаблонах до полей стоят пустые абзацы-
+    распорки и короткие подписи. Таблицы и разрывы страниц не моделируются — None.
+    """
+    w = "{%s}" % DOCX_NS["w"]
+    tops: Dict[object, float] = {}
+    y = top
+    for el in body:
+        if el.tag == w + "tbl":
+            return None
+        if el.tag != w + "p":
+            continue
+        if el.find(".//w:br[@w:type='page']", DOCX_NS) is not None:
+            return None
+        tops[el] = y
+        spacing = styles.spacing(el)
+        y += (int(spacing.get("before", 0)) + int(spacing.get("after", 0))) / TWIPS_PER_PT + styles.line_height(el)
+    return tops
+
+
+def extract_overlay_layout(docx_path: str) -> Optional[OverlayLayout]:
+    """
+    Раскладка полей из DOCX: текстбоксы с плейсхолдерами и абзацы тела с ними.
+    Текстбоксы, привязанные к абзацу (печатные шаблоны), и абзацы тела
+    ставятся по потоку абзацев (_body_flow). Якорь относительно символа или
+    с выравниванием вместо смещения статически не вычисляется — тогда None.
+    """
+    from lxml import etree
+
+    with zipfile.ZipFile(docx_path) as z:
+        root = etree.fromstring(z.read("word/document.xml"))
+        styles = DocxStyles.from_zip(z)
+    w = "{%s}" % DOCX_NS["w"]
+
+    body = root.find("w:body", DOCX_NS)
+    sect = body.find("w:sectPr", DOCX_NS) if body is not None else None
+    pg_sz = sect.find("w:pgSz", DOCX_NS) if sect is not None else None
+    if pg_sz is None:
+        return None
+    pg_mar = sect.find("w:pgMar", DOCX_NS)
+
+    def mar(side: str) -> float:
+        return int(pg_mar.get(w + side, 0)) / TWIPS_PER_PT if pg_mar is not None else 0.0
+    margins = {"x": mar("left"), "y": mar("top")}
+    layout = OverlayLayout(
+        page_width=int(pg_sz.get(w + "w")) / TWIPS_PER_PT,
+        page_height=int(pg_sz.get(w + "h")) / TWIPS_PER_PT,
+    )
+    flow: Optional[Dict[object, float]] = None
+
+    def para_top(p) -> Optional[float]:
+        nonlocal flow
+        if flow is None:
+            flow = _body_flow(body, styles, margins["y"]) or {}
+        return flow.get(p)
+
+    for p in body.iterfind("w:p", DOCX_NS):
+        text = _own_para_text(p)
+        if "{{" not in text:
+            continue
+        top = para_top(p)
+        if top is None:
+            return None
+        ind = p.find("w:pPr/w:ind", DOCX_NS)
+        left = int(ind.get(w + "left", ind.get(w + "start", 0))) / TWIPS_PER_PT if ind is not None else 0.0
+        right = int(ind.get(w + "right", ind.get(w + "end", 0))) / TWIPS_PER_PT if ind is not None else 0.0
+        para = _overlay_paragraph(p, text, styles)
+        before = para.space_before
+        para.space_before = para.space_after = 0.0
+        layout.boxes.append(OverlayBox(
+            x=margins["x"] + left,
+            y=top + before,
+            width=layout.page_width - margins["x"] - mar("right") - left - right,
+            height=styles.line_height(p),
+            paragraphs=[para],
+        ))
+
+    for anchor in root.iterfind(".//wp:anchor", DOCX_NS):
+        txbx = anchor.find(".//wps:txbx", DOCX_NS)
+        if txbx is None:
+            continue
+        paras = txbx.findall(".//w:p", DOCX_NS)
+        texts = [_xml_para_text(p) for p in paras]
+        if not any("{{" in t for t in texts):
+            continue  # статичный текст уже есть в фоне
+        pos: Dict[str, float] = {}
+        for axis, tag in (("x", "wp:positionH"), ("y", "wp:positionV")):
+            el = anchor.find(tag, DOCX_NS)
+            off = el.find("wp:posOffset", DOCX_NS) if el is not None else None
+            rel = el.get("relativeFrom") if el is not None else None
+            if off is None:
+                return None
+            offset = int(off.text) / EMU_PER_PT
+            if rel in ("page", "topMargin", "leftMargin"):
+                pos[axis] = offset
+            elif rel in ("margin", "column"):
+                # одна колонка: колонка совпадает с полем страницы
+                pos[axis] = offset + margins[axis]
+            elif axis == "y" and rel in ("paragraph", "line"):
+                anchor_p = next(anchor.iterancestors(w + "p"), None)
+                top = para_top(anchor_p) if anchor_p is not None else None
+                if top is None:
+                    return None
+                if rel == "line":
+                    top += int(styles.spacing(anchor_p).get("before", 0)) / TWIPS_PER_PT
+                pos[axis] = top + offset
+            else:
+                return None
+        ext = anchor.find("wp:extent", DOCX_NS)
+        body_pr = anchor.find(".//wps:bodyPr", DOCX_NS)
+        ins = {k: int(body_pr.get(k, d)) / EMU_PER_PT if body_pr is not None else d / EMU_PER_PT
+               for k, d in (("lIns", 91440), ("tIns", 45720), ("rIns", 91440), ("bIns", 45720))}
+        layout.boxes.append(OverlayBox(
+            x=pos["x"] + ins["lIns"],
+            y=pos["y"] + ins["tIns"],
+            width=int(ext.get("cx")) / EMU_PER_PT - ins["lIns"] - ins["rIns"],
+            height=int(ext.get("cy")) / EMU_PER_PT - ins["tIns"] - ins["bIns"],
+            paragraphs=[_overlay_paragraph(p, t, styles) for p, t in zip(paras, texts)],
+        ))
+    return layout if layout.boxes else None
+
+
+def _load_layout_override(docx_path: str) -> Optional[OverlayLayout]:
+    """Ручная раскладка из layouts.json (ключ — имя файла шаблона)."""
+    if not os.path.exists(OVERLAY_LAYOUTS_FILE):
+        return None
+    with open(OVERLAY_LAYOUTS_FILE, "r", encoding="utf-8") as f:
+        spec = json.load(f).get(os.path.basename(docx_path))
+    if not spec:
+        return None
+    return OverlayLayout(
+        page_width=spec["page_width"],
+        page_height=spec["page_height"],
+        boxes=[
+            OverlayBox(
+                x=b["x"], y=b["y"], width=b["width"], height=b["height"],
+                paragraphs=[OverlayParagraph(**p) for p in b["paragraphs"]],
+            )
+            for b in spec["boxes"]
+        ],
+    )
+
+
+def _build_overlay_background(docx_path: str) -> bytes:
+    """Шаблон без текста с плейсхолдерами -> PDF-фон (единственный вызов LibreOffice)."""
+    from docx import Document
+    from docx.oxml.ns import qn
+
+    d = Document(docx_path)
+    for p in d.element.body.iter(qn("w:p")):
+        if "{{" in _own_para_text(p):
+            for t in p.iter(qn("w:t")):
+                if next(t.iterancestors(qn("w:p")), None) is p:
+                    t.text = ""
+    buf = io.BytesIO()
+    d.save(buf)
+    return convert_docx_bytes(buf.getvalue())
+
+
+def get_overlay_layout(docx_path: str) -> Optional[OverlayLayout]:
+    """Раскладка + фон шаблона; строится один раз на (путь, mtime). None — overlay недоступен."""
+    key = (os.path.abspath(docx_path), os.path.getmtime(docx_path))
+    if key in OVERLAY_LAYOUTS:
+        return OVERLAY_LAYOUTS[key]
+    with OVERLAY_LOCK:
+        if key in OVERLAY_LAYOUTS:
+            return OVERLAY_LAYOUTS[key]
+        layout: Optional[OverlayLayout] = None
+        try:
+            layout = _load_layout_override(docx_path) or extract_overlay_layout(docx_path)
+            if layout is None:
+                logger.info(f"Overlay layout unavailable for {os.path.basename(docx_path)}, using LibreOffice")
+            else:
+                layout.background = _build_overlay_background(docx_path)
+        except Exception as e:
+            logger.warning(f"Overlay prepare failed for {os.path.basename(docx_path)}: {e}")
+            layout = None
+        OVERLAY_LAYOUTS[key] = layout
+        return layout
+
+
+def prepare_overlay_templates() -> None:
+    for group in DOCX_MAP.values():
+        for variants in group.values():
+            for docx_name in variants.values():
+                docx_path = os.path.join(TEMPLATES_DIR, docx_name)
+                if os.path.exists(docx_path):
+                    get_overlay_layout(docx_path)
+
+
+def overlay_unsupported_templates() -> List[str]:
+    """
+    Шаблоны, для которых engine=overlay уйдёт в LibreOffice: нет записи в
+    layouts.json и раскладку не извлечь статически. Фон при этом не строится.
+    """
+    unsupported = []
+    for group in DOCX_MAP.values():
+        for variants in group.values():
+            for docx_name in variants.values():
+                docx_path = os.path.join(TEMPLATES_DIR, docx_name)
+                if not os.path.exists(docx_path) or docx_name in unsupported:
+                    continue
+                try:
+                    layout = _load_layout_override(docx_path) or extract_overlay_layout(docx_path)
+                except Exception as e:
+                    logger.warning(f"Overlay layout check failed for {docx_name}: {e}")
+                    layout = None
+                if layout is None:
+                    unsupported.append(docx_name)
+    return unsupported
+
+
+_JINJA_CACHE: Dict[str, object] = {}
+
+
+def _render_text(template: str, context: Dict[str, str]) -> str:
+    from jinja2 import Template
+    compiled = _JINJA_CACHE.get(template)
+    if compiled is None:
+        compiled = _JINJA_CACHE[template] = Template(template)
+    return compiled.render(context)
+
+
+def _overlay_size(template: str, size: float, context: Dict[str, str]) -> float:
+    """Кегль, подобранный text fit для имени/курса (ключи FIT_FIELDS), иначе из раскладки."""
+    for placeholders, key, _ in FIT_FIELDS.values():
+        if key in context and re.search(r"\{\{\s*%s\s*\}\}" % placeholders[0], template):
+            return int(context[key]) / 2
+    return size
+
+
+def _draw_overlay(layout: OverlayLayout, context: Dict[str, str]) -> bytes:
+    from reportlab.pdfgen import canvas
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.lib.colors import HexColor
+    from reportlab.lib.utils import simpleSplit
+
+    ensure_fonts()
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=(layout.page_width, layout.page_height))
+    for box in layout.boxes:
+        top = layout.page_height - box.y
+        for para in box.paragraphs:
+            text = _render_text(para.template, context)
+            size = _overlay_size(para.template, para.size, context)
+            ascent, descent = pdfmetrics.getAscentDescent(para.font, size)
+            line_height = (ascent - descent) or size * 1.2
+            top -= para.space_before
+            c.setFont(para.font, size)
+            c.setFillColor(HexColor("#" + para.color))
+            for line in simpleSplit(text, para.font, size, box.width) or [""]:
+                baseline = top - ascent
+                if para.align == "center":
+                    c.drawCentredString(box.x + box.width / 2, baseline, line)
+                elif para.align == "right":
+                    c.drawRightString(box.x + box.width, baseline, line)
+                else:
+                    c.drawString(box.x, baseline, line)
+                top -= line_height
+            top -= para.space_after
+    c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+def render_overlay_pdf(docx_path: str, context: Dict[str, str]) -> bytes:
+    layout = get_overlay_layout(docx_path)
+    if layout is None:
+        raise RuntimeError(f"No overlay layout for {os.path.basename(docx_path)}")
+    from PyPDF2 import PdfReader, PdfWriter
+
+    overlay = PdfReader(io.BytesIO(_draw_overlay(layout, context))).pages[0]
+    background = PdfReader(io.BytesIO(layout.background)).pages[0]
+    writer = PdfWriter()
+    page = writer.add_page(background)
+    page.merge_page(overlay)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+async def _prepare_overlay_on_startup():
+    unsupported = await asyncio.get_event_loop().run_in_executor(None, overlay_unsupported_templates)
+    if unsupported:
+        log = logger.warning if RENDER_ENGINE == "overlay" else logger.info
+        log(f"engine=overlay falls back to LibreOffice for {len(unsupported)} template(s) "
+            f"(add them to {os.path.basename(OVERLAY_LAYOUTS_FILE)}): {', '.join(unsupported)}")
+    if RENDER_ENGINE == "overlay":
+        asyncio.get_event_loop().run_in_executor(None, prepare_overlay_templates)
+
+
+# =============================================================================
+# Job state backend: прогресс и результаты, видимые из всех воркеров
+# =============================================================================
+RESULTS_DIR = os.getenv("RESULTS_DIR", os.path.join(tempfile.gettempdir(), "cert_results"))
+JOB_STATE_BACKEND = os.getenv("JOB_STATE_BACKEND", "memory")  # memory | sqlite
+JOB_STATE_DB = os.getenv("JOB_STATE_DB", os.path.join(RESULTS_DIR, "jobs.sqlite3"))
+PROGRESS_POLL_INTERVAL = float(os.getenv("PROGRESS_POLL_INTERVAL", "0.5"))  # секунды, для sqlite
+PROGRESS_PUBLISH_INTERVAL = float(os.getenv("PROGRESS_PUBLISH_INTERVAL", "0.25"))  # секунды, для sqlite
+
+
+@dataclass
+class JobResult:
+    path: str
+    size: int
+    created: float
+    output: str = "zip"  # zip | pdf
+
+
+class MemoryJobState:
+    """Состояние задач в памяти процесса — по умолчанию, для одного воркера."""
+
+    shared = False
+
+    def __init__(self):
+        self._results: "OrderedDict[str, JobResult]" = OrderedDict()
+        self._submissions: Dict[str, Tuple[str, float]] = {}
+        self._aliases: Dict[str, Tuple[str, float]] = {}
+        self._lock = Lock()
+
+    def publish(self, job_id: str, data: Dict[str, object]) -> None:
+        pass  # подписчики SSE получают обновления из ProgressState напрямую
+
+    def read_progress(self, job_id: str) -> Optional[Tuple[int, Dict[str, object]]]:
+        return None
+
+    def sweep_progress(self, older_than: float) -> None:
+        """Забывает отпечатки загрузок и алиасы старше older_than."""
+        with self._lock:
+            for table in (self._submissions, self._aliases):
+                for key in [k for k, (_, ts) in table.items() if ts < older_than]:
+                    del table[key]
+
+    def find_submission(self, key: str) -> Optional[str]:
+        entry = self._submissions.get(key)
+        return entry[0] if entry else None
+
+    def remember_submission(self, key: str, job_id: str) -> None:
+        with self._lock:
+            self._submissions[key] = (job_id, time.time())
+
+    def add_alias(self, alias: str, job_id: str) -> None:
+        with self._lock:
+            self._aliases[alias] = (job_id, time.time())
+
+    def resolve(self, job_id: str) -> str:
+        entry = self._aliases.get(job_id)
+        return entry[0] if entry else job_id
+
+    def add_result(self, job_id: str, item: JobResult) -> Optional[JobResult]:
+        with self._lock:
+            old = self._results.pop(job_id, None)
+            self._results[job_id] = item
+            return old
+
+    def get_result(self, job_id: str) -> Optional[JobResult]:
+        return self._results.get(job_id)
+
+    def pop_result(self, job_id: str) -> Optional[JobResult]:
+        with self._lock:
+            return self._results.pop(job_id, None)
+
+    def results(self) -> List[Tuple[str, JobResult]]:
+        """Все результаты, от старых к новым."""
+        with self._lock:
+            return list(self._results.items())
+
+
+class SqliteJobState:
+    """
+    Прогресс и метаданные результатов в общей SQLite-базе (WAL): их видит любой
+    воркер uvicorn на этой машине. Подписчики SSE опрашивают версию записи.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS progress ("
+                "job_id TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL, updated REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS submissions (key TEXT PRIMARY KEY, job_id TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS aliases (job_id TEXT PRIMARY KEY, target TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "job_id TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, "
+                "output TEXT NOT NULL DEFAULT 'zip')"
+            )
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            db.execute("PRAGMA synchronous=NORMAL")
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def publish(self, job_id: str, data: Dict[str, object]) -> None:
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO progress (job_id, data, version, updated) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET data = excluded.data, "
+                "version = progress.version + 1, updated = excluded.updated",
+                (job_id, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+
+    def read_progress(self, job_id: str) -> Optional[Tuple[int, Dict[str, object]]]:
+        with self._db() as db:
+            row = db.execute("SELECT version, data FROM progress WHERE job_id = ?", (job_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def sweep_progress(self, older_than: float) -> None:
+        with self._db() as db:
+            db.execute("DELETE FROM progress WHERE updated < ?", (older_than,))
+            db.execute("DELETE FROM submissions WHERE created < ?", (older_than,))
+            db.execute("DELETE FROM aliases WHERE created < ?", (older_than,))
+
+    def find_submission(self, key: str) -> Optional[str]:
+        with self._db() as db:
+            row = db.execute("SELECT job_id FROM submissions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def remember_submission(self, key: str, job_id: str) -> None:
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO submissions (key, job_id, created) VALUES (?, ?, ?)",
+                       (key, job_id, time.time()))
+
+    def add_alias(self, alias: str, job_id: str) -> None:
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO aliases (job_id, target, created) VALUES (?, ?, ?)",
+                       (alias, job_id, time.time()))
+
+    def resolve(self, job_id: str) -> str:
+        with self._db() as db:
+            row = db.execute("SELECT target FROM aliases WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else job_id
+
+    def add_result(self, job_id: str, item: JobResult) -> Optional[JobResult]:
+        with self._db() as db:
+            row = db.execute("SELECT path, size, created, output FROM results WHERE job_id = ?", (job_id,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO results (job_id, path, size, created, output) VALUES (?, ?, ?, ?, ?)",
+                (job_id, item.path, item.size, item.created, item.output),
+            )
+        return JobResult(*row) if row else None
+
+    def get_result(self, job_id: str) -> Optional[JobResult]:
+        with self._db() as db:
+            row = db.execute("SELECT path, size, created, output FROM results WHERE job_id = ?", (job_id,)).fetchone()
+        return JobResult(*row) if row else None
+
+    def pop_result(self, job_id: str) -> Optional[JobResult]:
+        with self._db() as db:
+            row = db.execute("SELECT path, size, created, output FROM results WHERE job_id = ?", (job_id,)).fetchone()
+            db.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+        return JobResult(*row) if row else None
+
+    def results(self) -> List[Tuple[str, JobResult]]:
+        with self._db() as db:
+            rows = db.execute("SELECT job_id, path, size, created, output FROM results ORDER BY created").fetchall()
+        return [(r[0], JobResult(*r[1:])) for r in rows]
+
+
+def make_job_state(kind: str):
+    if kind == "sqlite":
+        return SqliteJobState(JOB_STATE_DB)
+    if kind != "memory":
+        logger.warning(f"Unknown JOB_STATE_BACKEND={kind!r}, using memory")
+    return MemoryJobState()
+
+
+JOB_STATE = make_job_state(JOB_STATE_BACKEND)
+
+
+# =============================================================================
+# SSE progress
+# =============================================================================
+@dataclass
+class ProgressState:
+    total: int = 0
+    processed: int = 0
+    stage: str = "init"  # init | uploading | queued | processing | zipping | done | error | redirect
+    message: str = ""
+    errors: int = 0
+    warnings: List[str] = field(default_factory=list)
+    queue_position: int = 0  # место в очереди планировщика, 0 — задача выполняется
+    bytes_before: int = 0    # размер PDF до оптимизации (quality=web)
+    bytes_after: int = 0
+    redirect: str = ""       # stage=redirect: job_id задачи, к которой присоединена эта
+    created: float = field(default_factory=lambda: time.time())
+    updated: float = field(default_factory=lambda: time.time())
+    subscribers: List[asyncio.Queue] = field(default_factory=list)  # по очереди на SSE-клиента
+
+PROGRESS: Dict[str, ProgressState] = {}
+TERMINAL_STAGES = ("done", "error", "redirect")
+
+def get_progress(job_id: str) -> ProgressState:
+    if job_id not in PROGRESS:
+        PROGRESS[job_id] = ProgressState()
+    return PROGRESS[job_id]
+
+def snapshot(state: ProgressState) -> Dict[str, object]:
+    percent = int(state.processed * 100 / max(1, state.total)) if state.total > 0 else 0
+    return {
+        "total": state.total,
+        "processed": state.processed,
+        "percent": percent,
+        "stage": state.stage,
+        "message": state.message,
+        "errors": state.errors,
+        "warnings": state.warnings,
+        "queue_position": state.queue_position,
+        "bytes_before": state.bytes_before,
+        "bytes_after": state.bytes_after,
+        "job_id": state.redirect or None,
+    }
+
+class ProgressPublisher:
+    """
+    Запись прогресса в общий бэкенд мимо event loop: один поток-писатель,
+    промежуточные состояния задачи схлопываются до последнего не чаще раза
+    в interval. Финальное состояние (TERMINAL_STAGES) пишется сразу, и emit
+    ждёт записи: после него опрос базы уже видит done/error.
+    """
+
+    def __init__(self, job_state, interval: float):
+        self.job_state = job_state
+        self.interval = interval
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[str, Dict[str, object]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress")
+        return self._executor
+
+    def _write(self, job_id: str, data: Dict[str, object]) -> None:
+        try:
+            self.job_state.publish(job_id, data)
+        except sqlite3.Error as e:
+            logger.warning(f"Progress publish failed for {job_id}: {e}")
+
+    def _flush(self, job_id: str) -> None:
+        self._timers.pop(job_id, None)
+        data = self._pending.pop(job_id, None)
+        if data is not None:
+            self.executor.submit(self._write, job_id, data)
+
+    async def publish(self, job_id: str, data: Dict[str, object]) -> None:
+        loop = asyncio.get_running_loop()
+        if data["stage"] in TERMINAL_STAGES:
+            self._pending.pop(job_id, None)
+            timer = self._timers.pop(job_id, None)
+            if timer is not None:
+                timer.cancel()
+            # поток один: промежуточные записи, уже отданные ему, лягут раньше
+            await loop.run_in_executor(self.executor, self.job_state.publish, job_id, data)
+            return
+        self._pending[job_id] = data
+        if job_id not in self._timers:
+            self._timers[job_id] = loop.call_later(self.interval, self._flush, job_id)
+
+    def shutdown(self) -> None:
+        for job_id in list(self._timers):
+            self._timers[job_id].cancel()
+            self._flush(job_id)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+PROGRESS_PUBLISHER = ProgressPublisher(JOB_STATE, PROGRESS_PUBLISH_INTERVAL)
+
+
+async def emit(job_id: str):
+    state = get_progress(job_id)
+    state.updated = time.time()
+    if JOB_STATE.shared:
+        await PROGRESS_PUBLISHER.publish(job_id, snapshot(state))
+    for q in state.subscribers:
+        q.put_nowait("update")
+
+async def _shared_progress_events(job_id: str) -> AsyncIterator[str]:
+    """SSE для общего бэкенда: задача может выполняться в другом воркере."""
+    loop = asyncio.get_event_loop()
+    version = None
+    idle = 0.0
+    while True:
+        record = await loop.run_in_executor(None, JOB_STATE.read_progress, job_id)
+        if record and record[0] != version:
+            version, data = record
+            idle = 0.0
+            yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            if data.get("stage") in TERMINAL_STAGES:
+                break
+        elif idle >= 15.0:
+            idle = 0.0
+            yield "event: ping\ndata: {}\n\n"
+        await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+        idle += PROGRESS_POLL_INTERVAL
+
+@app.get("/progress/{job_id}")
+async def progress_stream(job_id: str):
+    job_id = JOB_STATE.resolve(job_id)
+    if JOB_STATE.shared:
+        return StreamingResponse(_shared_progress_events(job_id), media_type="text/event-stream")
+
+    async def event_gen():
+        state = get_progress(job_id)
+        q: asyncio.Queue = asyncio.Queue()
+        q.put_nowait("update")
+        state.subscribers.append(q)
+        try:
+            while True:
+                try:
+                    _ = await asyncio.wait_for(q.get(), timeout=15.0)
+                except asyncio.TimeoutError:
+                    yield "event: ping\ndata: {}\n\n"
+                    continue
+                data = json.dumps(snapshot(state), ensure_ascii=False)
+                yield f"data: {data}\n\n"
+                if state.stage in TERMINAL_STAGES:
+                    break
+        finally:
+            state.subscribers.remove(q)
+    return StreamingResponse(event_gen(), media_type="text/event-stream")
+
+
+# =============================================================================
+# Job results
+# =============================================================================
+RESULT_TTL = int(os.getenv("RESULT_TTL", "3600"))  # секунды
+RESULTS_MAX_BYTES = int(os.getenv("RESULTS_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+RESULTS_JANITOR_INTERVAL = int(os.getenv("RESULTS_JANITOR_INTERVAL", "60"))
+# вид результата: ZIP с отдельными PDF или единый PDF (см. open_output)
+OUTPUT_FORMATS = ("zip", "pdf")
+OUTPUT_MEDIA = {
+    "zip": ("application/zip", "certificates.zip"),
+    "pdf": ("application/pdf", "certificates.pdf"),
+}
+
+
+class JobResultStore:
+    """
+    Готовые архивы (ZIP или единый PDF) лежат на диске с расширением своего
+    вида, метаданные — в бэкенде состояния задач. Результат можно скачивать
+    повторно до истечения TTL; сверх лимита вытесняются самые старые.
+    """
+
+    def __init__(self, directory: str, ttl: int, max_bytes: int, backend):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._lock = Lock()
+        self.expired = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._sweep_orphans(time.time())
+
+    def _path(self, job_id: str, output: str = "zip") -> str:
+        name = hashlib.sha256(job_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.{output if output in OUTPUT_FORMATS else 'zip'}")
+
+    def new_file(self, job_id: str, output: str = "zip") -> str:
+        """Путь для записи архива; результат становится виден после commit()."""
+        return self._path(job_id, output) + f".{os.getpid()}.tmp"
+
+    def commit(self, job_id: str, tmp_path: str, output: str = "zip") -> None:
+        path = self._path(job_id, output)
+        os.replace(tmp_path, path)
+        item = JobResult(path=path, size=os.path.getsize(path), created=time.time(), output=output)
+        with self._lock:
+            old = self.backend.add_result(job_id, item)
+            if old is not None and old.path != path:
+                try: os.unlink(old.path)
+                except OSError: pass
+            self._evict_over_limit()
+
+    def get(self, job_id: str) -> Optional[JobResult]:
+        item = self.backend.get_result(job_id)
+        if item is None:
+            return None
+        if time.time() - item.created > self.ttl or not os.path.exists(item.path):
+            with self._lock:
+                self._drop(job_id)
+                self.expired += 1
+            return None
+        return item
+
+    def _drop(self, job_id: str) -> None:
+        item = self.backend.pop_result(job_id)
+        if item is None:
+            return
+        try: os.unlink(item.path)
+        except OSError: pass
+
+    def _evict_over_limit(self) -> None:
+        items = self.backend.results()
+        total = sum(item.size for _, item in items)
+        for job_id, item in items[:-1]:
+            if total <= self.max_bytes:
+                break
+            self._drop(job_id)
+            total -= item.size
+            self.evictions += 1
+
+    def _sweep_orphans(self, now: float) -> None:
+        # архивы прошлых запусков и соседних воркеров без метаданных удаляем по TTL
+        known = {item.path for _, item in self.backend.results()}
+        for name in os.listdir(self.directory):
+            if not name.endswith(tuple(f".{ext}" for ext in OUTPUT_FORMATS) + (".tmp",)):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if path not in known and now - os.path.getmtime(path) > self.ttl:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def sweep(self) -> None:
+        now = time.time()
+        with self._lock:
+            for job_id, item in self.backend.results():
+                if now - item.created > self.ttl:
+                    self._drop(job_id)
+                    self.expired += 1
+            self._evict_over_limit()
+            self._sweep_orphans(now)
+        self.backend.sweep_progress(now - self.ttl)
+
+    def stats(self) -> Dict[str, object]:
+        items = self.backend.results()
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": len(items),
+            "bytes": sum(item.size for _, item in items),
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "progress_entries": len(PROGRESS),
+        }
+
+
+JOB_RESULTS = JobResultStore(RESULTS_DIR, RESULT_TTL, RESULTS_MAX_BYTES, JOB_STATE)
+
+
+def sweep_progress() -> None:
+    """Удаляет состояния прогресса, которые не обновлялись дольше TTL."""
+    now = time.time()
+    for job_id in [j for j, st in PROGRESS.items() if now - st.updated > RESULT_TTL]:
+        PROGRESS.pop(job_id, None)
+
+
+async def _results_janitor() -> None:
+    while True:
+        await asyncio.sleep(RESULTS_JANITOR_INTERVAL)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, JOB_RESULTS.sweep)
+            sweep_progress()
+        except Exception as e:
+            logger.warning(f"Results janitor failed: {e}")
+
+
+# =============================================================================
+# Scheduler: общая мощность конвертации, очередь задач, round-robin по строкам
+# =============================================================================
+MAX_ACTIVE_JOBS = max(1, int(os.getenv("MAX_ACTIVE_JOBS", "4")))
+
+
+@dataclass
+class ScheduledJob:
+    key: str
+    state: Optional[ProgressState]
+    job_id: Optional[str]
+    units: Deque[Tuple[Callable, tuple, asyncio.Future]] = field(default_factory=deque)
+    running: int = 0
+    done: int = 0
+
+
+class JobScheduler:
+    """
+    Единый исполнитель на LO_POOL_SIZE потоков. Не больше MAX_ACTIVE_JOBS задач
+    выполняются одновременно, остальные ждут в очереди FIFO. Между активными
+    задачами свободные слоты раздаются по кругу, по одной единице работы
+    (строке или пакету) — маленькая задача не ждёт, пока большая дойдёт до конца.
+    """
+
+    def __init__(self, slots: int, max_active: int):
+        self.slots = slots
+        self.max_active = max_active
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._active: "OrderedDict[str, ScheduledJob]" = OrderedDict()
+        self._waiting: Deque[Tuple[ScheduledJob, asyncio.Future]] = deque()
+        self._busy = 0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="render")
+        return self._executor
+
+    async def _publish_positions(self) -> None:
+        for pos, (job, _) in enumerate(self._waiting, start=1):
+            if job.state and job.state.queue_position != pos:
+                job.state.queue_position = pos
+                job.state.stage = "queued"
+                job.state.message = f"В очереди: {pos}"
+                await emit(job.job_id)
+
+    async def admit(self, job: ScheduledJob) -> None:
+        if len(self._active) < self.max_active and not self._waiting:
+            self._active[job.key] = job
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._waiting.append((job, fut))
+        await self._publish_positions()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if (job, fut) in self._waiting:
+                self._waiting.remove((job, fut))
+                asyncio.ensure_future(self._publish_positions())
+            else:
+                self.release(job)
+            raise
+        if job.state:
+            job.state.queue_position = 0
+            job.state.stage = "processing"
+            job.state.message = "Обработка строк"
+            await emit(job.job_id)
+
+    def release(self, job: ScheduledJob) -> None:
+        if self._active.pop(job.key, None) is None:
+            return
+        while job.units:
+            _, _, fut = job.units.popleft()
+            fut.cancel()
+        while self._waiting and len(self._active) < self.max_active:
+            nxt, fut = self._waiting.popleft()
+            self._active[nxt.key] = nxt
+            if not fut.done():
+                fut.set_result(None)
+        if self._waiting:
+            asyncio.ensure_future(self._publish_positions())
+
+    def submit(self, job: ScheduledJob, fn: Callable, *args) -> asyncio.Future:
+        fut = asyncio.get_event_loop().create_future()
+        job.units.append((fn, args, fut))
+        self._dispatch()
+        return fut
+
+    def _next_unit(self) -> Optional[Tuple[ScheduledJob, Tuple[Callable, tuple, asyncio.Future]]]:
+        for _ in range(len(self._active)):
+            key, job = next(iter(self._active.items()))
+            self._active.move_to_end(key)
+            while job.units:
+                unit = job.units.popleft()
+                if not unit[2].cancelled():
+                    return job, unit
+        return None
+
+    def _dispatch(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self._busy < self.slots:
+            picked = self._next_unit()
+            if picked is None:
+                return
+            job, (fn, args, fut) = picked
+            self._busy += 1
+            job.running += 1
+            task = loop.run_in_executor(self.executor, fn, *args)
+            task.add_done_callback(lambda t, job=job, fut=fut: self._finished(job, fut, t))
+
+    def _finished(self, job: ScheduledJob, fut: asyncio.Future, task: asyncio.Future) -> None:
+        self._busy -= 1
+        job.running -= 1
+        job.done += 1
+        if not fut.cancelled():
+            if task.exception() is not None:
+                fut.set_exception(task.exception())
+            else:
+                fut.set_result(task.result())
+        self._dispatch()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "slots": self.slots,
+            "busy": self._busy,
+            "max_active_jobs": self.max_active,
+            "active_jobs": len(self._active),
+            "queued_jobs": len(self._waiting),
+            "queued_units": sum(len(j.units) for j in self._active.values()),
+        }
+
+
+SCHEDULER = JobScheduler(LO_POOL_SIZE, MAX_ACTIVE_JOBS)
+
+
+# =============================================================================
+# Pipeline: этапы строки через ограниченные очереди, пулы — на приложение
+# =============================================================================
+RENDER_WORKERS = max(1, int(os.getenv("RENDER_WORKERS", str(min(2, os.cpu_count() or 1)))))  # DOCX-шаблонизация
+RENDER_PROCESSES = max(0, int(os.getenv("RENDER_PROCESSES", "0")))  # >0 — DOCX в пуле процессов, мимо GIL
+ARCHIVE_WORKERS = max(1, int(os.getenv("ARCHIVE_WORKERS", str(min(MAX_ACTIVE_JOBS, os.cpu_count() or 1)))))
+PIPELINE_QUEUE_SIZE = max(1, int(os.getenv("PIPELINE_QUEUE_SIZE", "4")))  # единиц работы между этапами
+
+
+class StageExecutors:
+    """
+    Пулы этапов конвейера — одни на всё приложение и создаются при старте, а
+    не на запрос. Этапы из processes получают ProcessPoolExecutor (spawn:
+    форк процесса с потоками пула LibreOffice небезопасен), остальные — потоки.
+    Конвертация идёт через SCHEDULER (слоты LO_POOL).
+    """
+
+    def __init__(self, sizes: Dict[str, int], processes: Dict[str, Callable[[], None]]):
+        self.sizes = dict(sizes)
+        self.processes = dict(processes)  # этап -> initializer процесса
+        self._pools: Dict[str, Executor] = {}
+        self._lock = Lock()
+
+    def _create(self, stage: str) -> Executor:
+        if stage in self.processes:
+            import multiprocessing
+            return ProcessPoolExecutor(max_workers=self.sizes[stage], mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=self.processes[stage])
+        return ThreadPoolExecutor(max_workers=self.sizes[stage], thread_name_prefix=stage)
+
+    def get(self, stage: str) -> Executor:
+        pool = self._pools.get(stage)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(stage)
+                if pool is None:
+                    pool = self._pools[stage] = self._create(stage)
+        return pool
+
+    def start(self) -> None:
+        for stage in self.sizes:
+            self.get(stage)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for pool in self._pools.values():
+                pool.shutdown(wait=False, cancel_futures=True)
+            self._pools.clear()
+
+
+# parse держит поток на всё чтение файла — по одному на активную задачу
+EXECUTORS = StageExecutors(
+    {"parse": MAX_ACTIVE_JOBS, "render": RENDER_WORKERS, "docx": RENDER_PROCESSES or RENDER_WORKERS,
+     "archive": ARCHIVE_WORKERS},
+    processes={"docx": _docx_worker_init} if RENDER_PROCESSES else {},
+)
+DOCX_STAGE_FN = _template_docx_in_worker if RENDER_PROCESSES else template_docx
+
+
+def _start_executors():
+    EXECUTORS.start()
+    SCHEDULER.executor  # пул конвертации тоже создаётся сразу
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    fn: Callable[[Any], Awaitable[Any]]
+    workers: int = 1
+
+
+class Pipeline:
+    """
+    Источник -> этапы -> sink. Этапы связаны asyncio.Queue(maxsize=queue_size),
+    у каждого workers параллельных воркеров. В полёте не больше capacity
+    единиц: источник ждёт, пока sink заберёт готовое, поэтому темп задаёт самый
+    медленный этап, а память не растёт. В sink единицы приходят в порядке
+    источника. Исключение этапа или sink останавливает конвейер и пробрасывается.
+    """
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
 
-def string_width_pt(text: str, size: int) -> float:
-    try:
-        return pdfmetrics.stringWidth(text, FONT_NAME, size)
-    except Exception:
-        return size * max(1, len(text)) * 0.5
+    @property
+    def capacity(self) -> int:
+        return self.queue_size * (len(self.stages) + 1) + sum(st.workers for st in self.stages)
 
-def need_small_variant(full_name: str) -> bool:
-    base_size = 28
-    # блок имени в шаблоне — 620 px = 465 pt; замер идёт regular, рендер bold,
-    # поэтому берём с запасом
-    max_width = 540
-    w = string_width_pt(full_name, base_size)
-    return w > max_width
+    async def run(self, source: AsyncIterator[Any], sink: Callable[[Any], Awaitable[None]]) -> None:
+        end = object()
+        queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        slots = asyncio.Semaphore(self.capacity)
 
-def sanitize_filename(s: str) -> str:
-    return re.sub(r'[\\/:*?"<>|]+', "_", s).replace(" ", "_")[:100]
+        async def feed() -> None:
+            seq = 0
+            try:
+                while True:
+                    await slots.acquire()
+                    try:
+                        item = await source.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    await queues[0].put((seq, item))
+                    seq += 1
+            finally:
+                aclose = getattr(source, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            await queues[0].put((seq, end))
+
+        async def work(stage: PipelineStage, inbox: asyncio.Queue, outbox: asyncio.Queue, left: List[int]) -> None:
+            while True:
+                seq, item = await inbox.get()
+                if item is end:
+                    # последний воркер этапа передаёт конец дальше, остальным — вернуть в очередь
+                    left[0] -= 1
+                    await (outbox if left[0] == 0 else inbox).put((seq, end))
+                    return
+                await outbox.put((seq, await stage.fn(item)))
+
+        async def drain() -> None:
+            ready: Dict[int, Any] = {}
+            nxt = 0
+            while True:
+                seq, item = await queues[-1].get()
+                if item is end:
+                    return
+                ready[seq] = item
+                while nxt in ready:
+                    await sink(ready.pop(nxt))
+                    nxt += 1
+                    slots.release()
+
+        tasks = [asyncio.ensure_future(feed()), asyncio.ensure_future(drain())]
+        for i, stage in enumerate(self.stages):
+            left = [stage.workers]
+            tasks += [asyncio.ensure_future(work(stage, queues[i], queues[i + 1], left)) for _ in range(stage.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
 
 # =============================================================================
-# DOCX -> PDF (LibreOffice) — СЕРИАЛИЗОВАНО
+# Warmup: холодные издержки платим при старте, а не первой задачей
 # =============================================================================
-def docx_to_pdf_cached(docx_path: str) -> str:
-    abs_docx = os.path.abspath(docx_path)
-    if abs_docx in DOCX_TO_PDF_CACHE:
-        logger.info(f"Using cached PDF for {abs_docx}")
-        return DOCX_TO_PDF_CACHE[abs_docx]
-
-    logger.info(f"Converting DOCX to PDF: {abs_docx}")
-    out_dir = tempfile.mkdtemp(prefix="docx2pdf_")
-
-    libreoffice_paths = [
-        "soffice",
-        r"C:\Program Files\LibreOffice\program\soffice.exe",
-        r"C:\Program Files (x86)\LibreOffice\program\soffice.exe",
-        r"C:\LibreOffice\program\soffice.exe",
-    ]
-    cmd = None
-    for path in libreoffice_paths:
-        try:
-            if path == "soffice":
-                test_cmd = ["soffice", "--version"]
-                subprocess.run(test_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-                cmd = [path]
-                break
-            elif os.path.exists(path):
-                cmd = [path]
-                break
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            continue
-    if cmd is None:
-        raise RuntimeError("LibreOffice not found. Install it or add to PATH.")
-
-    profile_dir = os.path.join(out_dir, "lo_profile")
-    try: os.makedirs(profile_dir, exist_ok=True)
-    except Exception: pass
-    profile_url = "file:///" + os.path.abspath(profile_dir).replace("\\", "/").lstrip("/")
-
-    cmd_with_profile = [
-        cmd[0], "--headless", "--norestore", "--nolockcheck",
-        f"-env:UserInstallation={profile_url}",
-        "--convert-to", "pdf", "--outdir", out_dir, abs_docx,
-    ]
+WARMUP = os.getenv("WARMUP", "0") == "1"
+WARMUP_SAMPLE_DATES = "01.02.24 - 03.02.24"
 
-    last_stdout = last_stderr = b""
-    pdf_path = os.path.join(out_dir, os.path.splitext(os.path.basename(abs_docx))[0] + ".pdf")
-    # сериализация + мягкий ретрай
-    with LO_CONVERT_LOCK:
-        for attempt in range(2):
-            proc = subprocess.run(cmd_with_profile, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=180)
-            last_stdout, last_stderr = proc.stdout, proc.stderr
-            if os.path.exists(pdf_path):
-                break
-            time.sleep(0.5)
 
-    if not os.path.exists(pdf_path):
-        stderr_txt = (last_stderr or b"").decode(errors='ignore')
-        stdout_txt = (last_stdout or b"").decode(errors='ignore')
-        raise RuntimeError(f"LibreOffice convert failed: {stderr_txt or stdout_txt or 'unknown error'}")
+@dataclass
+class WarmupReport:
+    enabled: bool
+    done: bool = False
+    started: float = 0.0
+    finished: float = 0.0
+    steps: Dict[str, float] = field(default_factory=dict)    # шаг -> секунды
+    errors: Dict[str, str] = field(default_factory=dict)
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "ready": self.done,
+            "warmup": self.enabled,
+            "seconds": round((self.finished or time.time()) - self.started, 3) if self.started else 0.0,
+            "steps": {k: round(v, 3) for k, v in self.steps.items()},
+            "errors": self.errors,
+        }
 
-    DOCX_TO_PDF_CACHE[abs_docx] = pdf_path
-    return pdf_path
 
+WARMUP_REPORT = WarmupReport(enabled=WARMUP, done=not WARMUP)
 
-# =============================================================================
-# Render DOCX + точная правка отступов в текстбоксах
-# =============================================================================
-def render_docx_template(
-    docx_path: str,
-    context: Dict[str, str],
-    adjust_online_course_indent: bool = False,
-    course_indent_pts: int = 18,
-) -> bytes:
-    """
-    Рендерит DOCX и (в online-режиме) аккуратно выравнивает:
-      - курс: общая позиция + первая строка чуть левее второй (через w:ind/@w:hanging)
-      - дату: немного правее
-    Делает «репак» архива DOCX без дублей частей (LibreOffice не падает).
-    """
-    import zipfile, shutil
-    from xml.etree import ElementTree as ET
 
-    # 1) Рендер шаблона во временный DOCX
-    doc = DocxTemplate(docx_path)
-    doc.render(context)
-    tmp_docx = tempfile.NamedTemporaryFile(suffix=".docx", delete=False)
-    doc.save(tmp_docx.name)
-    tmp_docx.close()
+def _warmup_contexts() -> Dict[str, Dict[str, str]]:
+    """Путь шаблона -> пробный контекст; по одному на каждый из шаблонов DOCX_MAP."""
+    context = format_dates_for_jinja(parse_dates(WARMUP_SAMPLE_DATES))
+    context.update({
+        "Имя": "Иван", "Фамилия": "Петров", "Тренинг": "Warmup",
+        "Идентификатор": "warmup", "Город": "Москва", "Страна": "",
+    })
+    return {os.path.join(TEMPLATES_DIR, name): dict(context) for name in TEMPLATE_KINDS}
 
-    # безопасная замена частей
-    def _repack_docx_replace(path: str, replacements: Dict[str, bytes]) -> None:
-        if not replacements:
-            return
-        tmp_out = tempfile.NamedTemporaryFile(suffix=".docx", delete=False).name
-        with zipfile.ZipFile(path, "r") as zin, zipfile.ZipFile(tmp_out, "w", zipfile.ZIP_DEFLATED) as zout:
-            existing = set()
-            for item in zin.infolist():
-                data = zin.read(item.filename)
-                if item.filename in replacements:
-                    data = replacements[item.filename]
-                zout.writestr(item, data)
-                existing.add(item.filename)
-            for name, data in replacements.items():
-                if name not in existing:
-                    zout.writestr(name, data)
-        shutil.move(tmp_out, path)
-
-    if adjust_online_course_indent:
-        # 2) При необходимости — мягкая правка обычного параграфа (если это не текстбокс)
-        try:
-            from docx import Document
-            from docx.shared import Pt
-            d = Document(tmp_docx.name)
-
-            def all_paragraphs(docx):
-                pars = list(docx.paragraphs)
-                def walk_tables(tables, acc):
-                    for t in tables:
-                        for row in t.rows:
-                            for cell in row.cells:
-                                acc.extend(cell.paragraphs)
-                                if cell.tables:
-                                    walk_tables(cell.tables, acc)
-                walk_tables(docx.tables, pars)
-                return pars
-
-            def norm(s: str) -> str:
-                return " ".join((s or "").split()).lower()
-
-            paragraphs = all_paragraphs(d)
-            target_course = norm((context or {}).get("Тренинг", ""))
-            course_para = None
-            if target_course:
-                head = " ".join(target_course.split()[:3])
-                for p in paragraphs:
-                    if head and head in norm(p.text):
-                        course_para = p
-                        break
-            if course_para is not None:
-                course_para.paragraph_format.left_indent = Pt(course_indent_pts)
-                course_para.paragraph_format.first_line_indent = Pt(0)
-                d.save(tmp_docx.name)
-        except Exception as e:
-            logging.warning(f"Docx paragraph adjust skipped: {e}")
 
-        # 3) Точная настройка внутри текстбоксов
-        try:
-            ns = {
-                "w":   "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
-                "wps": "http://schemas.microsoft.com/office/word/2010/wordprocessingShape",
-                "v":   "urn:schemas-microsoft-com:vml",
-            }
-            # twips: 1 pt = 20 twips; 1 см ≈ 567 twips
-            COURSE_LEFT_TWIPS    = 0    # ОБНУЛЕНО: сдвигало курс вправо
-            COURSE_HANGING_TWIPS = 0    # ОБНУЛЕНО
-            DATE_LEFT_TWIPS      = 0    # ОБНУЛЕНО: сдвигало дату вправо
-
-            def norm(s: str) -> str:
-                return " ".join((s or "").split()).lower()
-
-            course_text = norm((context or {}).get("Тренинг", ""))
-            course_head = " ".join(course_text.split()[:3]) if course_text else ""
-            year  = str((context or {}).get("Год", "")).strip()
-            month = norm((context or {}).get("Месяц1", ""))
-            city  = norm((context or {}).get("Город", ""))
-
-            def is_course_para(text: str) -> bool:
-                return bool(course_head) and (course_head in text)
-
-            def is_date_para(text: str) -> bool:
-                return (bool(month) and month in text and bool(year) and year in text) or (bool(city) and city in text)
-
-            replacements: Dict[str, bytes] = {}
-            with zipfile.ZipFile(tmp_docx.name, "r") as z:
-                parts = ["word/document.xml"] + [n for n in z.namelist() if n.startswith("word/header") and n.endswith(".xml")]
-                for part in parts:
-                    try:
-                        xml = z.read(part)
-                    except KeyError:
-                        continue
-                    root = ET.fromstring(xml)
-
-                    def para_text(p):
-                        return norm("".join(t.text or "" for t in p.findall(".//w:t", ns)))
-
-                    changed = False
-                    # DrawingML textboxes
-                    for p in root.findall(".//wps:txbx//w:p", ns):
-                        t = para_text(p)
-                        if is_course_para(t):
-                            pPr = p.find("w:pPr", ns) or ET.SubElement(p, "{%s}pPr" % ns["w"])
-                            ind = pPr.find("w:ind", ns) or ET.SubElement(pPr, "{%s}ind" % ns["w"])
-                            ind.set("{%s}left" % ns["w"], str(COURSE_LEFT_TWIPS))
-                            ind.set("{%s}hanging" % ns["w"], str(COURSE_HANGING_TWIPS))
-                            if ind.get("{%s}firstLine" % ns["w"]):
-                                ind.attrib.pop("{%s}firstLine" % ns["w"], None)
-                            changed = True
-                        elif is_date_para(t):
-                            pPr = p.find("w:pPr", ns) or ET.SubElement(p, "{%s}pPr" % ns["w"])
-                            ind = pPr.find("w:ind", ns) or ET.SubElement(pPr, "{%s}ind" % ns["w"])
-                            ind.set("{%s}left" % ns["w"], str(DATE_LEFT_TWIPS))
-                            ind.set("{%s}firstLine" % ns["w"], "0")
-                            if ind.get("{%s}hanging" % ns["w"]):
-                                ind.attrib.pop("{%s}hanging" % ns["w"], None)
-                            changed = True
-
-                    # legacy VML textboxes
-                    for p in root.findall(".//v:textbox//w:p", ns):
-                        t = para_text(p)
-                        if is_course_para(t):
-                            pPr = p.find("w:pPr", ns) or ET.SubElement(p, "{%s}pPr" % ns["w"])
-                            ind = pPr.find("w:ind", ns) or ET.SubElement(pPr, "{%s}ind" % ns["w"])
-                            ind.set("{%s}left" % ns["w"], str(COURSE_LEFT_TWIPS))
-                            ind.set("{%s}hanging" % ns["w"], str(COURSE_HANGING_TWIPS))
-                            if ind.get("{%s}firstLine" % ns["w"]):
-                                ind.attrib.pop("{%s}firstLine" % ns["w"], None)
-                            changed = True
-                        elif is_date_para(t):
-                            pPr = p.find("w:pPr", ns) or ET.SubElement(p, "{%s}pPr" % ns["w"])
-                            ind = pPr.find("w:ind", ns) or ET.SubElement(pPr, "{%s}ind" % ns["w"])
-                            ind.set("{%s}left" % ns["w"], str(DATE_LEFT_TWIPS))
-                            ind.set("{%s}firstLine" % ns["w"], "0")
-                            if ind.get("{%s}hanging" % ns["w"]):
-                                ind.attrib.pop("{%s}hanging" % ns["w"], None)
-                            changed = True
-
-                    if changed:
-                        replacements[part] = ET.tostring(root, encoding="utf-8", xml_declaration=True)
-
-            _repack_docx_replace(tmp_docx.name, replacements)
-        except Exception as e:
-            logging.warning(f"Textbox indent adjust skipped: {e}")
+def _warm_fonts() -> None:
+    # метрики и подмножества глифов reportlab строятся при первом обращении к шрифту
+    from reportlab.pdfgen import canvas
+    from reportlab.pdfbase import pdfmetrics
 
-    # 4) Конвертация в PDF
-    pdf_path = docx_to_pdf_cached(tmp_docx.name)
-    with open(pdf_path, "rb") as f:
-        pdf_bytes = f.read()
-    os.unlink(tmp_docx.name)
-    return pdf_bytes
+    ensure_fonts()
+    for name in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.stringWidth("Warmup Прогрев 0123", name, 12)
+    c = canvas.Canvas(io.BytesIO())
+    c.setFont(FONT_NAME, 12)
+    c.drawString(10, 10, "Warmup Прогрев")
+    c.save()
 
 
-# =============================================================================
-# SSE progress
-# =============================================================================
-@dataclass
-class ProgressState:
-    total: int = 0
-    processed: int = 0
-    stage: str = "init"  # init | uploading | processing | zipping | done | error
-    message: str = ""
-    errors: int = 0
-    created: float = field(default_factory=lambda: time.time())
-    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+def _warm_templates(contexts: Dict[str, Dict[str, str]]) -> None:
+    for path, context in contexts.items():
+        if os.path.exists(path):
+            TEMPLATE_REGISTRY.render_body(path, context)
 
-PROGRESS: Dict[str, ProgressState] = {}
-JOB_RESULTS: Dict[str, bytes] = {}
 
-def get_progress(job_id: str) -> ProgressState:
-    if job_id not in PROGRESS:
-        PROGRESS[job_id] = ProgressState()
-    return PROGRESS[job_id]
+def _warm_conversions(contexts: Dict[str, Dict[str, str]]) -> None:
+    """По одной конвертации на шаблон мимо RENDER_CACHE: профили слотов пула, шрифты LibreOffice."""
+    items = [(p, c) for p, c in contexts.items() if os.path.exists(p)]
+    with ThreadPoolExecutor(max_workers=LO_POOL_SIZE) as pool:
+        results = list(pool.map(lambda item: _render_rows_uncached(item[0], [item[1]], "docx")[0], items))
+    failed = [os.path.basename(p) for (p, _), r in zip(items, results) if isinstance(r, Exception)]
+    if failed:
+        raise RuntimeError(f"Conversion failed for {', '.join(failed)}")
 
-def snapshot(state: ProgressState) -> Dict[str, object]:
-    percent = int(state.processed * 100 / max(1, state.total)) if state.total > 0 else 0
-    return {
-        "total": state.total,
-        "processed": state.processed,
-        "percent": percent,
-        "stage": state.stage,
-        "message": state.message,
-        "errors": state.errors,
-    }
 
-async def emit(job_id: str):
-    state = get_progress(job_id)
-    await state.queue.put("update")
+def _warm_docx_workers() -> None:
+    """Поднимает процессы пула docx заранее: каждый компилирует шаблоны в initializer."""
+    pool = EXECUTORS.get("docx")
+    for fut in [pool.submit(os.getpid) for _ in range(RENDER_PROCESSES)]:
+        fut.result()
+
+
+def run_warmup(report: WarmupReport) -> None:
+    report.started = time.time()
+    contexts = _warmup_contexts()
+    steps: List[Tuple[str, Callable[[], object]]] = [
+        ("converter", find_soffice),
+        ("fonts", _warm_fonts),
+        ("templates", lambda: _warm_templates(contexts)),
+        ("convert", lambda: _warm_conversions(contexts)),
+    ]
+    if RENDER_PROCESSES:
+        steps.insert(3, ("workers", _warm_docx_workers))
+    for name, step in steps:
+        t0 = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            report.errors[name] = str(e)
+            logger.warning(f"Warmup step {name} failed: {e}")
+        report.steps[name] = time.perf_counter() - t0
+    report.finished = time.time()
+    report.done = True
+    logger.info(f"Warmup finished in {report.finished - report.started:.1f}s: "
+                + ", ".join(f"{k}={v:.2f}s" for k, v in report.steps.items()))
 
-@app.get("/progress/{job_id}")
-async def progress_stream(job_id: str):
-    async def event_gen():
-        state = get_progress(job_id)
-        await emit(job_id)
-        while True:
-            try:
-                _ = await asyncio.wait_for(state.queue.get(), timeout=15.0)
-            except asyncio.TimeoutError:
-                yield "event: ping\ndata: {}\n\n"
-                continue
-            data = json.dumps(snapshot(state), ensure_ascii=False)
-            yield f"data: {data}\n\n"
-            if state.stage in ("done", "error"):
-                break
-    return StreamingResponse(event_gen(), media_type="text/event-stream")
+
+def _start_warmup():
+    if WARMUP:
+        asyncio.get_event_loop().run_in_executor(None, run_warmup, WARMUP_REPORT)
 
 
 # =============================================================================
@@ -813,6 +3428,63 @@ async def progress_stream(job_id: str):
 def health() -> PlainTextResponse:
     return PlainTextResponse("ok")
 
+@app.get("/ready")
+def ready() -> JSONResponse:
+    """Готовность к трафику: после прогрева (если WARMUP=1), с длительностью каждого шага."""
+    report = WARMUP_REPORT.snapshot()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+@app.get("/cache-stats")
+def cache_stats():
+    return RENDER_CACHE.stats()
+
+@app.get("/result-stats")
+def result_stats():
+    return JOB_RESULTS.stats()
+
+@app.get("/workspace-stats")
+def workspace_stats():
+    return WORKSPACES.stats()
+
+@app.get("/pool-stats")
+def pool_stats():
+    return LO_POOL.stats()
+
+@app.get("/metrics")
+def metrics() -> PlainTextResponse:
+    cache = RENDER_CACHE.stats()
+    sched = SCHEDULER.stats()
+    results = JOB_RESULTS.stats()
+    workspace = WORKSPACES.stats()
+    pool = LO_POOL.stats()
+    lines: List[str] = []
+    lines += STAGE_SECONDS.render()
+    lines += ROWS_TOTAL.render()
+    lines += [
+        "# HELP certgen_render_cache_requests_total Render cache lookups by result",
+        "# TYPE certgen_render_cache_requests_total counter",
+        f'certgen_render_cache_requests_total{{result="hit"}} {cache["hits"]}',
+        f'certgen_render_cache_requests_total{{result="miss"}} {cache["misses"]}',
+        "# HELP certgen_render_cache_errors_total Render cache writes that failed",
+        "# TYPE certgen_render_cache_errors_total counter",
+        f'certgen_render_cache_errors_total {cache["errors"]}',
+    ]
+    lines += gauge_lines("certgen_render_cache_hit_ratio", "Render cache hit ratio", cache["hit_ratio"])
+    lines += gauge_lines("certgen_render_cache_bytes", "Bytes held by the render cache", cache["bytes"])
+    lines += gauge_lines("certgen_active_jobs", "Jobs being processed", sched["active_jobs"])
+    lines += gauge_lines("certgen_queued_jobs", "Jobs waiting for admission", sched["queued_jobs"])
+    lines += gauge_lines("certgen_queued_rows", "Render units submitted but not started", sched["queued_units"])
+    lines += gauge_lines("certgen_busy_slots", "Render slots in use", sched["busy"])
+    lines += gauge_lines("certgen_result_bytes", "Bytes of retained job results", results["bytes"])
+    lines += gauge_lines("certgen_result_entries", "Retained job results", results["entries"])
+    lines += gauge_lines("certgen_workspace_bytes", "Bytes of conversion files in the workspace", workspace["bytes"])
+    lines += gauge_lines("certgen_workspace_jobs", "Jobs holding a workspace directory", workspace["active_jobs"])
+    lines += gauge_lines("certgen_workspace_free_bytes", "Free space on the workspace filesystem", workspace["disk_free"])
+    lines += gauge_lines("certgen_lo_uno", "1 if LibreOffice slots are driven over UNO", int(pool["uno"]))
+    lines += gauge_lines("certgen_lo_restarts", "LibreOffice slot restarts", pool["restarts"])
+    lines += gauge_lines("certgen_lo_timeouts", "LibreOffice conversions killed by LO_CONVERT_TIMEOUT", pool["timeouts"])
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 @app.get("/sample-excel")
 def sample_excel():
     root = os.path.abspath(os.path.join(BASE_DIR, ".."))
@@ -844,11 +3516,509 @@ def check_templates():
     return {
         "available_templates": available_templates,
         "missing_templates": missing_templates,
+        "overlay_unsupported_templates": overlay_unsupported_templates(),
+        "overlay_layouts_file": OVERLAY_LAYOUTS_FILE if os.path.exists(OVERLAY_LAYOUTS_FILE) else None,
         "templates_dir": TEMPLATES_DIR,
         "templates_dir_exists": os.path.exists(TEMPLATES_DIR)
     }
 
 
+OVERLAY_SAMPLE_DATES = {
+    "duration_day": "01.02.24 - 03.02.24",
+    "2day_2month": "30.01.24 - 02.02.24",
+    "1day_1month": "01.02.24",
+}
+
+@app.get("/overlay-compare")
+def overlay_compare(group: str = "online", kind: str = "duration_day", variant: str = "normal"):
+    """ZIP с эталоном (LibreOffice) и overlay-версией одного шаблона для визуальной сверки."""
+    try:
+        docx_path = os.path.join(TEMPLATES_DIR, DOCX_MAP[group][kind][variant])
+    except KeyError:
+        return PlainTextResponse("Unknown template", status_code=404)
+    context = format_dates_for_jinja(parse_dates(OVERLAY_SAMPLE_DATES[kind]))
+    context.update({"Имя": "Иван", "Фамилия": "Петров", "Тренинг": "Пример названия тренинга",
+                    "Идентификатор": "TEST-0001", "Страна": ""})
+    mem_zip = io.BytesIO()
+    with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("reference.pdf", render_docx_template(docx_path, context))
+        if get_overlay_layout(docx_path) is not None:
+            zf.writestr("overlay.pdf", render_overlay_pdf(docx_path, context))
+    return Response(
+        content=mem_zip.getvalue(),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=overlay-compare.zip"},
+    )
+
+
+# =============================================================================
+# Единый PDF и оптимизация: страницы дописываются по мере готовности,
+# одинаковые объекты — один раз
+# =============================================================================
+PDF_QUALITIES = ("web", "print")
+PDF_WEB_DPI = int(os.getenv("PDF_WEB_DPI", "150"))  # 0 — не пережимать изображения
+_PAGE_INHERITED = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+_TRANSPORT_FILTERS = {"/ASCII85Decode", "/ASCIIHexDecode", "/FlateDecode"}
+_SUBSET_PREFIX_RE = re.compile(r"^/?[A-Z]{6}\+")
+
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+
+
+class MergedPdfWriter:
+    """
+    Пишет PDF объект за объектом сразу в fileobj (нужен только write).
+    Одинаковые по содержимому объекты — шрифты, фон шаблона, ExtGState —
+    пишутся один раз; в памяти остаются лишь смещения и хэши. Интерфейс
+    writestr совместим с ZipFile, чтобы подставляться в _process_rows вместо
+    архива.
+
+    compress — сжать потоки без фильтра; object_streams — сложить словари в
+    сжатый object stream (они держатся в памяти до close, поэтому только для
+    небольших документов); image_dpi — пережать изображения выше этого DPI.
+    """
+
+    _CATALOG = 1
+    _PAGES = 2
+
+    def __init__(self, fileobj, compress: bool = False, object_streams: bool = False, image_dpi: int = 0):
+        self._f = fileobj
+        self._pos = 0
+        self._offsets: Dict[int, int] = {}
+        self._packed: List[Tuple[int, bytes]] = []
+        self._next = 3
+        self._by_hash: Dict[bytes, int] = {}
+        self._pages: List[int] = []
+        self._page_width = 0.0
+        self.compress = compress
+        self.object_streams = object_streams
+        self.image_dpi = image_dpi if HAS_PIL else 0
+        self.deduplicated = 0
+        self.unsubset_fonts: set = set()
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self) -> "MergedPdfWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _write(self, data: bytes) -> None:
+        self._f.write(data)
+        self._pos += len(data)
+
+    def _emit(self, num: int, body: bytes, is_stream: bool = True) -> None:
+        if self.object_streams and not is_stream:
+            self._packed.append((num, body))
+            return
+        self._offsets[num] = self._pos
+        self._write(b"%d 0 obj\n" % num + body + b"\nendobj\n")
+
+    @staticmethod
+    def _serialize(obj) -> bytes:
+        buf = io.BytesIO()
+        obj.write_to_stream(buf, None)
+        return buf.getvalue()
+
+    def _check_font(self, obj: "DictionaryObject") -> None:
+        if obj.get("/Type") == "/FontDescriptor" and any(k in obj for k in ("/FontFile", "/FontFile2", "/FontFile3")):
+            name = str(obj.get("/FontName", ""))
+            if not _SUBSET_PREFIX_RE.match(name) and name not in self.unsubset_fonts:
+                self.unsubset_fonts.add(name)
+                logger.warning(f"PDF embeds full font program {name} (not subset)")
+
+    def _downsample(self, obj: "StreamObject") -> Optional[Tuple[bytes, Dict[str, object]]]:
+        """Новые (данные, поля словаря) для изображения выше image_dpi; None — оставить как есть."""
+        from PIL import Image
+        from PyPDF2.generic import ArrayObject, NameObject, NumberObject
+
+        width, height = int(obj.get("/Width", 0)), int(obj.get("/Height", 0))
+        if not (self.image_dpi and self._page_width and width and height):
+            return None
+        # фон сертификата занимает страницу целиком — DPI считаем по ширине страницы
+        dpi = width / (self._page_width / 72.0)
+        if dpi <= self.image_dpi * 1.1 or obj.get("/BitsPerComponent") != 8 or obj.get("/ImageMask"):
+            return None
+        filters = obj.get("/Filter")
+        filters = list(filters) if isinstance(filters, ArrayObject) else [filters]
+        colorspace = obj.get("/ColorSpace")
+        modes = {"/DeviceRGB": "RGB", "/DeviceGray": "L"}
+        jpeg = filters[-1] == "/DCTDecode"
+        if colorspace not in modes or not set(filters[:-1] if jpeg else filters) <= _TRANSPORT_FILTERS:
+            return None
+        scale = self.image_dpi / dpi
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # get_data снимает все фильтры, кроме DCT: для JPEG это сам файл JPEG
+        if jpeg:
+            img = Image.open(io.BytesIO(obj.get_data()))
+        else:
+            img = Image.frombytes(modes[colorspace], (width, height), obj.get_data())
+        img = img.convert(modes[colorspace]).resize(size, Image.LANCZOS)
+        if jpeg:
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=85, optimize=True)
+            data = buf.getvalue()
+        else:
+            data = zlib.compress(img.tobytes(), 9)
+        if len(data) >= len(obj._data):
+            return None
+        return data, {
+            "/Width": NumberObject(size[0]),
+            "/Height": NumberObject(size[1]),
+            "/Filter": NameObject("/DCTDecode" if jpeg else "/FlateDecode"),
+        }
+
+    @staticmethod
+    def _compress_stream(stream: "StreamObject") -> None:
+        """Снимает текстовые кодировки (ASCII85/Hex) и сжимает несжатые потоки."""
+        from PyPDF2.filters import ASCII85Decode, ASCIIHexDecode
+        from PyPDF2.generic import ArrayObject, NameObject
+
+        filters = stream.get("/Filter")
+        filters = list(filters) if isinstance(filters, ArrayObject) else ([filters] if filters else [])
+        if filters and filters[0] in ("/ASCII85Decode", "/ASCIIHexDecode") and not isinstance(stream.get("/DecodeParms"), ArrayObject):
+            codec = ASCII85Decode if filters[0] == "/ASCII85Decode" else ASCIIHexDecode
+            stream._data = codec.decode(stream._data)
+            filters = filters[1:]
+        if not filters and len(stream._data) > 64:
+            stream._data = zlib.compress(stream._data, 9)
+            filters = ["/FlateDecode"]
+        if len(filters) > 1:
+            stream[NameObject("/Filter")] = ArrayObject(NameObject(f) for f in filters)
+        elif filters:
+            stream[NameObject("/Filter")] = NameObject(filters[0])
+        elif "/Filter" in stream:
+            del stream["/Filter"]
+
+    def _copy(self, obj, memo: Dict[int, Optional[int]], forced: Dict[int, int], skip=()):
+        """Копия объекта с перенумерованными ссылками (зависимости пишутся раньше)."""
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+        if isinstance(obj, IndirectObject):
+            return IndirectObject(self._ref(obj, memo, forced), 0, None)
+        if isinstance(obj, StreamObject):
+            new = StreamObject()
+            new._data = obj._data
+            replaced = self._downsample(obj) if obj.get("/Subtype") == "/Image" else None
+            for k, v in obj.items():
+                if k != "/Length" and not (replaced and k == "/DecodeParms"):
+                    new[NameObject(k)] = self._copy(v, memo, forced)
+            if replaced:
+                new._data, fields = replaced
+                new.update({NameObject(k): v for k, v in fields.items()})
+            elif self.compress:
+                self._compress_stream(new)
+            return new
+        if isinstance(obj, DictionaryObject):
+            new = DictionaryObject()
+            for k, v in obj.items():
+                if k not in skip:
+                    new[NameObject(k)] = self._copy(v, memo, forced)
+            self._check_font(new)
+            return new
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(v, memo, forced) for v in obj)
+        return obj
+
+    def _ref(self, ref: "IndirectObject", memo: Dict[int, Optional[int]], forced: Dict[int, int]) -> int:
+        from PyPDF2.generic import StreamObject
+
+        key = ref.idnum
+        if key in memo:
+            num = memo[key]
+            if num is None:
+                # цикл ссылок: номер выдаём заранее, такой объект не дедуплицируется
+                num = forced[key] = self._next
+                self._next += 1
+                memo[key] = num
+            return num
+        memo[key] = None
+        copy = self._copy(ref.get_object(), memo, forced)
+        body = self._serialize(copy)
+        is_stream = isinstance(copy, StreamObject)
+        if key in forced:
+            num = forced.pop(key)
+        else:
+            digest = hashlib.sha256(body).digest()
+            num = self._by_hash.get(digest)
+            if num is not None:
+                self.deduplicated += 1
+                memo[key] = num
+                return num
+            num = self._by_hash[digest] = self._next
+            self._next += 1
+        memo[key] = num
+        self._emit(num, body, is_stream)
+        return num
+
+    def add_pdf(self, pdf_bytes: bytes) -> None:
+        from PyPDF2 import PdfReader
+        from PyPDF2.generic import IndirectObject, NameObject
+
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        memo: Dict[int, Optional[int]] = {}
+        forced: Dict[int, int] = {}
+        for page in reader.pages:
+            self._page_width = float(page.mediabox.width)
+            page_obj = page.get_object()
+            page_dict = self._copy(page_obj, memo, forced, skip=("/Parent",))
+            parent = page_obj.get("/Parent")
+            for key in _PAGE_INHERITED:
+                node = parent.get_object() if parent is not None else None
+                while key not in page_dict and node is not None:
+                    if key in node:
+                        page_dict[NameObject(key)] = self._copy(node[key], memo, forced)
+                    node = node.get("/Parent").get_object() if "/Parent" in node else None
+            page_dict[NameObject("/Parent")] = IndirectObject(self._PAGES, 0, None)
+            num = self._next
+            self._next += 1
+            self._emit(num, self._serialize(page_dict), is_stream=False)
+            self._pages.append(num)
+
+    def writestr(self, name: str, data: bytes) -> None:
+        self.add_pdf(data)
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def close(self) -> None:
+        kids = b" ".join(b"%d 0 R" % n for n in self._pages)
+        self._emit(self._PAGES, b"<< /Type /Pages /Kids [ " + kids + b" ] /Count %d >>" % len(self._pages), False)
+        self._emit(self._CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self._PAGES, False)
+        if self.object_streams:
+            self._close_with_object_stream()
+            return
+        xref_pos = self._pos
+        lines = [b"xref\n0 %d\n" % self._next, b"0000000000 65535 f \n"]
+        for num in range(1, self._next):
+            offset = self._offsets.get(num)
+            lines.append(b"%010d 00000 n \n" % offset if offset is not None else b"0000000000 65535 f \n")
+        self._write(b"".join(lines))
+        self._write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self._next, self._CATALOG, xref_pos))
+
+    def _close_with_object_stream(self) -> None:
+        # PDF 1.5: словари — в одном сжатом /ObjStm, таблица ссылок — xref stream
+        stm_num, xref_num = self._next, self._next + 1
+        size = self._next + 2
+        header = b" ".join(b"%d %d" % (num, off) for num, off in self._offsets_in_stream()) + b"\n"
+        payload = zlib.compress(header + b"\n".join(body for _, body in self._packed), 9)
+        self._offsets[stm_num] = self._pos
+        self._write(b"%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\nstream\n"
+                    % (stm_num, len(self._packed), len(header), len(payload)) + payload + b"\nendstream\nendobj\n")
+        packed_index = {num: i for i, (num, _) in enumerate(self._packed)}
+        self._offsets[xref_num] = self._pos
+        rows = []
+        for num in range(size):
+            if num in packed_index:
+                rows.append(b"\x02" + stm_num.to_bytes(4, "big") + packed_index[num].to_bytes(2, "big"))
+            elif num in self._offsets:
+                rows.append(b"\x01" + self._offsets[num].to_bytes(4, "big") + b"\x00\x00")
+            else:
+                rows.append(b"\x00" + b"\x00" * 4 + b"\xff\xff")
+        data = zlib.compress(b"".join(rows), 9)
+        self._write(b"%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root %d 0 R /Filter /FlateDecode /Length %d >>\nstream\n"
+                    % (xref_num, size, self._CATALOG, len(data)) + data + b"\nendstream\nendobj\n")
+        self._write(b"startxref\n%d\n%%%%EOF\n" % self._offsets[xref_num])
+
+    def _offsets_in_stream(self) -> Iterator[Tuple[int, int]]:
+        offset = 0
+        for num, body in self._packed:
+            yield num, offset
+            offset += len(body) + 1
+
+
+def pick_quality(quality: Optional[str]) -> str:
+    """По умолчанию print — PDF как из LibreOffice; web только по явному запросу."""
+    return quality if quality in PDF_QUALITIES else "print"
+
+
+def optimize_pdf(pdf_bytes: bytes, quality: str) -> bytes:
+    """
+    web — пересборка с дедупликацией объектов, сжатием потоков, object streams
+    и пережатием изображений до PDF_WEB_DPI; print — без изменений. Если
+    результат не меньше исходного, возвращается исходный.
+    """
+    if quality != "web":
+        return pdf_bytes
+    buf = io.BytesIO()
+    with STAGE_SECONDS.time(stage="optimize"):
+        with MergedPdfWriter(buf, compress=True, object_streams=True, image_dpi=PDF_WEB_DPI) as writer:
+            writer.add_pdf(pdf_bytes)
+    optimized = buf.getvalue()
+    return optimized if len(optimized) < len(pdf_bytes) else pdf_bytes
+
+
+@contextmanager
+def open_output(fileobj, output: str) -> Iterator[Union[zipfile.ZipFile, MergedPdfWriter]]:
+    """ZIP с отдельными PDF или один склеенный PDF — оба принимают writestr()."""
+    if output == "pdf":
+        with MergedPdfWriter(fileobj) as writer:
+            yield writer
+    else:
+        with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zf:
+            yield zf
+
+
+# =============================================================================
+# Incremental regeneration
+# =============================================================================
+MANIFEST_NAME = "manifest.json"
+
+
+class JobManifest:
+    """
+    Манифест задачи: ID сертификата -> ключ контекста рендера (RenderCache.make_key,
+    включает шаблон, режим и движок) и имя записи в архиве. Кладётся в ZIP рядом с PDF.
+    """
+
+    VERSION = 1
+
+    def __init__(self, mode: str, engine: str, quality: str, entries: Optional[Dict[str, Dict[str, str]]] = None):
+        self.mode = mode
+        self.engine = engine
+        self.quality = quality
+        self.entries: Dict[str, Dict[str, str]] = entries if entries is not None else {}
+
+    def add(self, cert_id: str, ckey: str, fname: str) -> None:
+        self.entries.setdefault(cert_id, {"hash": ckey, "entry": fname})
+
+    def to_json(self) -> bytes:
+        payload = {
+            "version": self.VERSION,
+            "mode": self.mode,
+            "engine": self.engine,
+            "quality": self.quality,
+            "templates": template_set_version(),
+            "entries": self.entries,
+        }
+        return json.dumps(payload, ensure_ascii=False, indent=1, sort_keys=True).encode("utf-8")
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "JobManifest":
+        try:
+            payload = json.loads(data.decode("utf-8"))
+            entries = {str(k): {"hash": str(v["hash"]), "entry": str(v["entry"])}
+                       for k, v in payload["entries"].items()}
+            return cls(str(payload["mode"]), str(payload["engine"]), str(payload["quality"]), entries)
+        except (UnicodeDecodeError, ValueError, KeyError, TypeError, AttributeError):
+            raise ValueError("Некорректный манифест задачи")
+
+
+_ZIP_RAW_COPY = all(hasattr(zipfile, a) for a in (
+    "structFileHeader", "sizeFileHeader", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH"))
+
+
+def _read_raw_zip_entry(src: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    """Читает сжатые данные записи как есть (через внутренности zipfile)."""
+    with src._lock:
+        src.fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+        src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        raw = src.fp.read(info.compress_size)
+    if len(raw) != info.compress_size:
+        raise zipfile.BadZipFile(f"Обрезанная запись {info.filename}")
+    return raw
+
+
+def _copy_zip_entry(src: zipfile.ZipFile, name: str, dst: zipfile.ZipFile, arcname: str) -> None:
+    """
+    Переносит запись из архива в архив как есть, без распаковки и повторного сжатия.
+    Если внутренности zipfile недоступны или копирование не удалось до записи
+    в dst — запись распаковывается и пишется заново через writestr.
+    """
+    info = src.getinfo(name)
+    zinfo = zipfile.ZipInfo(arcname, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    raw = None
+    if _ZIP_RAW_COPY and all(hasattr(z, a) for z in (src, dst) for a in ("_lock", "fp")) \
+            and hasattr(dst, "_writecheck"):
+        try:
+            raw = _read_raw_zip_entry(src, info)
+        except Exception as e:
+            logger.warning(f"Прямое копирование {name} не удалось, перезапись: {e}")
+    if raw is None:
+        dst.writestr(zinfo, src.read(name))
+        return
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    with dst._lock:
+        dst._writecheck(zinfo)
+        dst._didModify = True
+        zinfo.header_offset = dst.fp.tell()
+        dst.fp.write(zinfo.FileHeader())
+        dst.fp.write(raw)
+        dst.filelist.append(zinfo)
+        dst.NameToInfo[zinfo.filename] = zinfo
+        dst.start_dir = dst.fp.tell()
+
+
+class PriorJob:
+    """
+    Предыдущая задача для инкрементальной генерации. С архивом неизменённые PDF
+    копируются из него; с одним манифестом — пропускаются (на выходе только изменения).
+    """
+
+    def __init__(self, manifest: JobManifest, archive: Optional[zipfile.ZipFile] = None):
+        self.manifest = manifest
+        self.archive = archive
+
+    def unchanged(self, cert_id: str, ckey: str) -> Optional[str]:
+        """Имя записи в прежнем архиве, если контекст строки не изменился."""
+        entry = self.manifest.entries.get(cert_id)
+        if entry is None or entry["hash"] != ckey:
+            return None
+        if self.archive is not None and entry["entry"] not in self.archive.NameToInfo:
+            return None
+        return entry["entry"]
+
+    def close(self) -> None:
+        if self.archive is not None:
+            self.archive.close()
+
+
+def load_prior(
+    base_job: Optional[str],
+    manifest_bytes: Optional[bytes],
+    output: str,
+    quality: str,
+) -> Optional[PriorJob]:
+    """
+    Собирает PriorJob из ссылки на прежнюю задачу и/или загруженного манифеста.
+    ValueError — если на них нельзя опереться (эндпоинты отвечают 400).
+    """
+    if not base_job and not manifest_bytes:
+        return None
+    if output != "zip":
+        raise ValueError("Инкрементальная генерация доступна только для output=zip")
+    archive = None
+    if base_job:
+        result = JOB_RESULTS.get(JOB_STATE.resolve(base_job))
+        if result is None:
+            raise ValueError(f"Результат задачи {base_job} не найден или истёк")
+        if result.output != "zip":
+            raise ValueError(f"Задача {base_job} собрана не в ZIP")
+        archive = zipfile.ZipFile(result.path)
+    try:
+        if not manifest_bytes:
+            if MANIFEST_NAME not in archive.NameToInfo:
+                raise ValueError(f"В архиве задачи {base_job} нет манифеста")
+            manifest_bytes = archive.read(MANIFEST_NAME)
+        manifest = JobManifest.from_json(manifest_bytes)
+    except Exception:
+        if archive is not None:
+            archive.close()
+        raise
+    if manifest.quality != quality:
+        # PDF другого качества не годятся для копирования
+        logger.warning(f"Prior manifest quality {manifest.quality} != {quality}, full regeneration")
+        if archive is not None:
+            archive.close()
+        return None
+    return PriorJob(manifest, archive)
+
+
 # =============================================================================
 # Core: generate (sync) / generate-async
 # =============================================================================
@@ -857,39 +4027,540 @@ async def _as_completed_iter(coros):
         yield fut
 
 
-def _parse_uploaded_table(data: bytes, filename: str) -> List[Dict[str, str]]:
-    """Возвращает строки с полями по исходному CSV/XLSX."""
-    rows_list: List[Dict[str, str]] = []
+ROW_QUEUE_SIZE = int(os.getenv("ROW_QUEUE_SIZE", "256"))  # строк в очереди между разбором и рендером
+DEDUP_RECENT_ROWS = 64  # сколько готовых PDF задачи держать для повторяющихся строк
+
+
+def _detach_upload(upload: UploadFile) -> BinaryIO:
+    """
+    Забирает spooled-файл у UploadFile: FastAPI закрывает загрузки при выходе
+    из обработчика, а фоновая задача читает файл и после ответа.
+    """
+    fileobj = upload.file
+    upload.file = io.BytesIO()
+    fileobj.seek(0)
+    return fileobj
+
+
+def submission_key(fileobj: BinaryIO, mode: str, engine: str, output: str, quality: str, *extra: str) -> str:
+    """Отпечаток задачи: содержимое загрузки, параметры результата и версия шаблонов."""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1 << 16), b""):
+        h.update(chunk)
+    fileobj.seek(0)
+    h.update(json.dumps([mode, engine, output, quality, template_set_version(), *extra]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _job_reusable(job_id: str) -> bool:
+    """Задача ещё выполняется или её результат не истёк."""
+    if JOB_RESULTS.get(job_id) is not None:
+        return True
+    state = PROGRESS.get(job_id)
+    if state is not None:
+        return state.stage not in ("done", "error")
+    if JOB_STATE.shared:
+        record = JOB_STATE.read_progress(job_id)
+        return bool(record) and record[1].get("stage") not in ("done", "error")
+    return False
+
+
+def _xlsx_rows(fileobj: BinaryIO) -> Iterator[List[str]]:
+    from openpyxl import load_workbook
+
+    wb = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            cells = [(c if c is not None else '') for c in row]
+            if any(str(c).strip() for c in cells):
+                yield [str(c) for c in cells]
+    finally:
+        wb.close()
+
+
+def _csv_rows(fileobj: BinaryIO) -> Iterator[List[str]]:
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', errors='ignore', newline='')
+    delim = detect_delimiter(text.read(4096))
+    text.seek(0)
+    for r in csv.reader(text, delimiter=delim):
+        cells = [(c or '').strip() for c in r]
+        if any(cell != '' for cell in cells):
+            yield cells
+
+
+def open_uploaded_table(fileobj: BinaryIO, filename: str) -> Tuple[RowSchema, Iterator[List[str]]]:
+    """
+    Один проход по загруженному CSV/XLSX: заголовок читается сразу (и по нему
+    строится схема), а строки отдаются лениво по мере чтения файла.
+    """
     if (filename or "").lower().endswith((".xlsx", ".xlsm", ".xls")):
         if not HAS_XLSX:
             raise RuntimeError('Поддержка Excel не установлена на сервере')
-        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
-        ws = wb.active
+        rows = _xlsx_rows(fileobj)
         headers: List[str] = []
-        for i, row in enumerate(ws.iter_rows(values_only=True)):
-            cells = [(c if c is not None else '') for c in row]
-            if not any(str(c).strip() for c in cells): continue
-            if not headers:
-                candidate = [str(c).strip() for c in cells]
-                tech = all(h.lower().startswith('column') or h.lower().startswith('unnamed') or h == '' for h in candidate)
-                non_empty = [h for h in candidate if h]
-                if tech or len(non_empty) < 3: continue
-                headers = candidate; continue
-            d: Dict[str, str] = {}
-            for idx, h in enumerate(headers):
-                val = '' if idx >= len(cells) or cells[idx] is None else str(cells[idx])
-                d[h] = val
-            rows_list.append(d)
-        if not headers or not rows_list:
+        for cells in rows:
+            candidate = [c.strip() for c in cells]
+            tech = all(h.lower().startswith('column') or h.lower().startswith('unnamed') or h == '' for h in candidate)
+            non_empty = [h for h in candidate if h]
+            if tech or len(non_empty) < 3: continue
+            headers = candidate
+            break
+        if not headers:
             raise ValueError('Excel: нераспознан заголовок или нет данных')
     else:
-        raw_txt = data.decode('utf-8-sig', errors='ignore')
-        txt, delim = normalize_csv_and_get_delimiter(raw_txt)
-        if not txt:
+        rows = _csv_rows(fileobj)
+        headers = next(rows, [])
+        if not headers:
             raise ValueError('CSV пустой или нераспознанный формат')
-        dict_reader = csv.DictReader(io.StringIO(txt), delimiter=delim)
-        rows_list = [row for row in dict_reader]
-    return rows_list
+        if _is_generic_header(headers):
+            real = next(rows, None)
+            if real is not None:
+                headers = real
+        headers[0] = headers[0].lstrip('\ufeff')
+
+    schema = RowSchema.from_headers(headers)
+    if schema.missing:
+        raise ValueError("Не найдены обязательные колонки: " + ", ".join(schema.missing))
+    for w in schema.warnings():
+        logger.warning(w)
+    return schema, rows
+
+
+def _parse_uploaded_table(data: bytes, filename: str) -> Tuple[RowSchema, List[List[str]]]:
+    """Возвращает схему колонок и все строки исходного CSV/XLSX целиком."""
+    schema, rows = open_uploaded_table(io.BytesIO(data), filename)
+    return schema, list(rows)
+
+
+async def _stream_rows(rows: Iterator[List[str]]) -> AsyncIterator[List[str]]:
+    """
+    Разбор файла идёт в отдельном потоке и кладёт строки в ограниченную очередь:
+    рендер начинается с первой строки, а память не растёт с размером файла.
+    """
+    loop = asyncio.get_event_loop()
+    q: asyncio.Queue = asyncio.Queue(maxsize=ROW_QUEUE_SIZE)
+    stop = Event()
+    done = object()
+
+    def produce() -> None:
+        item: object = done
+        try:
+            for row in rows:
+                if stop.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(q.put(row), loop).result()
+        except Exception as e:
+            item = e
+        if not stop.is_set():
+            asyncio.run_coroutine_threadsafe(q.put(item), loop).result()
+
+    producer = loop.run_in_executor(EXECUTORS.get("parse"), produce)
+    try:
+        while True:
+            item = await q.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        while not producer.done():
+            while not q.empty():
+                q.get_nowait()
+            await asyncio.sleep(0.01)
+
+
+def _prepare_row(
+    row: CertificateRow,
+    mode: str,
+    dates: Optional[DateParser] = None,
+) -> Optional[Tuple[str, Dict[str, str], str]]:
+    """
+    Поля строки -> (путь к шаблону, контекст Jinja, имя PDF в архиве); None — строку
+    пропускаем. dates — разборы «Даты» на задачу; DateParseError, если даты не распознаны.
+    """
+    is_online = (mode == "online")
+    course     = row.course
+    dates_raw  = row.dates
+    first_name = row.first_name
+    last_name  = row.last_name
+    cert_id    = row.id
+    city       = row.city
+    country    = row.country
+
+    if not (course and dates_raw and first_name and last_name and cert_id):
+        return None
+
+    parsed = dates.parse(dates_raw) if dates is not None else ParsedDates.parse(dates_raw)
+    kind = parsed.kind
+    group = "online" if is_online else "print"
+    docx_path = os.path.join(TEMPLATES_DIR, DOCX_MAP[group][kind]["normal"])
+    if not os.path.exists(docx_path):
+        raise FileNotFoundError(f"Template not found: {docx_path}")
+
+    context = parsed.context()
+    context.update({
+        "Имя": first_name,
+        "Фамилия": last_name,
+        "Тренинг": course,
+        "Идентификатор": cert_id,
+        "Город": city or context.get("Город", "Москва"),
+        "Страна": country,
+    })
+    if TEXT_FIT:
+        # один шаблон на вид дат: кегль имени и курса подбирается под длину
+        context.update(fit_context(docx_path, context))
+    elif need_small_variant(docx_path, context):
+        docx_path = os.path.join(TEMPLATES_DIR, DOCX_MAP[group][kind]["small"])
+        if not os.path.exists(docx_path):
+            raise FileNotFoundError(f"Template not found: {docx_path}")
+    fname = f"{sanitize_filename(cert_id)}_{sanitize_filename(last_name)}_{sanitize_filename(first_name)}.pdf"
+    return docx_path, context, fname
+
+
+async def _report_row_error(state: Optional[ProgressState], job_id: Optional[str], row_num: int, e: Exception) -> None:
+    logger.error(f"Error preparing row {row_num}: {str(e)}")
+    if state:
+        state.errors += 1
+        state.message = f"Ошибка в строке {row_num}"
+        await emit(job_id)
+
+
+async def _process_rows(
+    schema: RowSchema,
+    rows: AsyncIterator[List[str]],
+    mode: str,
+    zf: Union[zipfile.ZipFile, MergedPdfWriter],
+    state: Optional[ProgressState],
+    job_id: Optional[str],
+    batch: bool = False,
+    engine: str = "docx",
+    on_entry: Optional[Callable[[], Awaitable[None]]] = None,
+    quality: str = "print",
+    prior: Optional[PriorJob] = None,
+) -> int:
+    """
+    Конвейер строк (см. Pipeline): разбор -> контекст -> render DOCX ->
+    convert (общий планировщик, round-robin между активными задачами) ->
+    запись в архив (или в единый PDF). В пакетном режиме строки группируются
+    по шаблону и каждая группа конвертируется одним вызовом LibreOffice.
+    Строки с одинаковым контекстом рендерятся один раз. on_entry вызывается
+    после каждой записи в архив; quality=web ужимает каждый PDF (см.
+    optimize_pdf). ZIP дополняется манифестом; строки, не изменившиеся
+    относительно prior, не рендерятся. Возвращает число готовых сертификатов
+    (вместе с неизменёнными).
+    """
+    loop = asyncio.get_event_loop()
+    seen = 0
+    processed_count = 0
+    reused = 0
+    unchanged = 0
+    manifest = JobManifest(mode, engine, quality) if isinstance(zf, zipfile.ZipFile) else None
+    dates = DateParser()
+    sizes = PdfSizeStats()
+    # дубли: первая строка с таким ключом ещё в конвейере -> сколько дублей её ждёт;
+    # после записи результат держится в held, пока дубли не дойдут до архива,
+    # а записанные PDF — в небольшом LRU (дальше выручает RENDER_CACHE)
+    inflight: Dict[str, int] = {}
+    held: Dict[str, List] = {}
+    recent: "OrderedDict[str, bytes]" = OrderedDict()
+    job = ScheduledJob(key=f"{job_id or 'anon'}-{id(zf)}", state=state, job_id=job_id)
+
+    async def units() -> AsyncIterator[RenderUnit]:
+        """Этап prepare: строки -> единицы работы; идёт последовательно, в цикле событий."""
+        nonlocal seen, reused, unchanged
+        groups: Dict[str, List[PipelineRow]] = {}
+        grouped: Dict[str, str] = {}     # ckey строки в неотправленной группе -> её шаблон
+        deferred: List[RenderUnit] = []  # дубли пакетного режима ждут, пока отправится их группа
+
+        def flush(docx_path: str) -> List[RenderUnit]:
+            """Полная группа и дубли, которые ждали именно её."""
+            items = groups.pop(docx_path)
+            for item in items:
+                grouped.pop(item.ckey, None)
+            ready = [RenderUnit(docx_path, TEMPLATE_KINDS.get(os.path.basename(docx_path), "unknown"), items)]
+            ready += [dup for dup in deferred if dup.rows[0].ckey not in grouped]
+            deferred[:] = [dup for dup in deferred if dup.rows[0].ckey in grouped]
+            return ready
+        try:
+            async for row in rows:
+                seen += 1
+                row_num = seen
+                if state:
+                    state.total = max(state.total, seen)
+                try:
+                    prepared = _prepare_row(schema.extract(row), mode, dates)
+                except Exception as e:
+                    ROWS_TOTAL.inc(mode=mode, kind="unknown", status="failed")
+                    await _report_row_error(state, job_id, row_num, e)
+                    continue
+                if prepared is None:
+                    ROWS_TOTAL.inc(mode=mode, kind="unknown", status="skipped")
+                    logger.warning(f"Skipping row {row_num}: missing required fields")
+                    continue
+                docx_path, context, fname = prepared
+                kind = TEMPLATE_KINDS.get(os.path.basename(docx_path), "unknown")
+                ckey = RenderCache.make_key(docx_path, mode, engine, context)
+                cert_id = context["Идентификатор"]
+                old_entry = prior.unchanged(cert_id, ckey) if prior else None
+                if old_entry is not None:
+                    unchanged += 1
+                    ROWS_TOTAL.inc(mode=mode, kind=kind, status="unchanged")
+                    if prior.archive is not None:
+                        yield RenderUnit(docx_path, kind, [PipelineRow(row_num, fname, ckey, copy_from=old_entry,
+                                                                       cert_id=cert_id)])
+                    elif manifest is not None:
+                        # PDF уже есть у клиента по прежнему манифесту — запись переносится
+                        manifest.add(cert_id, ckey, fname)
+                    continue
+                if ckey in inflight:
+                    inflight[ckey] += 1
+                elif ckey in held:
+                    held[ckey][1] += 1
+                elif ckey in recent:
+                    recent.move_to_end(ckey)
+                    held[ckey] = [recent[ckey], 1]
+                else:
+                    inflight[ckey] = 0
+                    item = PipelineRow(row_num, fname, ckey, context, cert_id=cert_id)
+                    if not batch:
+                        yield RenderUnit(docx_path, kind, [item])
+                        continue
+                    group = groups.setdefault(docx_path, [])
+                    group.append(item)
+                    grouped[ckey] = docx_path
+                    if BATCH_MAX_ROWS and len(group) >= BATCH_MAX_ROWS:
+                        for ready in flush(docx_path):
+                            yield ready
+                    continue
+                reused += 1
+                dup = RenderUnit(docx_path, kind, [PipelineRow(row_num, fname, ckey, cert_id=cert_id)])
+                if ckey in grouped:
+                    deferred.append(dup)
+                else:
+                    yield dup
+        finally:
+            aclose = getattr(rows, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        if state:
+            state.total = seen
+        for docx_path in list(groups):
+            for ready in flush(docx_path):
+                yield ready
+
+    async def render_stage(unit: RenderUnit) -> RenderUnit:
+        if not unit.renders:
+            return unit
+        try:
+            return await loop.run_in_executor(EXECUTORS.get("render"), render_unit, unit, engine, quality, sizes)
+        except Exception as e:
+            unit.results = [e] * len(unit.rows)
+            return unit
+
+    async def docx_stage(unit: RenderUnit) -> RenderUnit:
+        if not unit.todo:
+            return unit
+        contexts = [unit.rows[i].context for i in unit.todo]
+        try:
+            batch, parts, elapsed = await loop.run_in_executor(
+                EXECUTORS.get("docx"), DOCX_STAGE_FN, unit.docx_path, contexts)
+        except Exception as e:
+            return apply_docx_parts(unit, False, [e] * len(contexts))
+        STAGE_SECONDS.observe(elapsed, stage="render")
+        return apply_docx_parts(unit, batch, parts)
+
+    async def convert_stage(unit: RenderUnit) -> RenderUnit:
+        if not unit.todo:
+            return unit
+        try:
+            return await SCHEDULER.submit(job, convert_unit, unit, quality, sizes, workspace)
+        except Exception as e:
+            for i in unit.todo:
+                unit.results[i] = e
+            return unit
+
+    def write(fname: str, pdf_bytes: bytes) -> None:
+        with STAGE_SECONDS.time(stage="zip"):
+            zf.writestr(fname, pdf_bytes)
+
+    def copy(old_entry: str, fname: str) -> None:
+        with STAGE_SECONDS.time(stage="zip"):
+            _copy_zip_entry(prior.archive, old_entry, zf, fname)
+
+    async def archive(unit: RenderUnit) -> None:
+        """Этап archive: запись идёт строго по одной, но deflate — в пуле archive, не в цикле событий."""
+        nonlocal processed_count
+        pool = EXECUTORS.get("archive")
+        for i, row in enumerate(unit.rows):
+            if row.copy_from is not None:
+                await loop.run_in_executor(pool, copy, row.copy_from, row.fname)
+                if manifest is not None:
+                    manifest.add(row.cert_id, row.ckey, row.fname)
+                if on_entry:
+                    await on_entry()
+                continue
+            if row.context is None:
+                entry = held[row.ckey]
+                result = entry[0]
+                entry[1] -= 1
+                if not entry[1]:
+                    del held[row.ckey]
+            else:
+                result = unit.results[i]
+                waiters = inflight.pop(row.ckey, 0)
+                if waiters:
+                    held[row.ckey] = [result, waiters]
+                if isinstance(result, bytes):
+                    recent[row.ckey] = result
+                    if len(recent) > DEDUP_RECENT_ROWS:
+                        recent.popitem(last=False)
+            if isinstance(result, Exception):
+                ROWS_TOTAL.inc(mode=mode, kind=unit.kind, status="failed")
+                await _report_row_error(state, job_id, row.row_num, result)
+                continue
+            await loop.run_in_executor(pool, write, row.fname, result)
+            if manifest is not None:
+                manifest.add(row.cert_id, row.ckey, row.fname)
+            ROWS_TOTAL.inc(mode=mode, kind=unit.kind, status="processed")
+            processed_count += 1
+            if on_entry:
+                await on_entry()
+        if state:
+            state.processed = processed_count + unchanged
+            state.bytes_before, state.bytes_after = sizes.before, sizes.after
+            state.message = f"Готово {state.processed} из {max(state.total, seen)}"
+            await emit(job_id)
+
+    pipeline = Pipeline([
+        PipelineStage("render", render_stage, RENDER_WORKERS),
+        PipelineStage("docx", docx_stage, RENDER_PROCESSES or RENDER_WORKERS),
+        PipelineStage("convert", convert_stage, LO_POOL_SIZE),
+    ])
+    await SCHEDULER.admit(job)
+    try:
+        with WORKSPACES.job(job.key) as workspace:
+            await pipeline.run(units(), archive)
+        if manifest is not None and (processed_count or unchanged):
+            zf.writestr(MANIFEST_NAME, manifest.to_json())
+    finally:
+        SCHEDULER.release(job)
+    if reused:
+        logger.info(f"Reused {reused} duplicate row(s) without rendering")
+    if dates.unparseable:
+        logger.warning(f"Unparseable dates: {dates.unparseable}")
+        if state:
+            state.warnings.extend(dates.warnings())
+            await emit(job_id)
+    if unchanged:
+        logger.info(f"Kept {unchanged} unchanged row(s) from the previous job")
+        if state:
+            state.processed = processed_count + unchanged
+            state.message = f"Готово {state.processed} из {max(state.total, seen)}"
+            await emit(job_id)
+    return processed_count + unchanged
+
+
+class _ZipChunkWriter:
+    """
+    Приёмник для ZipFile без seek/tell: zipfile сам переходит на data
+    descriptors, поэтому размеры записей не нужны заранее.
+    """
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+
+    def write(self, b) -> int:
+        self._parts.append(bytes(b))
+        return len(b)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+async def _stream_zip_response(
+    schema: RowSchema,
+    rows: Iterator[List[str]],
+    fileobj: BinaryIO,
+    mode: str,
+    state: Optional[ProgressState],
+    job_id: Optional[str],
+    batch: bool,
+    engine: str,
+    output: str = "zip",
+    quality: str = "print",
+    prior: Optional[PriorJob] = None,
+) -> Optional[StreamingResponse]:
+    """
+    ZIP (или единый PDF) уходит клиенту по мере готовности сертификатов. Ответ
+    начинается с первой записью; если валидных строк нет — None (вызывающий
+    отдаёт 400). Закрывает fileobj по завершении.
+    """
+    sink = _ZipChunkWriter()
+    chunks: asyncio.Queue = asyncio.Queue(maxsize=4)
+
+    async def flush() -> None:
+        data = sink.take()
+        if data:
+            await chunks.put(data)
+
+    async def run() -> int:
+        try:
+            with open_output(sink, output) as zf:
+                count = await _process_rows(schema, _stream_rows(rows), mode, zf, state, job_id, batch, engine, flush, quality, prior)
+            if count:
+                await flush()  # central directory / xref
+            else:
+                sink.take()
+            return count
+        finally:
+            fileobj.close()
+            if prior:
+                prior.close()
+            await chunks.put(None)
+
+    task = asyncio.create_task(run())
+    first = await chunks.get()
+    if first is None:
+        await task
+        return None
+
+    async def body():
+        try:
+            yield first
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+            await task
+            if state:
+                state.stage = "done"
+                state.message = "Готово"
+                await emit(job_id)
+        except Exception as e:
+            logger.error(f"Streaming generation failed: {str(e)}")
+            if state:
+                state.stage = "error"
+                state.message = str(e)
+                await emit(job_id)
+            raise
+        finally:
+            if not task.done():
+                task.cancel()
+
+    media_type, filename = OUTPUT_MEDIA[output]
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 
 @app.post("/generate")
@@ -897,9 +4568,24 @@ async def generate(
     csv_file: UploadFile = File(...),
     mode: str = Form(...),                  # print | online
     job_id: Optional[str] = Form(None),
+    batch: bool = Form(False),              # одна конвертация на группу шаблона
+    engine: Optional[str] = Form(None),     # docx | overlay
+    stream: bool = Form(False),             # отдавать ZIP по мере готовности
+    output: str = Form("zip"),              # zip | pdf (один склеенный PDF)
+    quality: Optional[str] = Form(None),    # web | print (по умолчанию print)
+    base_job: Optional[str] = Form(None),   # прежняя задача: перерендерить только изменённые строки
+    manifest_file: Optional[UploadFile] = File(None),  # или её manifest.json
 ):
     try:
         logger.info(f"Starting certificate generation for mode: {mode}")
+        engine = engine if engine in RENDER_ENGINES else RENDER_ENGINE
+        output = output if output in OUTPUT_FORMATS else "zip"
+        quality = pick_quality(quality)
+        manifest_bytes = await manifest_file.read() if manifest_file else None
+        try:
+            prior = load_prior(base_job, manifest_bytes, output, quality)
+        except ValueError as e:
+            return PlainTextResponse(str(e), status_code=400)
         state: Optional[ProgressState] = None
         if job_id:
             state = get_progress(job_id)
@@ -907,82 +4593,50 @@ async def generate(
             state.message = "Загрузка файла"
             await emit(job_id)
 
-        data = await csv_file.read()
         filename = (csv_file.filename or '')
-        rows_list = _parse_uploaded_table(data, filename)
+        await csv_file.seek(0)
+        fileobj = _detach_upload(csv_file) if stream else csv_file.file
+        try:
+            schema, rows = await asyncio.get_event_loop().run_in_executor(
+                None, open_uploaded_table, fileobj, filename)
+        except Exception as e:
+            fileobj.close()
+            if prior:
+                prior.close()
+            if not isinstance(e, ValueError):
+                raise
+            # нет обязательных колонок или заголовка — ошибка запроса, а не сервера
+            if state:
+                state.stage = "error"
+                state.message = str(e)
+                await emit(job_id)
+            return PlainTextResponse(str(e), status_code=400)
 
-        total = len(rows_list)
         if state:
-            state.total = total
+            state.warnings = schema.warnings()
+            state.total = 0
             state.processed = 0
             state.stage = "processing"
             state.message = "Обработка строк"
             await emit(job_id)
 
-        mem_zip = io.BytesIO()
-        processed_count = 0
-        loop = asyncio.get_event_loop()
-
-        with ThreadPoolExecutor(max_workers=1) as executor:  # сериализуем LO
-            with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-                for row_num, row in enumerate(rows_list, 1):
-                    try:
-                        is_online = (mode == "online")
-                        course     = _get_field(row, "course")
-                        dates_raw  = _get_field(row, "dates")
-                        first_name = _get_field(row, "first_name")
-                        last_name  = _get_field(row, "last_name")
-                        cert_id    = _get_field(row, "id")
-                        city       = _get_field(row, "city")
-                        country    = _get_field(row, "country")
-
-                        if not (course and dates_raw and first_name and last_name and cert_id):
-                            logger.warning(f"Skipping row {row_num}: missing required fields")
-                            continue
-
-                        parsed = parse_dates(dates_raw)
-                        kind = pick_kind(parsed)
-                        use_small = need_small_variant(f"{first_name} {last_name}")
-                        variant = "small" if use_small else "normal"
-
-                        group = "online" if is_online else "print"
-                        docx_name = DOCX_MAP[group][kind][variant]
-                        docx_path = os.path.join(TEMPLATES_DIR, docx_name)
-                        if not os.path.exists(docx_path):
-                            raise FileNotFoundError(f"Template not found: {docx_path}")
-
-                        context = format_dates_for_jinja(parsed)
-                        context.update({
-                            "Имя": first_name,
-                            "Фамилия": last_name,
-                            "Тренинг": course,
-                            "Идентификатор": cert_id,
-                            "Город": city or context.get("Город", "Москва"),
-                            "Страна": country,
-                        })
-
-                        def render_sync():
-                            adjust = False  # ОТКЛЮЧЕНО: координаты заданы в шаблоне
-                            return render_docx_template(docx_path, context, adjust)
-
-                        pdf_bytes = await loop.run_in_executor(executor, render_sync)
-                        fname = f"{sanitize_filename(cert_id)}_{sanitize_filename(last_name)}_{sanitize_filename(first_name)}.pdf"
-                        zf.writestr(fname, pdf_bytes)
-                        processed_count += 1
-                        if state:
-                            state.processed = processed_count
-                            state.message = f"Готово {processed_count} из {total}"
-                            await emit(job_id)
-                    except Exception as e:
-                        logger.error(f"Error preparing row {row_num}: {str(e)}")
-                        if state:
-                            state.errors += 1
-                            state.message = f"Ошибка в строке {row_num}"
-                            await emit(job_id)
-                        continue
+        hint = "CSV/Excel распознан, но ни одной корректной строки не найдено."
+        if stream:
+            response = await _stream_zip_response(schema, rows, fileobj, mode, state, job_id, batch, engine, output, quality, prior)
+            if response is not None:
+                return response
+            processed_count = 0
+        else:
+            mem_zip = io.BytesIO()
+            try:
+                with open_output(mem_zip, output) as zf:
+                    processed_count = await _process_rows(
+                        schema, _stream_rows(rows), mode, zf, state, job_id, batch, engine, quality=quality, prior=prior)
+            finally:
+                if prior:
+                    prior.close()
 
         if processed_count == 0:
-            hint = "CSV/Excel распознан, но ни одной корректной строки не найдено."
             if state:
                 state.stage = "error"
                 state.message = "Нет валидных строк"
@@ -1001,10 +4655,11 @@ async def generate(
             state.message = "Готово"
             await emit(job_id)
 
+        media_type, download_name = OUTPUT_MEDIA[output]
         return Response(
             content=zip_bytes,
-            media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=certificates.zip"},
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename={download_name}"},
         )
 
     except Exception as e:
@@ -1022,9 +4677,19 @@ async def generate_async(
     csv_file: UploadFile = File(...),
     mode: str = Form(...),                  # print | online
     job_id: Optional[str] = Form(None),
+    batch: bool = Form(False),              # одна конвертация на группу шаблона
+    engine: Optional[str] = Form(None),     # docx | overlay
+    output: str = Form("zip"),              # zip | pdf (один склеенный PDF)
+    quality: Optional[str] = Form(None),    # web | print (по умолчанию print)
+    base_job: Optional[str] = Form(None),   # прежняя задача: перерендерить только изменённые строки
+    manifest_file: Optional[UploadFile] = File(None),  # или её manifest.json
 ):
     try:
         logger.info(f"Starting ASYNC certificate generation for mode: {mode}")
+        engine = engine if engine in RENDER_ENGINES else RENDER_ENGINE
+        output = output if output in OUTPUT_FORMATS else "zip"
+        quality = pick_quality(quality)
+        manifest_bytes = await manifest_file.read() if manifest_file else None
 
         if not job_id:
             job_id = f"job-{int(time.time())}-{os.getpid()}-{id(csv_file)}"
@@ -1033,78 +4698,52 @@ async def generate_async(
         state.message = "Загрузка файла"
         await emit(job_id)
 
-        data = await csv_file.read()
         filename = (csv_file.filename or '')
-        rows_list = _parse_uploaded_table(data, filename)
-
-        total = len(rows_list)
-        state.total = total
+        fileobj = _detach_upload(csv_file)
+        # повторная отправка того же файла присоединяется к уже идущей/готовой задаче
+        key = await asyncio.get_event_loop().run_in_executor(
+            None, submission_key, fileobj, mode, engine, output, quality,
+            base_job or "", hashlib.sha256(manifest_bytes or b"").hexdigest())
+        existing = JOB_STATE.find_submission(key)
+        if existing and existing != job_id and _job_reusable(existing):
+            fileobj.close()
+            JOB_STATE.add_alias(job_id, existing)
+            # SSE-клиент мог подписаться на свой job_id до POST: сообщаем ему, за какой задачей следить
+            state.stage = "redirect"
+            state.redirect = existing
+            state.message = "Такой же файл уже обрабатывается"
+            await emit(job_id)
+            PROGRESS.pop(job_id, None)
+            logger.info(f"Identical upload: {job_id} attached to {existing}")
+            return {"job_id": existing, "reused": True}
+        try:
+            prior = load_prior(base_job, manifest_bytes, output, quality)
+        except Exception:
+            fileobj.close()
+            raise
+        JOB_STATE.remember_submission(key, job_id)
+        try:
+            schema, rows = await asyncio.get_event_loop().run_in_executor(
+                None, open_uploaded_table, fileobj, filename)
+        except Exception:
+            fileobj.close()
+            if prior:
+                prior.close()
+            raise
+
+        state.warnings = schema.warnings()
+        state.total = 0
         state.processed = 0
         state.stage = "processing"
         state.message = "Обработка строк"
         await emit(job_id)
 
         async def worker():
+            result_path = JOB_RESULTS.new_file(job_id, output)
             try:
-                mem_zip = io.BytesIO()
-                processed_count = 0
-                loop = asyncio.get_event_loop()
-
-                with ThreadPoolExecutor(max_workers=1) as executor:  # сериализуем LO
-                    with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-                        for row_num, row in enumerate(rows_list, 1):
-                            try:
-                                is_online = (mode == "online")
-                                course     = _get_field(row, "course")
-                                dates_raw  = _get_field(row, "dates")
-                                first_name = _get_field(row, "first_name")
-                                last_name  = _get_field(row, "last_name")
-                                cert_id    = _get_field(row, "id")
-                                city       = _get_field(row, "city")
-                                country    = _get_field(row, "country")
-
-                                if not (course and dates_raw and first_name and last_name and cert_id):
-                                    logger.warning(f"Skipping row {row_num}: missing required fields")
-                                    continue
-
-                                parsed = parse_dates(dates_raw)
-                                kind = pick_kind(parsed)
-                                use_small = need_small_variant(f"{first_name} {last_name}")
-                                variant = "small" if use_small else "normal"
-
-                                group = "online" if is_online else "print"
-                                docx_name = DOCX_MAP[group][kind][variant]
-                                docx_path = os.path.join(TEMPLATES_DIR, docx_name)
-                                if not os.path.exists(docx_path):
-                                    raise FileNotFoundError(f"Template not found: {docx_path}")
-
-                                context = format_dates_for_jinja(parsed)
-                                context.update({
-                                    "Имя": first_name,
-                                    "Фамилия": last_name,
-                                    "Тренинг": course,
-                                    "Идентификатор": cert_id,
-                                    "Город": city or context.get("Город", "Москва"),
-                                    "Страна": country,
-                                })
-
-                                def render_sync():
-                                    adjust = False  # ОТКЛЮЧЕНО: координаты заданы в шаблоне
-                                    return render_docx_template(docx_path, context, adjust)
-
-                                pdf_bytes = await loop.run_in_executor(executor, render_sync)
-                                fname = f"{sanitize_filename(cert_id)}_{sanitize_filename(last_name)}_{sanitize_filename(first_name)}.pdf"
-                                zf.writestr(fname, pdf_bytes)
-                                processed_count += 1
-                                state.processed = processed_count
-                                state.message = f"Готово {processed_count} из {total}"
-                                await emit(job_id)
-                            except Exception as e:
-                                logger.error(f"Error preparing row {row_num}: {str(e)}")
-                                state.errors += 1
-                                state.message = f"Ошибка в строке {row_num}"
-                                await emit(job_id)
-                                continue
+                with open(result_path, "wb") as f, open_output(f, output) as zf:
+                    processed_count = await _process_rows(
+                        schema, _stream_rows(rows), mode, zf, state, job_id, batch, engine, quality=quality, prior=prior)
 
                 if processed_count == 0:
                     state.stage = "error"
@@ -1112,8 +4751,7 @@ async def generate_async(
                     await emit(job_id)
                     return
 
-                mem_zip.seek(0)
-                JOB_RESULTS[job_id] = mem_zip.getvalue()
+                JOB_RESULTS.commit(job_id, result_path, output)
                 state.stage = "zipping"
                 state.message = "Упаковка ZIP"
                 await emit(job_id)
@@ -1126,9 +4764,15 @@ async def generate_async(
                 state.stage = "error"
                 state.message = str(e)
                 await emit(job_id)
+            finally:
+                fileobj.close()
+                if prior:
+                    prior.close()
+                if os.path.exists(result_path):
+                    os.unlink(result_path)
 
         asyncio.create_task(worker())
-        return {"job_id": job_id}
+        return {"job_id": job_id, "reused": False}
 
     except Exception as e:
         logger.error(f"generate-async init failed: {str(e)}")
@@ -1142,15 +4786,28 @@ async def generate_async(
 
 @app.get("/download/{job_id}")
 def download_result(job_id: str):
-    data = JOB_RESULTS.get(job_id)
-    if not data:
+    result = JOB_RESULTS.get(JOB_STATE.resolve(job_id))
+    if result is None:
         return PlainTextResponse("Результат не готов или истёк", status_code=404)
-    try:
-        del JOB_RESULTS[job_id]
-    except Exception:
-        pass
+    media_type, filename = OUTPUT_MEDIA.get(result.output, OUTPUT_MEDIA["zip"])
+    return FileResponse(
+        result.path,
+        media_type=media_type,
+        filename=filename,
+    )
+
+
+@app.get("/manifest/{job_id}")
+def download_manifest(job_id: str):
+    result = JOB_RESULTS.get(JOB_STATE.resolve(job_id))
+    if result is None or result.output != "zip":
+        return PlainTextResponse("Манифест недоступен", status_code=404)
+    with zipfile.ZipFile(result.path) as zf:
+        if MANIFEST_NAME not in zf.NameToInfo:
+            return PlainTextResponse("Манифест недоступен", status_code=404)
+        data = zf.read(MANIFEST_NAME)
     return Response(
         content=data,
-        media_type="application/zip",
-        headers={"Content-Disposition": "attachment; filename=certificates.zip"},
+        media_type="application/json",
+        headers={"Content-Disposition": f"attachment; filename={MANIFEST_NAME}"},
     )
@@ -0,0 +1,4 @@
+"""
+Бенчмарки конвейера сертификатов: синтетические когорты, замер по этапам,
+сравнение с сохранённым baseline. Запуск: python -m benchmarks --help
+"""
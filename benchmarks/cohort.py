@@ -0,0 +1,107 @@
+"""Генератор синтетических когорт участников в формате загрузки (CSV/XLSX)."""
+import csv
+import io
+import random
+from dataclasses import dataclass
+from typing import Dict, List
+
+HEADERS = ["Имя", "Фамилия", "Название тренинга", "Даты", "ID", "Город", "Страна"]
+DATE_KINDS = ("duration_day", "2day_2month", "1day_1month")
+
+FIRST_RU = ["Иван", "Анна", "Сергей", "Мария", "Дмитрий", "Ольга", "Алексей", "Екатерина", "Павел", "Наталья"]
+LAST_RU = ["Петров", "Смирнова", "Кузнецов", "Попова", "Соколов", "Лебедева", "Козлов", "Новикова", "Морозов", "Волкова"]
+FIRST_LAT = ["John", "Emma", "Lucas", "Sophie", "Daniel", "Olivia", "Martin", "Laura", "Thomas", "Julia"]
+LAST_LAT = ["Smith", "Müller", "Dubois", "Rossi", "García", "Novak", "Jensen", "Kowalski", "Silva", "Brown"]
+# достаточно длинные, чтобы text fit уменьшил кегль (или, при TEXT_FIT=0, выбрался шаблон small)
+LONG_FIRST_RU = ["Александра-Валентина", "Константин-Владислав", "Елизавета-Анастасия"]
+LONG_LAST_RU = ["Константинопольская-Преображенская", "Новодворский-Воскресенский", "Краснопольская-Рождественская"]
+LONG_FIRST_LAT = ["Maximilian-Alexander", "Anna-Katharina-Sophie", "Jean-Christophe"]
+LONG_LAST_LAT = ["Schwarzenberg-Oppenheimer", "Vandenberghe-Lichtenstein", "Montgomery-Fitzgerald-Smythe"]
+COURSES = [
+    "Финансовое моделирование",
+    "Управление проектами",
+    "МСФО: практический курс",
+    "Data Analytics for Finance",
+    "Leadership Essentials",
+]
+CITIES = [("Москва", "Россия"), ("Алматы", "Казахстан"), ("Ташкент", "Узбекистан"), ("Dubai", "UAE")]
+MONTHS_EN = ["January", "February", "March", "April", "May", "June",
+             "July", "August", "September", "October", "November", "December"]
+
+
+@dataclass
+class CohortSpec:
+    rows: int = 100
+    latin_share: float = 0.3
+    long_share: float = 0.1
+    kinds: tuple = DATE_KINDS
+    seed: int = 1
+
+
+def _dates(rng: random.Random, kind: str) -> str:
+    year = rng.choice([2024, 2025])
+    month = rng.randint(1, 12)
+    textual = rng.random() < 0.25
+    if kind == "duration_day":
+        d1 = rng.randint(1, 25)
+        d2 = d1 + rng.randint(1, 3)
+        if textual:
+            return f"{d1}-{d2} {MONTHS_EN[month - 1]} {year}"
+        return f"{d1:02d}.{month:02d}.{year % 100:02d} - {d2:02d}.{month:02d}.{year % 100:02d}"
+    if kind == "2day_2month":
+        month = min(month, 11)
+        d1, d2 = rng.randint(27, 30), rng.randint(1, 3)
+        return f"{d1:02d}.{month:02d}.{year} - {d2:02d}.{month + 1:02d}.{year}"
+    d1 = rng.randint(1, 28)
+    if textual:
+        return f"{d1} {MONTHS_EN[month - 1]} {year}"
+    return f"{d1:02d}.{month:02d}.{year % 100:02d}"
+
+
+def generate_cohort(spec: CohortSpec) -> List[Dict[str, str]]:
+    """Строки когорты; при одном seed результат детерминирован."""
+    rng = random.Random(spec.seed)
+    rows = []
+    for i in range(spec.rows):
+        latin = rng.random() < spec.latin_share
+        long_name = rng.random() < spec.long_share
+        if long_name:
+            first = rng.choice(LONG_FIRST_LAT if latin else LONG_FIRST_RU)
+            last = rng.choice(LONG_LAST_LAT if latin else LONG_LAST_RU)
+        else:
+            first = rng.choice(FIRST_LAT if latin else FIRST_RU)
+            last = rng.choice(LAST_LAT if latin else LAST_RU)
+        city, country = rng.choice(CITIES)
+        rows.append({
+            "Имя": first,
+            "Фамилия": last,
+            "Название тренинга": rng.choice(COURSES),
+            "Даты": _dates(rng, spec.kinds[i % len(spec.kinds)]),
+            "ID": f"BM-{i + 1:06d}",
+            "Город": city,
+            "Страна": country,
+        })
+    return rows
+
+
+def to_csv(rows: List[Dict[str, str]], delimiter: str = ";") -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=delimiter, lineterminator="\n")
+    writer.writerow(HEADERS)
+    for row in rows:
+        writer.writerow([row[h] for h in HEADERS])
+    # как выгрузка из Excel: UTF-8 с BOM
+    return buf.getvalue().encode("utf-8-sig")
+
+
+def to_xlsx(rows: List[Dict[str, str]]) -> bytes:
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(HEADERS)
+    for row in rows:
+        ws.append([row[h] for h in HEADERS])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
@@ -0,0 +1,114 @@
+"""
+Время холодного импорта app.main и первых ответов /health и /ui.
+
+    python -m benchmarks.import_time                  # код 1, если импорт дольше бюджета
+    python -m benchmarks.import_time --budget 0.5 --repeat 5
+
+Каждый замер — отдельный интерпретатор: кэш модулей не помогает. Заодно
+проверяется, что тяжёлые зависимости не грузятся при импорте.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# должны импортироваться лениво, при первой задаче
+LAZY_MODULES = ("docxtpl", "docx", "openpyxl", "reportlab", "PyPDF2", "PIL", "lxml", "jinja2")
+
+PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import app.main
+t_import = time.perf_counter() - t0
+loaded = [m for m in LAZY if m in sys.modules]
+from fastapi.testclient import TestClient
+client = TestClient(app.main.app)
+t1 = time.perf_counter()
+client.get("/health")
+t_health = time.perf_counter() - t1
+t2 = time.perf_counter()
+client.get("/ui")
+t_ui = time.perf_counter() - t2
+print(json.dumps({
+    "import_s": t_import,
+    "health_ms": t_health * 1000,
+    "ui_ms": t_ui * 1000,
+    "loaded": loaded,
+}))
+"""
+
+
+def _top_imports(stderr: str, limit: int) -> List[Dict[str, object]]:
+    """Прямые зависимости app.main из вывода -X importtime, по убыванию."""
+    children: List[Dict[str, object]] = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # заголовок
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append({"module": name.strip(), "ms": round(int(cumulative) / 1000, 1)})
+        elif depth == 0:
+            # importtime печатает модуль после его зависимостей
+            if name.strip() == "app.main":
+                return sorted(children, key=lambda r: -r["ms"])[:limit]
+            children = []
+    return []
+
+
+def measure_once() -> Dict[str, object]:
+    code = f"LAZY = {LAZY_MODULES!r}\n" + PROBE
+    env = dict(os.environ, WARMUP="0")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["top"] = _top_imports(proc.stderr, 8)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.import_time",
+                                     description="Бюджет времени импорта app.main")
+    parser.add_argument("--budget", type=float, default=0.75, help="предел медианы импорта, с")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="куда записать JSON с результатами")
+    args = parser.parse_args(argv)
+
+    runs = [measure_once() for _ in range(max(1, args.repeat))]
+    median = statistics.median(r["import_s"] for r in runs)
+    result = {
+        "import_s": round(median, 4),
+        "health_ms": round(statistics.median(r["health_ms"] for r in runs), 2),
+        "ui_ms": round(statistics.median(r["ui_ms"] for r in runs), 2),
+        "budget_s": args.budget,
+        "loaded_eagerly": runs[-1]["loaded"],
+        "top_imports": runs[-1]["top"],
+    }
+
+    print(f"import app.main: {result['import_s']:.3f}s (budget {args.budget:.3f}s, median of {len(runs)})")
+    print(f"first /health: {result['health_ms']:.1f}ms, first /ui: {result['ui_ms']:.1f}ms")
+    for row in result["top_imports"]:
+        print(f"  {row['module']:<32} {row['ms']:>8.1f}ms")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    if median > args.budget:
+        print(f"FAIL: import exceeds budget by {median - args.budget:.3f}s")
+        failed = True
+    if result["loaded_eagerly"]:
+        print(f"FAIL: loaded at import time: {', '.join(result['loaded_eagerly'])}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Замер конвейера по этапам на синтетической когорте.
+
+    python -m benchmarks --rows 200 --format xlsx --output results.json
+    python -m benchmarks --rows 200 --baseline results.json   # код 1 при регрессии
+"""
+import argparse
+import io
+import json
+import logging
+import platform
+import sys
+import time
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from benchmarks.cohort import DATE_KINDS, CohortSpec, generate_cohort, to_csv, to_xlsx
+from benchmarks.stand_in import StandInConverter, TimedConverter
+
+STAGES = ("parse", "extract", "parse_dates", "prepare", "render_docx", "convert", "zip")
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {s: [] for s in STAGES}
+
+    @contextmanager
+    def __call__(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - t0)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, values in self.samples.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            result[stage] = {
+                "count": len(values),
+                "total_s": round(sum(values), 6),
+                "mean_ms": round(sum(values) * 1000 / len(values), 4),
+                "p50_ms": round(pick(0.50) * 1000, 4),
+                "p95_ms": round(pick(0.95) * 1000, 4),
+                "max_ms": round(ordered[-1] * 1000, 4),
+            }
+        return result
+
+
+class TimedZipFile(zipfile.ZipFile):
+    """ZIP конвейера, замеряющий каждую запись (этап zip идёт в пуле archive)."""
+
+    def __init__(self, *args, timer: StageTimer, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timer = timer
+
+    def writestr(self, *args, **kwargs):
+        with self.timer("zip"):
+            return super().writestr(*args, **kwargs)
+
+
+def run_benchmark(spec: CohortSpec, fmt: str, mode: str, converter: str, latency: float,
+                  batch: bool = False) -> Dict[str, object]:
+    """
+    Разбор и подготовка строк меряются по одной; рендер, конвертация и ZIP —
+    внутри настоящего конвейера _process_rows (параллельные этапы, планировщик),
+    поэтому wall_s и rows_per_s — пропускная способность сервиса, а не цикла.
+    RENDER_CACHE на время замера выключен: иначе повторный прогон ничего не рендерит.
+    """
+    import asyncio
+
+    from app import main as app_main
+
+    rows = generate_cohort(spec)
+    data = to_xlsx(rows) if fmt == "xlsx" else to_csv(rows)
+    timer = StageTimer()
+    mix: Counter = Counter()
+    skipped = 0
+    dates = app_main.DateParser()
+
+    with timer("parse"):
+        schema, table = app_main._parse_uploaded_table(data, f"cohort.{fmt}")
+    for cells in table:
+        with timer("extract"):
+            row = schema.extract(cells)
+        with timer("parse_dates"):
+            parsed = dates.parse(row.dates)
+        with timer("prepare"):
+            prepared = app_main._prepare_row(row, mode, dates)
+        if prepared is None:
+            skipped += 1
+            continue
+        docx_path, context, _ = prepared
+        variant = "small" if "_small_" in docx_path else "normal"
+        if any(context.get(slot.context_key, str(int(slot.size * 2))) != str(int(slot.size * 2))
+               for slot in app_main.TEMPLATE_REGISTRY.get(docx_path).fit_slots):
+            variant = "fitted"  # кегль уменьшен text fit
+        mix[f"{parsed.kind}/{variant}"] += 1
+
+    original_pool, original_cache, original_docx = app_main.LO_POOL, app_main.RENDER_CACHE, app_main.DOCX_STAGE_FN
+    timed = TimedConverter(StandInConverter(latency) if converter == "stand-in" else original_pool)
+
+    def docx_stage(docx_path, contexts):
+        result = original_docx(docx_path, contexts)
+        timer.samples["render_docx"].append(result[2])
+        return result
+
+    app_main.LO_POOL = timed
+    app_main.RENDER_CACHE = app_main.RenderCache("", 0)
+    app_main.DOCX_STAGE_FN = docx_stage
+    archive = io.BytesIO()
+    wall0 = time.perf_counter()
+    try:
+        with TimedZipFile(archive, "w", zipfile.ZIP_DEFLATED, timer=timer) as zf:
+            rendered = asyncio.run(app_main._process_rows(
+                schema, app_main._stream_rows(iter(table)), mode, zf, None, None, batch=batch))
+        wall = time.perf_counter() - wall0
+    finally:
+        app_main.LO_POOL, app_main.RENDER_CACHE, app_main.DOCX_STAGE_FN = original_pool, original_cache, original_docx
+    timer.samples["convert"].extend(timed.durations)
+
+    return {
+        "meta": {
+            "rows": spec.rows,
+            "format": fmt,
+            "mode": mode,
+            "converter": converter,
+            "latency": latency,
+            "batch": batch,
+            "slots": app_main.LO_POOL_SIZE,
+            "seed": spec.seed,
+            "latin_share": spec.latin_share,
+            "long_share": spec.long_share,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "mix": dict(sorted(mix.items())),
+        "skipped": skipped,
+        "rendered": rendered,
+        "distinct_dates": dates.distinct,
+        "zip_bytes": archive.tell(),
+        "wall_s": round(wall, 6),
+        "rows_per_s": round(rendered / wall, 3) if wall else 0.0,
+        "stages": timer.summary(),
+    }
+
+
+def compare(current: Dict[str, object], baseline: Dict[str, object], tolerance: float) -> List[str]:
+    """Список регрессий: этап медленнее baseline больше чем на tolerance."""
+    problems = []
+    for key in ("rows", "format", "mode", "converter", "batch", "slots"):
+        if current["meta"].get(key) != baseline.get("meta", {}).get(key):
+            problems.append(f"meta.{key} differs from baseline: "
+                            f"{current['meta'].get(key)!r} != {baseline.get('meta', {}).get(key)!r}")
+    for stage, stats in current["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if not base or not base.get("mean_ms"):
+            continue
+        ratio = stats["mean_ms"] / base["mean_ms"]
+        if ratio > 1 + tolerance:
+            problems.append(f"{stage}: mean {stats['mean_ms']:.3f} ms vs {base['mean_ms']:.3f} ms (x{ratio:.2f})")
+    base_rps = baseline.get("rows_per_s") or 0
+    if base_rps and current["rows_per_s"] < base_rps * (1 - tolerance):
+        problems.append(f"throughput: {current['rows_per_s']:.2f} rows/s vs {base_rps:.2f} rows/s")
+    return problems
+
+
+def print_report(result: Dict[str, object], baseline: Optional[Dict[str, object]] = None) -> None:
+    print(f"{result['meta']['rows']} rows, {result['meta']['format']}, {result['meta']['mode']}, "
+          f"converter={result['meta']['converter']}, batch={result['meta']['batch']}, slots={result['meta']['slots']}: {result['wall_s']:.3f} s, {result['rows_per_s']:.2f} rows/s")
+    print(f"{'stage':<12} {'count':>6} {'mean ms':>10} {'p95 ms':>10} {'total s':>10} {'baseline':>10}")
+    for stage, s in result["stages"].items():
+        base = (baseline or {}).get("stages", {}).get(stage, {}).get("mean_ms")
+        base_txt = f"{base:.3f}" if base else "-"
+        print(f"{stage:<12} {s['count']:>6} {s['mean_ms']:>10.3f} {s['p95_ms']:>10.3f} {s['total_s']:>10.3f} {base_txt:>10}")
+    print("mix: " + ", ".join(f"{k}={v}" for k, v in result["mix"].items()))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Бенчмарк конвейера сертификатов")
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--format", choices=("csv", "xlsx"), default="csv")
+    parser.add_argument("--mode", choices=("online", "print"), default="online")
+    parser.add_argument("--converter", choices=("stand-in", "soffice"), default="stand-in",
+                        help="stand-in — без LibreOffice; soffice — реальный пул")
+    parser.add_argument("--latency", type=float, default=0.0, help="имитация времени конвертации, с")
+    parser.add_argument("--batch", action="store_true", help="пакетный режим, как batch=true в /generate")
+    parser.add_argument("--latin-share", type=float, default=0.3)
+    parser.add_argument("--long-share", type=float, default=0.1)
+    parser.add_argument("--kinds", default=",".join(DATE_KINDS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать JSON с результатами")
+    parser.add_argument("--baseline", help="JSON прошлого запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление, доля")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger("certefikati").setLevel(logging.WARNING)
+    kinds = tuple(k for k in args.kinds.split(",") if k)
+    unknown = set(kinds) - set(DATE_KINDS)
+    if unknown:
+        parser.error(f"unknown kinds: {', '.join(sorted(unknown))}")
+
+    spec = CohortSpec(rows=args.rows, latin_share=args.latin_share, long_share=args.long_share,
+                      kinds=kinds, seed=args.seed)
+    result = run_benchmark(spec, args.format, args.mode, args.converter, args.latency, args.batch)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if baseline is not None:
+        problems = compare(result, baseline, args.tolerance)
+        for p in problems:
+            print("REGRESSION " + p, file=sys.stderr)
+        return 1 if problems else 0
+    return 0
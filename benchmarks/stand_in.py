@@ -0,0 +1,88 @@
+"""Конвертер-заглушка вместо пула LibreOffice и обёртка, замеряющая конвертацию."""
+import os
+import re
+import time
+import zipfile
+from threading import Lock
+from typing import Dict, List
+
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.pdfgen import canvas
+
+_SECT_RE = re.compile(r"<w:sectPr\b.*?</w:sectPr>", re.DOTALL)
+
+
+class StandInConverter:
+    """
+    Пишет PDF с числом страниц по числу разделов документа (как LibreOffice
+    для пакетной сборки). latency — имитация времени конвертации на документ.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.conversions = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _page_count(docx_path: str) -> int:
+        with zipfile.ZipFile(docx_path) as z:
+            xml = z.read("word/document.xml").decode("utf-8")
+        # continuous-раздел продолжает текущую страницу
+        return max(1, sum(1 for m in _SECT_RE.finditer(xml) if 'w:val="continuous"' not in m.group(0)))
+
+    def convert(self, docx_path: str, out_dir: str) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.conversions += 1
+        pdf_path = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+        c = canvas.Canvas(pdf_path, pagesize=landscape(A4))
+        for i in range(self._page_count(docx_path)):
+            c.drawString(72, 72, f"stand-in page {i + 1}")
+            c.showPage()
+        c.save()
+        return pdf_path
+
+    def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, object]:
+        """Те же ключи, что у LibreOfficePool.stats(): /metrics и /pool-stats читают их напрямую."""
+        return {
+            "size": 0,
+            "started": True,
+            "idle": 0,
+            "uno": False,
+            "conversions": self.conversions,
+            "restarts": 0,
+            "timeouts": 0,
+            "stand_in": True,
+            "latency": self.latency,
+        }
+
+
+class TimedConverter:
+    """Прокси над пулом: копит длительность каждой конвертации."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.durations: List[float] = []
+        self._lock = Lock()
+
+    def convert(self, docx_path: str, out_dir: str) -> str:
+        t0 = time.perf_counter()
+        try:
+            return self.inner.convert(docx_path, out_dir)
+        finally:
+            with self._lock:
+                self.durations.append(time.perf_counter() - t0)
+
+    def take(self) -> float:
+        """Сумма длительностей с прошлого вызова."""
+        with self._lock:
+            total = sum(self.durations)
+            self.durations.clear()
+        return total
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
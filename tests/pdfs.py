@@ -0,0 +1,24 @@
+"""Маленькие PDF для тестов: общий шрифт и фон, разный текст — как у сертификатов одного шаблона."""
+import io
+from typing import Tuple
+
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+PAGE = (595, 842)  # A4, pt
+
+
+def make_pdf(text: str, pages: int = 1, image_size: Tuple[int, int] = (64, 64)) -> bytes:
+    """Каждая страница: фон-изображение на всю ширину и строка текста Helvetica."""
+    width, height = image_size
+    image = Image.linear_gradient("L").resize(image_size).convert("RGB")
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=PAGE, invariant=1)
+    for i in range(pages):
+        c.drawImage(ImageReader(image), 0, 0, PAGE[0], PAGE[0] * height / width)
+        c.setFont("Helvetica", 12)
+        c.drawString(100, 700, f"{text} {i}")
+        c.showPage()
+    c.save()
+    return buf.getvalue()
@@ -0,0 +1,94 @@
+import asyncio
+import io
+import zipfile
+
+import pytest
+
+from app import main as app_main
+from app.main import LibreOfficeTimeout, RowSchema, _process_rows
+from benchmarks.stand_in import StandInConverter
+
+HEADER = ["Имя", "Фамилия", "Название тренинга", "Даты", "ID"]
+
+
+class BatchConverter(StandInConverter):
+    """Запоминает, сколько страниц было в каждой конвертации; пакеты может «вешать»."""
+
+    def __init__(self, hang_batches: bool = False):
+        super().__init__()
+        self.hang_batches = hang_batches
+        self.pages = []
+
+    def convert(self, docx_path: str, out_dir: str) -> str:
+        pages = self._page_count(docx_path)
+        self.pages.append(pages)
+        if self.hang_batches and pages > 1:
+            raise LibreOfficeTimeout("LibreOffice conversion timed out after 0s")
+        return super().convert(docx_path, out_dir)
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    monkeypatch.setattr(app_main, "RENDER_CACHE", app_main.RenderCache(str(tmp_path / "cache"), 64 * 1024 * 1024))
+    monkeypatch.setattr(app_main, "BATCH_MAX_ROWS", 2)
+
+
+def row(i: int) -> list:
+    return [f"Пакет{i}", "Пакетов", "Курс пакета", "01.02.24", f"B-{i}"]
+
+
+def run(converter, monkeypatch, rows, count: int = 5) -> zipfile.ZipFile:
+    monkeypatch.setattr(app_main, "LO_POOL", converter)
+    buf = io.BytesIO()
+
+    async def scenario():
+        with zipfile.ZipFile(buf, "w") as zf:
+            return await _process_rows(RowSchema.from_headers(HEADER), rows(), "print", zf, None, None, batch=True)
+
+    assert asyncio.run(scenario()) == count
+    return zipfile.ZipFile(buf)
+
+
+def test_full_group_is_converted_before_input_ends(monkeypatch):
+    converter = BatchConverter()
+    converted_early = False
+
+    async def rows():
+        nonlocal converted_early
+        for i in range(5):
+            if i == 2:
+                for _ in range(500):  # вход «стоит», пока первая группа не сконвертируется
+                    if converter.pages:
+                        converted_early = True
+                        break
+                    await asyncio.sleep(0.01)
+            yield row(i)
+
+    archive = run(converter, monkeypatch, rows)
+    assert converted_early
+    assert converter.pages == [2, 2, 1]
+    assert len([n for n in archive.namelist() if n.endswith(".pdf")]) == 5
+
+
+def test_batch_timeout_falls_back_to_per_row(monkeypatch):
+    converter = BatchConverter(hang_batches=True)
+
+    async def rows():
+        for i in range(5):
+            yield row(i)
+
+    archive = run(converter, monkeypatch, rows)
+    assert sorted(converter.pages) == [1] * 5 + [2, 2]
+    assert len([n for n in archive.namelist() if n.endswith(".pdf")]) == 5
+
+
+def test_duplicates_follow_their_group(monkeypatch):
+    converter = BatchConverter()
+
+    async def rows():
+        for i in (0, 1, 0, 2, 3, 4):
+            yield row(i)
+
+    run(converter, monkeypatch, rows, count=6)
+    # дубль первой строки берёт PDF её пакета и сам не конвертируется
+    assert converter.pages == [2, 2, 1]
@@ -0,0 +1,26 @@
+from fastapi.testclient import TestClient
+
+from app import main as app_main
+from benchmarks.cohort import CohortSpec
+from benchmarks.run import run_benchmark
+from benchmarks.stand_in import StandInConverter
+
+
+def test_benchmark_runs_the_pipeline():
+    pool, cache = app_main.LO_POOL, app_main.RENDER_CACHE
+    result = run_benchmark(CohortSpec(rows=12, seed=3), "csv", "print", "stand-in", 0.0)
+    assert result["rendered"] == sum(result["mix"].values()) == 12 - result["skipped"]
+    stages = result["stages"]
+    assert stages["convert"]["count"] == stages["render_docx"]["count"] == result["rendered"]
+    assert stages["zip"]["count"] == result["rendered"] + 1  # + манифест
+    assert (app_main.LO_POOL, app_main.RENDER_CACHE) == (pool, cache)
+
+
+def test_stand_in_stats_match_pool(monkeypatch):
+    converter = StandInConverter()
+    assert set(app_main.LO_POOL.stats()) <= set(converter.stats())
+    monkeypatch.setattr(app_main, "LO_POOL", converter)
+    with TestClient(app_main.app) as client:
+        r = client.get("/metrics")
+    assert r.status_code == 200
+    assert "certgen_lo_uno 0" in r.text
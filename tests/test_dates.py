@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from app.main import DateParseError, DateParser, parse_dates
+
+THIS_YEAR = time.localtime().tm_year
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("01.02.24", (1, 2, None, None, 2024)),
+    ("1.2.2024", (1, 2, None, None, 2024)),
+    ("01.02.24 - 03.02.24", (1, 2, 3, 2, 2024)),
+    ("28.02.2024 – 02.03.2024", (28, 2, 2, 3, 2024)),
+    ("12-14 March 2024", (12, 3, 14, 3, 2024)),
+    ("12 – 14 марта 2024", (12, 3, 14, 3, 2024)),
+    ("5 March, 2023", (5, 3, None, None, 2023)),
+    ("30 May; 2 June 2024", (30, 5, 2, 6, 2024)),
+    ("30 мая - 2 июня 2024", (30, 5, 2, 6, 2024)),
+    ("  7   December ", (7, 12, None, None, THIS_YEAR)),
+])
+def test_accepted_formats(value, expected):
+    p = parse_dates(value)
+    assert (p["d1"], p["m1"], p["d2"], p["m2"], p["y"]) == expected
+
+
+@pytest.mark.parametrize("value", ["", "   ", "скоро", "March 2024", "32 March 2024", "31.13.24", "00.05.24"])
+def test_garbage_raises(value):
+    with pytest.raises(DateParseError):
+        parse_dates(value)
+
+
+def test_date_parse_error_is_value_error():
+    with pytest.raises(ValueError, match="Не удалось разобрать даты: 'скоро'"):
+        parse_dates("скоро")
+
+
+def test_parser_memoizes_and_reports_per_value():
+    parser = DateParser()
+    assert parser.parse("01.02.24") is parser.parse("01.02.24")
+    assert parser.parse("01.02.24").kind == "1day_1month"
+    assert parser.parse("12-14 March 2024").kind == "duration_day"
+    assert parser.parse("30 May - 2 June 2024").kind == "2day_2month"
+
+    for value in ("скоро", "скоро", "потом"):
+        with pytest.raises(DateParseError):
+            parser.parse(value)
+    assert parser.distinct == 5
+    assert parser.unparseable == {"скоро": 2, "потом": 1}
+    assert parser.warnings() == ["Не распознаны даты «скоро» (строк: 2)", "Не распознаны даты «потом» (строк: 1)"]
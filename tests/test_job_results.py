@@ -0,0 +1,71 @@
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main as app_main
+from app.main import JobResultStore, MemoryJobState
+from benchmarks.stand_in import StandInConverter
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobResultStore(str(tmp_path / "results"), ttl=3600, max_bytes=1 << 30, backend=MemoryJobState())
+
+
+def commit(store, job_id: str, output: str, data: bytes) -> str:
+    path = store.new_file(job_id, output)
+    with open(path, "wb") as f:
+        f.write(data)
+    store.commit(job_id, path, output)
+    return store.get(job_id).path
+
+
+def test_extension_follows_output(store):
+    assert commit(store, "a", "zip", b"PK").endswith(".zip")
+    pdf = commit(store, "b", "pdf", b"%PDF")
+    assert pdf.endswith(".pdf")
+    assert store.get("b").output == "pdf"
+
+    zip_path = commit(store, "b", "zip", b"PK")  # перезапуск задачи в другом виде
+    assert not os.path.exists(pdf)
+    assert sorted(os.listdir(store.directory)) == sorted(os.path.basename(p) for p in (zip_path, store.get("a").path))
+
+
+def test_orphans_of_both_kinds_are_swept(store):
+    stale = time.time() - 2 * store.ttl
+    for name in ("old.zip", "old.pdf", "old.zip.1.tmp"):
+        path = os.path.join(store.directory, name)
+        open(path, "wb").close()
+        os.utime(path, (stale, stale))
+    store.sweep()
+    assert os.listdir(store.directory) == []
+
+
+@pytest.mark.parametrize("output, media_type, filename", [
+    ("zip", "application/zip", "certificates.zip"),
+    ("pdf", "application/pdf", "certificates.pdf"),
+])
+def test_download_sends_type_of_output(monkeypatch, tmp_path, output, media_type, filename):
+    store = JobResultStore(str(tmp_path / "results"), 3600, 1 << 30, app_main.JOB_STATE)
+    monkeypatch.setattr(app_main, "JOB_RESULTS", store)
+    monkeypatch.setattr(app_main, "LO_POOL", StandInConverter())
+    monkeypatch.setattr(app_main, "RENDER_CACHE", app_main.RenderCache(str(tmp_path / "cache"), 1 << 26))
+    data = "Имя;Фамилия;Название тренинга;Даты;ID\nИван;Скачанов;Курс;01.02.24;DL-1".encode("utf-8")
+    job_id = f"download-{output}"
+
+    with TestClient(app_main.app) as client:
+        r = client.post("/generate-async", files={"csv_file": ("rows.csv", data)},
+                        data={"mode": "print", "job_id": job_id, "output": output})
+        assert r.status_code == 200, r.text
+        for _ in range(100):
+            d = client.get(f"/download/{job_id}")
+            if d.status_code == 200:
+                break
+            time.sleep(0.05)
+
+    assert d.status_code == 200
+    assert d.headers["content-type"] == media_type
+    assert f'filename="{filename}"' in d.headers["content-disposition"]
+    assert store.get(job_id).path.endswith("." + output)
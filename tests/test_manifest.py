@@ -0,0 +1,135 @@
+import io
+import json
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main as app_main
+from app.main import MANIFEST_NAME, JobManifest, PriorJob, _copy_zip_entry
+from benchmarks.stand_in import StandInConverter
+
+FAIL_NAME = "Сбойный"
+
+
+class FlakyConverter(StandInConverter):
+    """Как заглушка бенчмарка, но строка с FAIL_NAME не конвертируется."""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = True
+        self.calls = 0
+
+    def convert(self, docx_path: str, out_dir: str) -> str:
+        self.calls += 1
+        with zipfile.ZipFile(docx_path) as z:
+            if self.fail and FAIL_NAME in z.read("word/document.xml").decode("utf-8"):
+                raise RuntimeError("LibreOffice convert failed: test")
+        return super().convert(docx_path, out_dir)
+
+
+@pytest.fixture
+def converter(monkeypatch):
+    conv = FlakyConverter()
+    monkeypatch.setattr(app_main, "LO_POOL", conv)
+    return conv
+
+
+@pytest.fixture(autouse=True)
+def render_cache(monkeypatch, tmp_path):
+    # кэш рендера живёт на диске между запусками: без своего каталога строки берутся из него
+    monkeypatch.setattr(app_main, "RENDER_CACHE", app_main.RenderCache(str(tmp_path / "cache"), 64 * 1024 * 1024))
+
+
+@pytest.fixture
+def client():
+    with TestClient(app_main.app) as c:
+        yield c
+
+
+def table(*rows) -> bytes:
+    lines = ["Имя;Фамилия;Название тренинга;Даты;ID"]
+    lines += [f"{name};Манифестов;Курс манифеста;01.02.24;{cert_id}" for cert_id, name in rows]
+    return "\n".join(lines).encode("utf-8")
+
+
+def generate(client, data: bytes, manifest: bytes = None) -> zipfile.ZipFile:
+    files = {"csv_file": ("rows.csv", data)}
+    if manifest is not None:
+        files["manifest_file"] = (MANIFEST_NAME, manifest)
+    r = client.post("/generate", files=files, data={"mode": "print"})
+    assert r.status_code == 200, r.text
+    return zipfile.ZipFile(io.BytesIO(r.content))
+
+
+def entries(archive: zipfile.ZipFile) -> dict:
+    return json.loads(archive.read(MANIFEST_NAME))["entries"]
+
+
+def test_failed_row_is_not_recorded_and_regenerated_later(client, converter):
+    rows = table(("MF-1", "Иван"), ("MF-2", FAIL_NAME), ("MF-3", "Анна"))
+    first = generate(client, rows)
+    assert sorted(n for n in first.namelist() if n.endswith(".pdf")) == [
+        "MF-1_Манифестов_Иван.pdf", "MF-3_Манифестов_Анна.pdf"]
+    assert sorted(entries(first)) == ["MF-1", "MF-3"]
+
+    converter.fail = False
+    second = generate(client, rows, manifest=first.read(MANIFEST_NAME))
+    assert [n for n in second.namelist() if n.endswith(".pdf")] == [f"MF-2_Манифестов_{FAIL_NAME}.pdf"]
+    assert sorted(entries(second)) == ["MF-1", "MF-2", "MF-3"]
+
+
+def test_only_changed_rows_are_rendered(client, converter):
+    converter.fail = False
+    first = generate(client, table(("MC-1", "Олег"), ("MC-2", "Пётр")))
+    calls = converter.calls
+
+    second = generate(client, table(("MC-1", "Олег"), ("MC-2", "Павел")), manifest=first.read(MANIFEST_NAME))
+    assert [n for n in second.namelist() if n.endswith(".pdf")] == ["MC-2_Манифестов_Павел.pdf"]
+    assert converter.calls == calls + 1
+    manifest = entries(second)
+    assert manifest["MC-1"] == entries(first)["MC-1"]
+    assert manifest["MC-2"]["entry"] == "MC-2_Манифестов_Павел.pdf"
+
+
+def test_prior_job_unchanged():
+    manifest = JobManifest("print", "docx", "print")
+    manifest.add("A", "hash-a", "a.pdf")
+    manifest.add("A", "other", "other.pdf")  # первая запись не перезаписывается
+    manifest.add("B", "hash-b", "b.pdf")
+    restored = JobManifest.from_json(manifest.to_json())
+    assert restored.entries == manifest.entries
+
+    prior = PriorJob(restored)
+    assert prior.unchanged("A", "hash-a") == "a.pdf"
+    assert prior.unchanged("A", "changed") is None
+    assert prior.unchanged("C", "hash-c") is None
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("a.pdf", b"%PDF-a")
+    with zipfile.ZipFile(buf) as archive:
+        prior = PriorJob(restored, archive)
+        assert prior.unchanged("A", "hash-a") == "a.pdf"
+        assert prior.unchanged("B", "hash-b") is None  # записи нет в архиве — рендерим заново
+
+
+def test_bad_manifest_is_rejected():
+    with pytest.raises(ValueError):
+        JobManifest.from_json(b"{}")
+
+
+@pytest.mark.parametrize("raw_copy", [True, False])
+def test_copy_zip_entry(monkeypatch, raw_copy):
+    monkeypatch.setattr(app_main, "_ZIP_RAW_COPY", raw_copy)
+    payload = b"%PDF-1.7 " + bytes(range(256)) * 64
+    src_buf, dst_buf = io.BytesIO(), io.BytesIO()
+    with zipfile.ZipFile(src_buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("old.pdf", payload)
+    with zipfile.ZipFile(src_buf) as src, zipfile.ZipFile(dst_buf, "w", zipfile.ZIP_DEFLATED) as dst:
+        dst.writestr("first.pdf", b"first")
+        _copy_zip_entry(src, "old.pdf", dst, "new.pdf")
+    with zipfile.ZipFile(dst_buf) as dst:
+        assert dst.testzip() is None
+        assert dst.read("new.pdf") == payload
+        assert dst.getinfo("new.pdf").compress_type == zipfile.ZIP_DEFLATED
@@ -0,0 +1,59 @@
+import io
+
+import pytest
+from PyPDF2 import PdfReader
+
+from app.main import MergedPdfWriter
+from tests.pdfs import make_pdf
+
+# общие для документов объекты reportlab: словарь /Font, сам шрифт и фон-изображение
+SHARED_PER_DOC = 3
+
+
+def merge(docs, **options):
+    buf = io.BytesIO()
+    with MergedPdfWriter(buf, **options) as writer:
+        for name, data in docs:
+            writer.writestr(name, data)
+    return buf.getvalue(), writer
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("object_streams", [False, True])
+def test_round_trip_strict(compress, object_streams):
+    docs = [(f"{name}.pdf", make_pdf(name, pages=2)) for name in ("alpha", "beta", "gamma")]
+    output, writer = merge(docs, compress=compress, object_streams=object_streams)
+
+    reader = PdfReader(io.BytesIO(output), strict=True)
+    assert len(reader.pages) == writer.page_count == 6
+    texts = [page.extract_text().strip() for page in reader.pages]
+    assert texts == [f"{name} {i}" for name in ("alpha", "beta", "gamma") for i in range(2)]
+    for page in reader.pages:
+        assert [float(v) for v in page.mediabox] == [0, 0, 595, 842]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("object_streams", [False, True])
+def test_shared_objects_written_once(compress, object_streams):
+    docs = [(f"{i}.pdf", make_pdf(f"row {i}")) for i in range(4)]
+    output, writer = merge(docs, compress=compress, object_streams=object_streams)
+
+    assert writer.deduplicated == SHARED_PER_DOC * (len(docs) - 1)
+    assert output.count(b"/Subtype /Image") == 1
+    reader = PdfReader(io.BytesIO(output), strict=True)
+    images = {page["/Resources"]["/XObject"].raw_get(name).idnum
+              for page in reader.pages for name in page["/Resources"]["/XObject"]}
+    assert len(images) == 1
+
+
+def test_object_streams_make_output_smaller():
+    docs = [(f"{i}.pdf", make_pdf(f"row {i}")) for i in range(5)]
+    plain, _ = merge(docs)
+    packed, _ = merge(docs, compress=True, object_streams=True)
+    assert len(packed) < len(plain)
+
+
+def test_empty_document_is_valid():
+    output, _ = merge([])
+    reader = PdfReader(io.BytesIO(output), strict=True)
+    assert len(reader.pages) == 0
@@ -0,0 +1,35 @@
+import io
+
+from PyPDF2 import PdfReader
+
+from app.main import PDF_WEB_DPI, optimize_pdf, pick_quality
+from tests.pdfs import PAGE, make_pdf
+
+
+def test_default_quality_is_print():
+    assert pick_quality(None) == "print"
+    assert pick_quality("bogus") == "print"
+    assert pick_quality("web") == "web"
+
+
+def test_print_quality_is_untouched():
+    pdf = make_pdf("print")
+    assert optimize_pdf(pdf, "print") is pdf
+
+
+def test_web_quality_downsamples_background():
+    pdf = make_pdf("web", image_size=(2480, 1754))  # фон A4 в 300 DPI
+    optimized = optimize_pdf(pdf, "web")
+
+    assert len(optimized) < len(pdf)
+    reader = PdfReader(io.BytesIO(optimized), strict=True)
+    assert reader.pages[0].extract_text().strip() == "web 0"
+    image = next(iter(reader.pages[0]["/Resources"]["/XObject"].values())).get_object()
+    assert image["/Width"] <= round(PAGE[0] / 72 * PDF_WEB_DPI) + 1
+
+
+def test_web_quality_never_grows_output():
+    pdf = make_pdf("tiny", image_size=(8, 8))
+    optimized = optimize_pdf(pdf, "web")
+    assert len(optimized) <= len(pdf)
+    PdfReader(io.BytesIO(optimized), strict=True)
@@ -0,0 +1,44 @@
+import glob
+import os
+
+import pytest
+
+from app import main as app_main
+from app.main import extract_overlay_layout, overlay_unsupported_templates
+
+TEMPLATES = sorted(glob.glob(os.path.join(app_main.TEMPLATES_DIR, "*.docx")))
+
+
+def test_templates_found():
+    assert len(TEMPLATES) == 12
+
+
+@pytest.mark.parametrize("path", TEMPLATES, ids=os.path.basename)
+def test_every_template_has_layout(path):
+    layout = extract_overlay_layout(path)
+    assert layout is not None
+
+    for box in layout.boxes:
+        assert 0 <= box.x and box.x + box.width <= layout.page_width
+        assert 0 <= box.y and box.y + box.height <= layout.page_height
+    templates = [p.template for box in layout.boxes for p in box.paragraphs]
+    for field in ("{{Имя}} {{Фамилия}}", "{{Тренинг}}", "{{Идентификатор}}"):
+        assert any(field in t for t in templates), field
+
+
+@pytest.mark.parametrize("path", [p for p in TEMPLATES if not os.path.basename(p).startswith("template-online")],
+                         ids=os.path.basename)
+def test_print_template_follows_paragraph_flow(path):
+    layout = extract_overlay_layout(path)
+    boxes = {next(p.template for p in box.paragraphs if "{{" in p.template): box for box in layout.boxes}
+    name = boxes["{{Имя}} {{Фамилия}}"]
+    course = next(box for t, box in boxes.items() if "{{Тренинг}}" in t)
+    cert_id = next(box for t, box in boxes.items() if "{{Идентификатор}}" in t)
+    # имя в верхней половине листа, курс под ним, ID внизу — как в эталоне LibreOffice
+    assert 300 < name.y < 400
+    assert name.y + name.height <= course.y
+    assert cert_id.y > layout.page_height * 0.85
+
+
+def test_no_template_falls_back_to_libreoffice():
+    assert overlay_unsupported_templates() == []
@@ -0,0 +1,117 @@
+import asyncio
+import random
+
+import pytest
+
+from app.main import Pipeline, PipelineStage
+
+
+class Source:
+    """Асинхронный источник, запоминающий, сколько отдал и был ли закрыт."""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.produced = 0
+        self.closed = False
+
+    async def gen(self):
+        try:
+            for i in range(self.count):
+                self.produced += 1
+                yield i
+        finally:
+            self.closed = True
+
+
+async def jitter(x):
+    await asyncio.sleep(random.random() / 1000)
+    return x
+
+
+def test_sink_gets_items_in_source_order():
+    out = []
+
+    async def sink(item):
+        out.append(item)
+
+    async def double(x):
+        return await jitter(x * 2)
+
+    pipeline = Pipeline([PipelineStage("a", jitter, 3), PipelineStage("b", double, 2)], queue_size=2)
+    asyncio.run(pipeline.run(Source(50).gen(), sink))
+    assert out == [i * 2 for i in range(50)]
+
+
+def test_in_flight_items_are_bounded():
+    in_flight = peak = 0
+
+    async def enter(x):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        return await jitter(x)
+
+    async def sink(item):
+        nonlocal in_flight
+        await asyncio.sleep(0.001)  # медленный sink задаёт темп
+        in_flight -= 1
+
+    pipeline = Pipeline([PipelineStage("a", enter, 2)], queue_size=1)
+    source = Source(40)
+    asyncio.run(pipeline.run(source.gen(), sink))
+    assert peak <= pipeline.capacity
+
+
+def test_stage_error_stops_pipeline_and_closes_source():
+    started = []
+
+    async def fail_on_five(x):
+        if x == 5:
+            raise ValueError("bad row")
+        return await jitter(x)
+
+    async def slow(x):
+        started.append(x)
+        await asyncio.sleep(0.01)
+        return x
+
+    pipeline = Pipeline([PipelineStage("a", fail_on_five, 2), PipelineStage("b", slow, 1)], queue_size=2)
+    source = Source(10_000)
+
+    async def scenario():
+        with pytest.raises(ValueError, match="bad row"):
+            await pipeline.run(source.gen(), lambda item: asyncio.sleep(0))
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(scenario())
+    assert source.closed
+    assert source.produced <= pipeline.capacity + 1
+
+
+def test_cancel_stops_stages_and_closes_source():
+    gate = asyncio.Event()  # никогда не открывается
+    cancelled = []
+
+    async def stuck(x):
+        try:
+            await gate.wait()
+        except asyncio.CancelledError:
+            cancelled.append(x)
+            raise
+        return x
+
+    source = Source(1000)
+    pipeline = Pipeline([PipelineStage("a", stuck, 3)], queue_size=2)
+
+    async def scenario():
+        run = asyncio.ensure_future(pipeline.run(source.gen(), lambda item: asyncio.sleep(0)))
+        await asyncio.sleep(0.01)
+        run.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await run
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(scenario())
+    assert sorted(cancelled) == [0, 1, 2]
+    assert source.closed
+    assert source.produced <= pipeline.capacity
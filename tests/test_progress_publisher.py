@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+from app.main import ProgressPublisher
+
+
+class RecordingState:
+    """Бэкенд-заглушка: запоминает записи и поток, в котором они пришли."""
+
+    def __init__(self):
+        self.writes = []
+
+    def publish(self, job_id, data):
+        self.writes.append((job_id, data["stage"], data["processed"], threading.current_thread().name))
+
+
+def state(stage: str, processed: int = 0) -> dict:
+    return {"stage": stage, "processed": processed}
+
+
+def test_intermediate_states_are_throttled_off_loop():
+    backend = RecordingState()
+    publisher = ProgressPublisher(backend, interval=0.02)
+
+    async def scenario():
+        for i in range(100):
+            await publisher.publish("job", state("processing", i))
+        assert backend.writes == []  # цикл событий в базу не пишет
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    publisher.shutdown()
+    assert [(w[1], w[2]) for w in backend.writes] == [("processing", 99)]
+    assert backend.writes[0][3].startswith("progress")
+
+
+def test_terminal_state_is_written_before_emit_returns():
+    backend = RecordingState()
+    publisher = ProgressPublisher(backend, interval=10)
+
+    async def scenario():
+        await publisher.publish("a", state("processing", 1))
+        await publisher.publish("b", state("processing", 1))
+        await publisher.publish("a", state("done", 2))
+        assert [(w[0], w[1]) for w in backend.writes] == [("a", "done")]
+
+    asyncio.run(scenario())
+    publisher.shutdown()  # отложенное состояние b не теряется
+    assert [(w[0], w[1]) for w in backend.writes] == [("a", "done"), ("b", "processing")]
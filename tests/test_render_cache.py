@@ -0,0 +1,25 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from app.main import RenderCache
+
+
+def test_concurrent_puts_of_same_key(tmp_path):
+    cache = RenderCache(str(tmp_path), 1024 * 1024)
+    payloads = [bytes([i]) * 4096 for i in range(16)]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda data: cache.put("k", data), payloads))
+
+    assert cache.get("k") in payloads
+    assert cache.stats()["errors"] == 0
+    assert os.listdir(tmp_path) == ["k.pdf"]  # временные файлы не остаются
+
+
+def test_write_failure_is_counted_not_raised(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache"), 1024 * 1024)
+    shutil.rmtree(tmp_path / "cache")
+
+    cache.put("k", b"%PDF")
+    assert cache.stats()["errors"] == 1
+    assert cache.get("k") is None
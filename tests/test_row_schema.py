@@ -0,0 +1,51 @@
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main as app_main
+from app.main import CertificateRow, RowSchema, open_uploaded_table
+
+
+def test_aliases_map_to_canonical_fields():
+    schema = RowSchema.from_headers(
+        [" Name/Имя ", "SURNAME", "Course name", "Дата", "Certificate ID", "Город", "Country/Страна"])
+    assert schema.missing == []
+    assert schema.warnings() == []
+    row = schema.extract(["Ivan", "Petrov", " Data Science ", "01.02.24", "C-1", "Казань", "Россия"])
+    assert row == CertificateRow("Ivan", "Petrov", "Data Science", "01.02.24", "C-1", "Казань", "Россия")
+
+
+def test_column_order_and_short_rows():
+    schema = RowSchema.from_headers(["ID", "Даты", "Название тренинга", "Фамилия", "Имя"])
+    assert schema.extract(["C-2", "01.02.24", "Курс", "Петров"]) == CertificateRow(
+        first_name="", last_name="Петров", course="Курс", dates="01.02.24", id="C-2")
+
+
+def test_unknown_and_ambiguous_columns_are_reported():
+    schema = RowSchema.from_headers(["Имя", "Name", "Фамилия", "Тренинг", "Название", "Даты", "ID", "Комментарий", ""])
+    assert schema.missing == []
+    assert schema.extract(["Иван", "Ivan", "Петров", "x", "Курс", "01.02.24", "C-3"]).first_name == "Иван"
+    assert schema.warnings() == [
+        "Неизвестные колонки: Тренинг, Комментарий",
+        "Несколько колонок для поля first_name: Имя, Name — используется «Имя»",
+    ]
+
+
+def test_missing_required_columns():
+    schema = RowSchema.from_headers(["Имя", "Фамилия", "Название тренинга", "Город"])
+    assert schema.missing == ["dates", "id"]
+
+
+def test_missing_columns_fail_before_rows_are_read():
+    data = "Имя;Фамилия;Город\n" + "Иван;Петров;Москва\n" * 1000
+    with pytest.raises(ValueError, match="^Не найдены обязательные колонки: course, dates, id$"):
+        open_uploaded_table(io.BytesIO(data.encode("utf-8")), "rows.csv")
+
+
+def test_generate_rejects_missing_columns_with_400():
+    with TestClient(app_main.app) as client:
+        r = client.post("/generate", files={"csv_file": ("rows.csv", "Имя;Фамилия\nИван;Петров".encode())},
+                        data={"mode": "print"})
+    assert r.status_code == 400
+    assert r.text == "Не найдены обязательные колонки: course, dates, id"
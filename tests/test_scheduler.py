@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import pytest
+
+from app import main as app_main
+from app.main import JobScheduler, ScheduledJob
+
+
+@pytest.fixture
+def job():
+    created = []
+
+    def make(key: str) -> ScheduledJob:
+        created.append(key)
+        return ScheduledJob(key, app_main.get_progress(key), key)
+    yield make
+    for key in created:
+        app_main.PROGRESS.pop(key, None)
+
+
+def test_round_robin_between_active_jobs(job):
+    order = []
+    lock = threading.Lock()
+
+    def unit(name: str) -> str:
+        with lock:
+            order.append(name)
+        return name
+
+    async def scenario():
+        scheduler = JobScheduler(slots=1, max_active=2)
+        big, small = job("big"), job("small")
+        await scheduler.admit(big)
+        await scheduler.admit(small)
+        futures = [scheduler.submit(big, unit, f"big{i}") for i in range(4)]
+        futures += [scheduler.submit(small, unit, f"small{i}") for i in range(2)]
+        results = await asyncio.gather(*futures)
+        scheduler.shutdown()
+        return results
+
+    results = asyncio.run(scenario())
+    assert results == ["big0", "big1", "big2", "big3", "small0", "small1"]
+    # первая единица big ушла сразу; дальше слот чередуется, маленькая задача не ждёт конца большой
+    assert order == ["big0", "small0", "big1", "small1", "big2", "big3"]
+
+
+def test_queue_position_and_admission(job):
+    async def scenario():
+        scheduler = JobScheduler(slots=1, max_active=1)
+        first, second, third = job("first"), job("second"), job("third")
+        await scheduler.admit(first)
+        waiting = [asyncio.ensure_future(scheduler.admit(j)) for j in (second, third)]
+        await asyncio.sleep(0)
+        assert (second.state.stage, second.state.queue_position) == ("queued", 1)
+        assert (third.state.stage, third.state.queue_position) == ("queued", 2)
+        assert third.state.message == "В очереди: 2"
+        assert scheduler.stats()["queued_jobs"] == 2
+
+        scheduler.release(first)
+        await waiting[0]
+        await asyncio.sleep(0)
+        assert (second.state.stage, second.state.queue_position) == ("processing", 0)
+        assert third.state.queue_position == 1
+        assert not waiting[1].done()
+
+        scheduler.release(second)
+        await waiting[1]
+        assert scheduler.stats()["active_jobs"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue(job):
+    async def scenario():
+        scheduler = JobScheduler(slots=1, max_active=1)
+        first, second, third = job("first"), job("second"), job("third")
+        await scheduler.admit(first)
+        waiting = [asyncio.ensure_future(scheduler.admit(j)) for j in (second, third)]
+        await asyncio.sleep(0)
+        waiting[0].cancel()
+        await asyncio.gather(waiting[0], return_exceptions=True)
+        await asyncio.sleep(0)
+        assert third.state.queue_position == 1
+        assert scheduler.stats()["queued_jobs"] == 1
+
+        scheduler.release(first)
+        await waiting[1]
+        assert third.state.stage == "processing"
+
+    asyncio.run(scenario())
+
+
+def test_release_cancels_pending_units(job):
+    async def scenario():
+        scheduler = JobScheduler(slots=1, max_active=1)
+        gate = threading.Event()
+        a = job("a")
+        await scheduler.admit(a)
+        running = scheduler.submit(a, gate.wait)
+        pending = scheduler.submit(a, lambda: "never")
+        scheduler.release(a)
+        assert pending.cancelled()
+        gate.set()
+        assert await running is True
+        assert scheduler.stats()["busy"] == 0
+        scheduler.shutdown()
+
+    asyncio.run(scenario())
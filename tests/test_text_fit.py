@@ -0,0 +1,53 @@
+import glob
+import os
+import re
+
+import pytest
+
+from app import main as app_main
+from app.main import TEMPLATE_REGISTRY, TEXT_FIT_MIN_SCALE, DocxStyles, _fit_style, _lines_needed, fit_size, glyph_metrics
+
+TEMPLATES = sorted(glob.glob(os.path.join(app_main.TEMPLATES_DIR, "*.docx")))
+LONG_NAME = "Констанция-Виктория Вознесенская-Преображенская"
+W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+MARKER = re.compile(r"\{\{\s*Имя\s*\}\}")
+
+
+def lines_at(text: str, slot, size: float) -> float:
+    metrics = glyph_metrics(slot.style)
+    return _lines_needed([metrics.em_width(w) for w in text.split()], metrics.em_width(" "), slot.width / size)
+
+
+@pytest.mark.parametrize("path", TEMPLATES, ids=os.path.basename)
+def test_long_name_is_shrunk_to_fit(path):
+    slot = next(s for s in TEMPLATE_REGISTRY.get(path).fit_slots if s.field == "name")
+    assert fit_size("Иван Петров", slot) == slot.size
+
+    size = fit_size(LONG_NAME, slot)
+    assert slot.size * TEXT_FIT_MIN_SCALE <= size < slot.size
+    assert lines_at(LONG_NAME, slot, size) <= slot.max_lines
+    assert lines_at(LONG_NAME, slot, size + 0.5) > slot.max_lines  # кегль наибольший из влезающих
+
+
+def para(run_props: str, para_props: str = "") -> str:
+    return f"<w:p><w:pPr>{para_props}</w:pPr><w:r><w:rPr>{run_props}</w:rPr><w:t>{{{{Имя}}}}</w:t></w:r></w:p>"
+
+
+STYLES = f"""<w:styles {W}>
+  <w:style w:type="paragraph" w:default="1" w:styleId="Normal"/>
+  <w:style w:type="paragraph" w:styleId="Title"><w:rPr><w:b/></w:rPr></w:style>
+  <w:style w:type="paragraph" w:styleId="Subtitle"><w:basedOn w:val="Title"/></w:style>
+  <w:style w:type="character" w:styleId="Strong"><w:rPr><w:b w:val="1"/></w:rPr></w:style>
+</w:styles>""".encode()
+
+
+@pytest.mark.parametrize("run_props, para_props, style", [
+    ("<w:b/>", "", "bold"),
+    ('<w:b w:val="0"/>', "", "regular"),
+    ('<w:b w:val="false"/><w:rFonts w:ascii="EYInterstate Light"/>', "", "light"),
+    ('<w:rStyle w:val="Strong"/>', "", "bold"),
+    ("", '<w:pStyle w:val="Subtitle"/>', "bold"),
+    ('<w:b w:val="off"/>', '<w:pStyle w:val="Title"/>', "regular"),
+])
+def test_fit_style_resolves_bold(run_props, para_props, style):
+    assert _fit_style(para(run_props, para_props), MARKER, DocxStyles(STYLES), f" {W}") == style